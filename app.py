@@ -4,7 +4,9 @@ import sys
 import random
 import glob
 import json
+import shlex
 import subprocess
+import time
 import zipfile
 import requests
 import easywebdav
@@ -13,6 +15,10 @@ from functools import wraps
 from werkzeug.security import generate_password_hash, check_password_hash
 from db_handler import DBHandler
 from logger import setup_logger
+from sync_trigger import SyncTriggerWorker, relative_sync_path
+from sync_plan import PLAN_ACTIONS, format_bytes, format_duration, load_plan
+from tree_history import open_tree_index
+from tree_index import DIFF_PAGE_SIZE
 from task_scheduler import add_tasks_to_cron, update_tasks_in_cron, delete_tasks_from_cron, list_tasks_in_cron, convert_to_cron_time, run_task_immediately
 import psutil
 from datetime import datetime
@@ -41,6 +47,9 @@ local_version = "6.1.2"
 CRON_BACKUP_FILE = "/config/cron.bak"
 ENV_FILE = "/config/app.env"
 
+# 可选的目录列表后端
+LISTING_BACKENDS = ['webdav', 'webdav_bulk', 'alist_api']
+
 
 
 
@@ -49,7 +58,7 @@ ENV_FILE = "/config/app.env"
 @app.before_request
 def check_user_config():
     # 跳过以下端点的检查
-    if request.endpoint in ['login', 'register', 'static', 'random_image', 'forgot_password']:
+    if request.endpoint in ['login', 'register', 'static', 'random_image', 'forgot_password', 'sync_trigger']:
         return
 
     # 确保 user_config 表中有用户名和密码
@@ -306,6 +315,8 @@ def random_image():
 @app.before_request
 def before_request():
     g.local_version = local_version  # 动态获取版本号的逻辑
+    if not app.testing:
+        sync_trigger_worker.start()
 
 
 @app.route('/edit/<int:config_id>', methods=['GET', 'POST'])
@@ -325,11 +336,24 @@ def edit_config(config_id):
             download_enabled = int(request.form.get('download_enabled', 1))  # 获取是否启用下载功能，默认1（启用）
             update_mode = request.form['update_mode']  # 获取更新模式
             strm_suffix = request.form.get('strm_suffix', '-转码')  # 获取strm文件后缀
+            crawl_concurrency = parse_crawl_concurrency(request.form.get('crawl_concurrency', '1'))  # 目录遍历并发数
+            request_rate, request_burst = parse_request_rate(request.form.get('request_rate', '2'), request.form.get('request_burst', '5'))  # 请求限流
+            listing_backend = request.form.get('listing_backend', 'webdav')  # 目录列表后端
+            if listing_backend not in LISTING_BACKENDS:
+                listing_backend = 'webdav'
+            freshness_hours = parse_freshness_hours(request.form.get('freshness_hours', '24'))  # 目录列表新鲜度窗口
+            prune_max_percent = parse_prune_max_percent(request.form.get('prune_max_percent', '10'))  # 单次删除上限
+            prune_sidecars = int(request.form.get('prune_sidecars', 0))  # 是否同时删除同名附属文件
 
             # 前端验证已经做过，这里做后端验证
             if not validate_download_interval_range(download_interval_range):
                 flash("下载间隔范围无效。请使用 'min-max' 格式，且 min <= max。", 'error')
                 return redirect(url_for('new_config'))
+            try:
+                output_profiles = parse_output_profiles(request.form.get('output_profiles', ''), target_directory)  # 其他输出
+            except ValueError as e:
+                flash(f"其他输出配置无效: {e}", 'error')
+                return redirect(request.url)
 
             # 自动为 rootpath 添加 /dav/ 前缀（如果没有）
             if not rootpath.startswith('/dav/'):
@@ -338,9 +362,9 @@ def edit_config(config_id):
             # 更新配置，包括下载启用状态、更新模式和大小阈值
             db_handler.cursor.execute('''
                 UPDATE config 
-                SET config_name = ?, url = ?, username = ?, password = ?, rootpath = ?, target_directory = ?, download_enabled = ?, update_mode = ?, download_interval_range = ?, strm_suffix = ?
+                SET config_name = ?, url = ?, username = ?, password = ?, rootpath = ?, target_directory = ?, download_enabled = ?, update_mode = ?, download_interval_range = ?, strm_suffix = ?, crawl_concurrency = ?, request_rate = ?, request_burst = ?, listing_backend = ?, freshness_hours = ?, prune_max_percent = ?, prune_sidecars = ?, output_profiles = ?
                 WHERE config_id = ?
-            ''', (config_name, url, username, password, rootpath, target_directory, download_enabled, update_mode, download_interval_range, strm_suffix, config_id))
+            ''', (config_name, url, username, password, rootpath, target_directory, download_enabled, update_mode, download_interval_range, strm_suffix, crawl_concurrency, request_rate, request_burst, listing_backend, freshness_hours, prune_max_percent, prune_sidecars, output_profiles, config_id))
             db_handler.conn.commit()
 
             flash('配置已成功更新！', 'success')
@@ -348,7 +372,7 @@ def edit_config(config_id):
 
         # GET 请求时，获取并显示现有的配置项
         db_handler.cursor.execute('''
-            SELECT config_name, url, username, password, rootpath, target_directory, download_enabled, update_mode, download_interval_range, strm_suffix 
+            SELECT config_name, url, username, password, rootpath, target_directory, download_enabled, update_mode, download_interval_range, strm_suffix, crawl_concurrency, request_rate, request_burst, listing_backend, freshness_hours, prune_max_percent, prune_sidecars, output_profiles 
             FROM config 
             WHERE config_id = ?
         ''', (config_id,))
@@ -384,11 +408,24 @@ def new_config():
             download_enabled = int(request.form.get('download_enabled', 1))  # 获取是否启用下载功能，默认1（启用）
             update_mode = request.form['update_mode']  # 获取更新模式
             strm_suffix = request.form.get('strm_suffix', '-转码')  # 获取strm文件后缀
+            crawl_concurrency = parse_crawl_concurrency(request.form.get('crawl_concurrency', '1'))  # 目录遍历并发数
+            request_rate, request_burst = parse_request_rate(request.form.get('request_rate', '2'), request.form.get('request_burst', '5'))  # 请求限流
+            listing_backend = request.form.get('listing_backend', 'webdav')  # 目录列表后端
+            if listing_backend not in LISTING_BACKENDS:
+                listing_backend = 'webdav'
+            freshness_hours = parse_freshness_hours(request.form.get('freshness_hours', '24'))  # 目录列表新鲜度窗口
+            prune_max_percent = parse_prune_max_percent(request.form.get('prune_max_percent', '10'))  # 单次删除上限
+            prune_sidecars = int(request.form.get('prune_sidecars', 0))  # 是否同时删除同名附属文件
 
             # 前端验证已经做过，这里做后端验证
             if not validate_download_interval_range(download_interval_range):
                 flash("下载间隔范围无效。请使用 'min-max' 格式，且 min <= max。", 'error')
                 return redirect(url_for('new_config'))
+            try:
+                output_profiles = parse_output_profiles(request.form.get('output_profiles', ''), target_directory)  # 其他输出
+            except ValueError as e:
+                flash(f"其他输出配置无效: {e}", 'error')
+                return redirect(request.url)
 
             # 自动为 rootpath 添加 /dav/ 前缀（如果没有）
             if not rootpath.startswith('/dav/'):
@@ -396,9 +433,9 @@ def new_config():
 
             # 插入新配置到数据库，确保所有字段都被插入
             db_handler.cursor.execute('''
-                INSERT INTO config (config_name, url, username, password, rootpath, target_directory, download_interval_range, download_enabled, update_mode, strm_suffix) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (config_name, url, username, password, rootpath, target_directory, download_interval_range, download_enabled, update_mode, strm_suffix))
+                INSERT INTO config (config_name, url, username, password, rootpath, target_directory, download_interval_range, download_enabled, update_mode, strm_suffix, crawl_concurrency, request_rate, request_burst, listing_backend, freshness_hours, prune_max_percent, prune_sidecars, output_profiles) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (config_name, url, username, password, rootpath, target_directory, download_interval_range, download_enabled, update_mode, strm_suffix, crawl_concurrency, request_rate, request_burst, listing_backend, freshness_hours, prune_max_percent, prune_sidecars, output_profiles))
             db_handler.conn.commit()
 
             flash('新配置已成功添加！', 'success')
@@ -415,7 +452,7 @@ def new_config():
 def copy_config(config_id):
     try:
         # 查询要复制的配置
-        db_handler.cursor.execute('SELECT config_name, url, username, password, rootpath, target_directory, download_interval_range, download_enabled, update_mode, strm_suffix FROM config WHERE config_id = ?', (config_id,))
+        db_handler.cursor.execute('SELECT config_name, url, username, password, rootpath, target_directory, download_interval_range, download_enabled, update_mode, strm_suffix, crawl_concurrency, request_rate, request_burst, listing_backend, freshness_hours, prune_max_percent, prune_sidecars, output_profiles FROM config WHERE config_id = ?', (config_id,))
         config = db_handler.cursor.fetchone()
 
         if not config:
@@ -426,9 +463,9 @@ def copy_config(config_id):
         new_name = config[0] + " - 复制"
 
         db_handler.cursor.execute('''
-            INSERT INTO config (config_name, url, username, password, rootpath, target_directory, download_interval_range, download_enabled, update_mode, strm_suffix) 
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (new_name, config[1], config[2], config[3], config[4], config[5], config[6], config[7], config[8], config[9]))
+            INSERT INTO config (config_name, url, username, password, rootpath, target_directory, download_interval_range, download_enabled, update_mode, strm_suffix, crawl_concurrency, request_rate, request_burst, listing_backend, freshness_hours, prune_max_percent, prune_sidecars, output_profiles) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (new_name, config[1], config[2], config[3], config[4], config[5], config[6], config[7], config[8], config[9], config[10], config[11], config[12], config[13], config[14], config[15], config[16], config[17]))
 
         # 提交事务
         db_handler.conn.commit()
@@ -467,6 +504,71 @@ def validate_download_interval_range(interval_range):
     return min_val <= max_val
 
 
+def parse_crawl_concurrency(value):
+    # 目录遍历并发数，非法值回退为 1（串行），上限 32
+    try:
+        return min(32, max(1, int(value)))
+    except (TypeError, ValueError):
+        return 1
+
+
+def parse_request_rate(rate, burst):
+    # 每秒请求数（0 表示不限速）和突发请求数，非法值回退为默认值
+    try:
+        rate = max(0.0, float(rate))
+    except (TypeError, ValueError):
+        rate = 2.0
+    try:
+        burst = max(1, int(burst))
+    except (TypeError, ValueError):
+        burst = 5
+    return rate, burst
+
+
+def parse_freshness_hours(value):
+    # 目录列表的新鲜度窗口（小时），非法值回退为 24，最小 0.1
+    try:
+        return max(0.1, float(value))
+    except (TypeError, ValueError):
+        return 24.0
+
+
+def parse_prune_max_percent(value):
+    # 单次运行最多删除的 .strm 文件百分比，0 表示不自动删除，非法值回退为 10
+    try:
+        return min(100.0, max(0.0, float(value)))
+    except (TypeError, ValueError):
+        return 10.0
+
+
+def parse_output_profiles(value, target_directory):
+    # 其他输出：JSON 列表，每项包含 target_directory，可选 strm_suffix 和 url_template（占位符 {base}、{path} 等）；
+    # 为空时返回 None，格式无效时抛出 ValueError
+    if not value or not value.strip():
+        return None
+    try:
+        profiles = json.loads(value)
+    except ValueError:
+        raise ValueError('不是有效的 JSON')
+    if not isinstance(profiles, list):
+        raise ValueError('应为 JSON 列表')
+    targets = {os.path.normpath(target_directory)}
+    for profile in profiles:
+        if not isinstance(profile, dict) or not profile.get('target_directory'):
+            raise ValueError('每个输出都需要 target_directory')
+        target = os.path.normpath(profile['target_directory'])
+        if target in targets:
+            raise ValueError(f'目标目录重复: {profile["target_directory"]}')
+        targets.add(target)
+        template = profile.get('url_template')
+        if template:
+            try:
+                template.format(base='', protocol='', host='', port='', path='')
+            except (KeyError, IndexError, ValueError):
+                raise ValueError(f'链接模板无效: {template}')
+    return json.dumps(profiles, ensure_ascii=False) if profiles else None
+
+
 # 设置页面
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
@@ -571,8 +673,9 @@ def logs(config_id):
     )
 
 
-# 定义函数来运行 main.py
-def run_config(config_id):
+# 定义函数来运行 main.py，paths 为需要单独同步的子目录列表（为空时同步整个配置）
+# 返回启动的子进程，启动失败时返回 None
+def run_config(config_id, paths=None, plan=False):
     # 获取当前文件的目录路径
     current_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -582,6 +685,10 @@ def run_config(config_id):
     if os.path.exists(main_script_path):
         # 使用python而不是python3.9，因为Docker环境中可能没有python3.9
         command = f"python {main_script_path} {config_id}"
+        for path in paths or []:
+            command += f" --path {shlex.quote(path)}"
+        if plan:
+            command += " --plan"
         try:
             # 创建临时logger用于记录
             temp_logger, _ = setup_logger('run_config')
@@ -596,9 +703,9 @@ def run_config(config_id):
                 command, 
                 shell=True, 
                 cwd=current_dir,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
+                # main.py 自行写日志文件，输出不需要读取；使用管道而不读取会在输出较多时阻塞子进程
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
             )
             print(f"✅ 脚本已启动，进程ID: {process.pid}")
             
@@ -608,6 +715,7 @@ def run_config(config_id):
                 temp_logger.info(f"脚本已启动，进程ID: {process.pid}")
             except Exception as e:
                 print(f"❌ 记录进程信息时出错: {e}")
+            return process
                 
         except Exception as e:
             error_msg = f"运行脚本时出错: {e}"
@@ -655,6 +763,127 @@ def run_selected_configs():
 
     return redirect(url_for('configs'))
 
+@app.route('/sync_config_paths/<int:config_id>', methods=['POST'])
+def sync_config_paths(config_id):
+    config = db_handler.get_webdav_config(config_id)
+    if not config:
+        flash(f'配置ID {config_id} 不存在', 'error')
+        return redirect(url_for('configs'))
+
+    # 多个子目录用 | 或换行分隔
+    paths = [path.strip() for path in re.split(r'[|\n]', request.form.get('paths', '')) if path.strip()]
+    if not paths:
+        flash('请输入需要同步的子目录', 'error')
+        return redirect(url_for('configs'))
+
+    run_config(config_id, paths)
+    flash(f'配置 {config["config_name"]} 的子目录同步已开始: {", ".join(paths)}', 'success')
+    return redirect(url_for('configs'))
+
+@app.route('/plan_config/<int:config_id>', methods=['POST'])
+def plan_config(config_id):
+    config = db_handler.get_webdav_config(config_id)
+    if not config:
+        flash(f'配置ID {config_id} 不存在', 'error')
+        return redirect(url_for('configs'))
+
+    # 干跑只生成变更计划，不修改目标目录；完成后在计划页面查看
+    run_config(config_id, plan=True)
+    flash(f'配置 {config["config_name"]} 的变更计划正在生成，完成后刷新本页查看', 'success')
+    return redirect(url_for('sync_plan_view', config_id=config_id))
+
+@app.route('/sync_plan/<int:config_id>')
+def sync_plan_view(config_id):
+    config = db_handler.get_webdav_config(config_id)
+    if not config:
+        return render_template('404.html'), 404
+    plan = load_plan(config_id)
+    generated_at = datetime.fromtimestamp(plan['generated_at']).strftime('%Y-%m-%d %H:%M:%S') if plan else None
+    return render_template('sync_plan.html', config=config, config_id=config_id, plan=plan, generated_at=generated_at,
+                           actions=PLAN_ACTIONS, format_bytes=format_bytes, format_duration=format_duration)
+
+# 通知触发的同步：外部（如 AList 上传钩子、脚本）通知某个路径发生变化，路径先写入持久化队列，
+# 由后台线程合并短时间内的多次通知后，再通过 main.py --path 只同步对应的子目录
+# 后台线程在应用收到请求（flask run 不执行 __main__）或直接运行 app.py 时启动，导入 app.py 本身不启动
+sync_trigger_worker = SyncTriggerWorker(DBHandler, run_config, setup_logger('sync_trigger')[0])
+
+@app.route('/api/sync_trigger', methods=['POST'])
+def sync_trigger():
+    data = request.get_json(silent=True) or request.form
+    # 使用安全码校验通知来源，可放在 X-Sync-Token 请求头或 token 参数中
+    token = request.headers.get('X-Sync-Token') or data.get('token')
+    if token != load_security_code():
+        return jsonify({'error': '安全码不正确'}), 403
+
+    paths = data.get('paths') if isinstance(data.get('paths'), list) else [data.get('path')]
+    paths = [path for path in paths if isinstance(path, str) and path.strip()]
+    if not paths:
+        return jsonify({'error': '缺少 path 参数'}), 400
+
+    # 未指定配置时，通知会分发给根路径包含该路径的所有配置
+    config_id = data.get('config_id')
+    if config_id not in (None, ''):
+        # JSON 中的布尔值、小数等不是有效的配置ID
+        if not str(config_id).isdigit():
+            return jsonify({'error': 'config_id 参数必须是整数'}), 400
+        config_ids = [int(config_id)]
+    else:
+        config_ids = [config[0] for config in db_handler.get_all_configurations()]
+
+    queued = []
+    now = time.time()
+    for config_id in config_ids:
+        config = db_handler.get_webdav_config(config_id)
+        if not config:
+            continue
+        for path in paths:
+            relative_path = relative_sync_path(config['rootpath'], path)
+            if relative_path is None:
+                continue
+            queued_path = db_handler.enqueue_sync_path(config_id, relative_path, now)
+            queued.append({'config_id': config_id, 'path': path, 'queued_path': queued_path})
+
+    return jsonify({'queued': queued, 'ignored': [path for path in paths if path not in {item['path'] for item in queued}]})
+
+@app.route('/api/tree_history/<int:config_id>/runs')
+@login_required
+def tree_history_runs(config_id):
+    tree_index = open_tree_index(config_id)
+    if tree_index is None:
+        return jsonify({'error': f'配置ID {config_id} 不存在或尚未建立远程目录树索引'}), 404
+    try:
+        return jsonify({'runs': tree_index.list_runs()})
+    finally:
+        tree_index.close()
+
+@app.route('/api/tree_history/<int:config_id>/diff')
+@login_required
+def tree_history_diff(config_id):
+    """对比两次运行结束时的远程目录树，按路径分页返回，next_after 作为下一页的 after 参数"""
+    tree_index = open_tree_index(config_id)
+    if tree_index is None:
+        return jsonify({'error': f'配置ID {config_id} 不存在或尚未建立远程目录树索引'}), 404
+    try:
+        from_run = request.args.get('from', type=int)
+        to_run = request.args.get('to', type=int) or int(tree_index.get_meta('finished_run', 0))
+        if from_run is None:
+            return jsonify({'error': '缺少 from 参数'}), 400
+        limit = min(request.args.get('limit', DIFF_PAGE_SIZE, type=int), 10000)
+        changes, next_after = tree_index.diff_runs(from_run, to_run, request.args.get('after'), limit)
+        return jsonify({
+            'from_run': from_run,
+            'to_run': to_run,
+            'changes': [
+                {'change': change, 'path': path, 'is_dir': is_dir, 'size': size, 'mtime': mtime}
+                for change, path, is_dir, size, mtime in changes
+            ],
+            'next_after': next_after,
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    finally:
+        tree_index.close()
+
 @app.route('/generate_strm_files/<int:config_id>', methods=['POST'])
 def generate_strm_files(config_id):
     try:
@@ -1143,6 +1372,18 @@ def update_version():
 # 在您的 Flask 应用中，确保已经导入了必要的模块
 
 
+def load_security_code():
+    """
+    获取安全码，默认为 'alist-strm'，app.env 中的设置优先。
+    """
+    stored_security_code = os.getenv('SECURITY_CODE', 'alist-strm')
+    if os.path.exists(ENV_FILE):
+        with open(ENV_FILE, 'r') as f:
+            for line in f:
+                if line.startswith('SECURITY_CODE='):
+                    stored_security_code = line.split('=')[1].strip()
+    return stored_security_code
+
 # 修改 forgot_password 路由
 @app.route('/forgot_password', methods=['GET', 'POST'])
 def forgot_password():
@@ -1151,16 +1392,8 @@ def forgot_password():
         new_password = request.form['new_password']
         confirm_password = request.form['confirm_password']
 
-        # 获取安全码，默认为 'alist-strm'
-        stored_security_code = os.getenv('SECURITY_CODE', 'alist-strm')
-        if os.path.exists(ENV_FILE):
-            with open(ENV_FILE, 'r') as f:
-                for line in f:
-                    if line.startswith('SECURITY_CODE='):
-                        stored_security_code = line.split('=')[1].strip()
-
         # 验证安全码
-        if stored_security_code != security_code:
+        if load_security_code() != security_code:
             flash('安全码不正确', 'error')
             return redirect(url_for('forgot_password'))
 
@@ -1605,6 +1838,7 @@ if __name__ == '__main__':
     port = load_port_from_env()
     # 本地开发时关闭debug模式，避免文件锁定问题
     debug_mode = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
+    sync_trigger_worker.start()
     app.run(host="0.0.0.0", port=port, debug=debug_mode, use_reloader=False)
 
 
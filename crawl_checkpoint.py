@@ -0,0 +1,94 @@
+import os
+import time
+from urllib.parse import unquote
+
+import tree_codec
+
+# 检查点写入间隔（秒）
+CHECKPOINT_INTERVAL = 60
+# 超过该时间（秒）的检查点视为过期，不再续跑
+CHECKPOINT_MAX_AGE = 3 * 24 * 3600
+
+
+class CrawlCheckpoint:
+    """
+    目录遍历检查点。定期把遍历进度（已完成的目录树、待遍历目录、已访问目录、未完成的写入/下载任务和计数器）
+    保存到 cache/crawl_checkpoint_<config_id>.dat（tree_codec 紧凑格式），进程或容器重启后 main.py 可从检查点继续遍历。
+    检查点与配置的根路径、目标目录和列表后端（部分同步时还有所选子目录）绑定，配置变更后旧检查点自动失效。
+    """
+
+    def __init__(self, config_id, config, logger, sync_paths=None, interval=CHECKPOINT_INTERVAL):
+        cache_dir = 'cache'
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.checkpoint_file = os.path.join(cache_dir, f'crawl_checkpoint_{config_id}.dat')
+        # 旧版本的 JSON 检查点，不再读取，完成后一并删除
+        self.legacy_checkpoint_file = os.path.join(cache_dir, f'crawl_checkpoint_{config_id}.json')
+        self.root_name = unquote(config['rootpath']).rstrip('/') + '/'
+        self.signature = {
+            'rootpath': config['rootpath'],
+            'target_directory': config['target_directory'],
+            'listing_backend': config.get('listing_backend', 'webdav')
+        }
+        if sync_paths:
+            self.signature['sync_paths'] = list(sync_paths)
+        self.logger = logger
+        self.interval = interval
+        self.last_saved = time.monotonic()
+
+    def load(self):
+        """
+        读取检查点，不存在、已过期或与当前配置不匹配时返回 None。
+        """
+        if not os.path.exists(self.checkpoint_file):
+            return None
+        try:
+            state = tree_codec.read_file(self.checkpoint_file)
+        except Exception as e:
+            self.logger.error(f"读取遍历检查点出错，将重新遍历: {e}")
+            return None
+
+        if state.get('signature') != self.signature:
+            self.logger.info("遍历检查点与当前配置不匹配，忽略检查点。")
+            return None
+        if time.time() - state.get('saved_at', 0) > CHECKPOINT_MAX_AGE:
+            self.logger.info("遍历检查点已过期，忽略检查点。")
+            return None
+        state['tree'] = tree_codec.decode_tree(state['tree'], self.root_name)
+        return state
+
+    def due(self):
+        return time.monotonic() - self.last_saved >= self.interval
+
+    def save(self, tree, pending, visited, pending_tasks, counters):
+        """
+        保存遍历进度。pending 为 (远程目录路径, 目录节点名) 列表，根目录的节点名为 None；
+        pending_tasks 为 {'strm': [...], 'download': [...]}，记录已入队但尚未完成的流水线任务。
+        先写临时文件再重命名，避免写入中途崩溃导致检查点损坏。
+        """
+        start = time.monotonic()
+        state = {
+            'signature': self.signature,
+            'saved_at': time.time(),
+            'tree': tree_codec.encode_tree(tree, self.root_name),
+            'pending': [list(item) for item in pending],
+            'visited': list(visited),
+            'pending_tasks': {kind: [list(task) for task in tasks] for kind, tasks in pending_tasks.items()},
+            'counters': counters
+        }
+        try:
+            size = tree_codec.write_file(self.checkpoint_file, state)
+            self.logger.info(f"遍历检查点已保存: 待遍历目录 {len(pending)} 个，未完成任务 {sum(len(tasks) for tasks in pending_tasks.values())} 个，"
+                             f"大小 {size / 1024:.1f} KB，耗时 {time.monotonic() - start:.2f} 秒")
+        except Exception as e:
+            self.logger.error(f"保存遍历检查点出错: {e}")
+        self.last_saved = time.monotonic()
+
+    def clear(self):
+        for checkpoint_file in (self.checkpoint_file, self.legacy_checkpoint_file):
+            if os.path.exists(checkpoint_file):
+                try:
+                    os.remove(checkpoint_file)
+                    self.logger.info("遍历已完成，检查点已删除。")
+                except OSError as e:
+                    self.logger.error(f"删除遍历检查点出错: {e}")
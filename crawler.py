@@ -0,0 +1,150 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import unquote
+
+from remote_tree import RemoteDirectory, RemoteFile, index_directories, directory_unchanged
+
+
+class RemoteCrawler:
+    """
+    迭代遍历远程目录树的生成器。维护待遍历目录栈（frontier），使用有界线程池同时列出最多
+    concurrency 个目录，每列完一个目录就产出 (目录路径, 条目列表)，供下游流水线边遍历边处理。
+    遍历过程中同时组装紧凑的嵌套目录树（self.tree，目录为 RemoteDirectory 节点）。
+    传入 cached_tree 时启用子树剪枝：父目录列表中修改时间和大小都未变化的子目录直接复用缓存的子树，不再列出。
+    传入 start_directories（已编码的远程目录列表）时只遍历这些子目录，self.tree 为各子目录节点组成的列表，
+    用于部分同步。传入 tree_index（RemoteTreeIndex）时，每列完一个目录就把结果写入索引。
+    previous_listing 返回某个目录在缓存中的子条目，供下游只处理变化的条目。
+    传入 max_listing_age（秒）时，最近一次列出早于该时间的缓存目录即使未变化也重新列出。
+    """
+
+    def __init__(self, backend, root_directory, concurrency, logger, state=None, cached_tree=None, start_directories=None,
+                 tree_index=None, run_id=None, max_listing_age=None):
+        self.backend = backend
+        self.root_name = unquote(root_directory).rstrip('/') + '/'
+        self.tree_index = tree_index
+        self.run_id = run_id
+        self.concurrency = max(1, concurrency)
+        self.logger = logger
+        self.in_flight = {}
+        self.cached_tree = cached_tree
+        self.cached_directories = index_directories(cached_tree) if cached_tree else {}
+        self.resumed = bool(state)
+        self.root_failed = False
+        self.pruned_directories = 0  # 复用缓存、未重新列出的子目录数量
+        self.stale_before = time.time() - max_listing_age if max_listing_age else None
+
+        if state:
+            # 从检查点恢复：已完成的目录树、待遍历目录、已访问目录
+            self.tree = state['tree']
+            self.frontier = [tuple(item) for item in state['pending']]
+            self.visited = set(state['visited'])
+        elif start_directories:
+            self.tree = [RemoteDirectory(unquote(directory)) for directory in start_directories]
+            # 逆序压栈，使子目录按给定顺序出栈
+            self.frontier = [(directory, node['name']) for directory, node in reversed(list(zip(start_directories, self.tree)))]
+            self.visited = set(start_directories)
+        else:
+            self.tree = []
+            self.frontier = [(root_directory, None)]
+            self.visited = {root_directory}
+
+        # 目录节点名 -> 目录节点，用于在子目录遍历完成后填充其 children
+        self.directory_nodes = index_directories(self.tree)
+
+    def pending(self):
+        """
+        尚未完成的目录（待遍历 + 正在遍历），用于写入检查点。
+        """
+        return self.frontier + list(self.in_flight.values())
+
+    def previous_listing(self, directory):
+        """
+        目录 directory（已编码）在缓存目录树中的子条目列表；没有缓存、该目录此前未成功列出，
+        或本次从检查点续跑时返回 None（续跑前的中断可能已把部分目录的新列表写入缓存，不能据此判断变化）。
+        """
+        if not self.cached_tree or self.resumed:
+            return None
+        name = unquote(directory).rstrip('/') + '/'
+        if name == self.root_name:
+            return self.cached_tree
+        node = self.cached_directories.get(name)
+        return node.get('children') if node else None
+
+    def _list(self, directory):
+        try:
+            self.logger.info(f"尝试遍历目录: {unquote(directory)}")
+            return self.backend.list_directory(directory)
+        except Exception as e:
+            self.logger.info(f"Error listing files: {e}")
+            return None
+
+    def iter_listings(self):
+        self.logger.info(f"开始遍历目录，并发数: {self.concurrency}")
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while self.frontier or self.in_flight:
+                # 按深度优先顺序提交目录，同时在途的目录数不超过并发数
+                while self.frontier and len(self.in_flight) < self.concurrency:
+                    directory, node_name = self.frontier.pop()
+                    self.in_flight[executor.submit(self._list, directory)] = (directory, node_name)
+
+                done, _ = wait(self.in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    directory, node_name = self.in_flight.pop(future)
+                    entries = future.result()
+                    if entries is None:
+                        # 列出失败的目录记为 children=None，下次运行不会被当作未变化而复用
+                        if node_name is not None:
+                            self.directory_nodes[node_name]['children'] = None
+                            if self.tree_index:
+                                self.tree_index.mark_unlisted(node_name)
+                        else:
+                            self.root_failed = True
+                        continue
+                    self._attach(node_name, entries)
+                    if self.tree_index:
+                        self.tree_index.record_listing(node_name or self.root_name, entries, self.run_id)
+                    yield directory, entries
+
+        if self.cached_directories:
+            self.logger.info(f"共有 {self.pruned_directories} 个未变化的子目录直接复用了缓存，未重新列出")
+
+    def _stale(self, cached_node):
+        if self.stale_before is None:
+            return False
+        return cached_node.listed_at is None or cached_node.listed_at < self.stale_before
+
+    def _attach(self, node_name, entries):
+        directories = []
+        files = []
+        subdirectories = []
+        for entry in entries:
+            if entry.is_directory:
+                file_info = RemoteDirectory(unquote(entry.name), entry.size, entry.mtime)
+                directories.append(file_info)
+                subdirectories.append((file_info, entry.name))
+            else:
+                files.append((unquote(entry.name), entry.size, entry.mtime))
+
+        if node_name is None:
+            self.tree = directories + [RemoteFile(name, size, modified) for name, size, modified in files]
+        else:
+            self.directory_nodes[node_name].set_entries(directories, files)
+
+        # 逆序压栈，使子目录按列表顺序出栈
+        for file_info, sub_directory in reversed(subdirectories):
+            # 检查是否已经访问过该目录，避免循环遍历
+            if sub_directory in self.visited:
+                continue
+            self.visited.add(sub_directory)
+
+            # 目录未变化时复用缓存的子树，跳过整个子树的遍历
+            cached_node = self.cached_directories.get(file_info['name'])
+            if directory_unchanged(cached_node, file_info) and not self._stale(cached_node):
+                file_info.copy_entries(cached_node)
+                file_info.digest = cached_node.get('digest')
+                self.pruned_directories += 1
+                self.logger.debug(f"目录未变化，复用缓存: {file_info['name']}")
+                continue
+
+            self.directory_nodes[file_info['name']] = file_info
+            self.frontier.append((sub_directory, file_info['name']))
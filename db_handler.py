@@ -1,9 +1,24 @@
+import json
 import os
 import sqlite3
 from urllib.parse import urlparse
 import  uuid
 from urllib.parse import urlparse
 
+def load_output_profiles(value):
+    """
+    解析配置中保存的其他输出（JSON 列表），每项至少包含 target_directory；格式无效时视为没有其他输出。
+    """
+    if not value:
+        return []
+    try:
+        profiles = json.loads(value)
+    except ValueError:
+        return []
+    if not isinstance(profiles, list):
+        return []
+    return [profile for profile in profiles if isinstance(profile, dict) and profile.get('target_directory')]
+
 class DBHandler:
     def __init__(self, db_file=None):
         # 如果 db_file 为空，则从环境变量中读取或使用默认值
@@ -43,7 +58,15 @@ class DBHandler:
                                 target_directory TEXT,
                                 download_enabled INTEGER DEFAULT 1,
                                 download_interval_range TEXT,
-                                strm_suffix TEXT DEFAULT '-转码'
+                                strm_suffix TEXT DEFAULT '-转码',
+                                crawl_concurrency INTEGER DEFAULT 1,
+                                request_rate REAL DEFAULT 2,
+                                request_burst INTEGER DEFAULT 5,
+                                listing_backend TEXT DEFAULT 'webdav',
+                                freshness_hours REAL DEFAULT 24,
+                                prune_max_percent REAL DEFAULT 10,
+                                prune_sidecars INTEGER DEFAULT 0,
+                                output_profiles TEXT  -- 其他输出，JSON 列表：[{"target_directory", "strm_suffix", "url_template"}]
                                 )''')
 
         # 初始化 user_config 表，用于存储脚本的全局配置
@@ -54,6 +77,14 @@ class DBHandler:
                                 metadata_formats TEXT,
                                 size_threshold INTEGER DEFAULT 100)''')
 
+        # 初始化 sync_queue 表，持久化保存外部通知的待同步子目录（path 为相对于配置根路径的路径，空字符串表示根目录）
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS sync_queue (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                config_id INTEGER,
+                                path TEXT,
+                                first_queued REAL,  -- 首次收到通知的时间
+                                last_queued REAL,  -- 最近一次收到通知的时间
+                                UNIQUE(config_id, path))''')
 
 
         self.conn.commit()
@@ -66,6 +97,14 @@ class DBHandler:
         self.add_column_if_not_exists('config', 'update_mode', 'TEXT')
         self.add_column_if_not_exists('config', 'download_interval_range', 'TEXT', default_value='1-3')
         self.add_column_if_not_exists('config', 'strm_suffix', 'TEXT', default_value='-转码')
+        self.add_column_if_not_exists('config', 'crawl_concurrency', 'INTEGER', default_value=1)
+        self.add_column_if_not_exists('config', 'request_rate', 'REAL', default_value=2)
+        self.add_column_if_not_exists('config', 'request_burst', 'INTEGER', default_value=5)
+        self.add_column_if_not_exists('config', 'listing_backend', 'TEXT', default_value='webdav')
+        self.add_column_if_not_exists('config', 'freshness_hours', 'REAL', default_value=24)
+        self.add_column_if_not_exists('config', 'prune_max_percent', 'REAL', default_value=10)
+        self.add_column_if_not_exists('config', 'prune_sidecars', 'INTEGER', default_value=0)
+        self.add_column_if_not_exists('config', 'output_profiles', 'TEXT')
         self.add_column_if_not_exists('user_config', 'size_threshold', 'INTEGER', default_value=100)
         self.add_column_if_not_exists('user_config', 'username', 'TEXT')
         self.add_column_if_not_exists('user_config', 'password', 'TEXT')
@@ -159,7 +198,7 @@ class DBHandler:
 
     def get_webdav_config(self, config_id):
         self.cursor.execute('''
-            SELECT config_name, url, username, password, rootpath, target_directory, download_enabled, update_mode,  download_interval_range, strm_suffix
+            SELECT config_name, url, username, password, rootpath, target_directory, download_enabled, update_mode,  download_interval_range, strm_suffix, crawl_concurrency, request_rate, request_burst, listing_backend, freshness_hours, prune_max_percent, prune_sidecars, output_profiles
             FROM config
             WHERE config_id=? LIMIT 1
         ''', (config_id,))
@@ -167,7 +206,7 @@ class DBHandler:
         result = self.cursor.fetchone()
 
         if result:
-            config_name, url, username, password, rootpath, target_directory, download_enabled, update_mode, download_interval_range, strm_suffix = result
+            config_name, url, username, password, rootpath, target_directory, download_enabled, update_mode, download_interval_range, strm_suffix, crawl_concurrency, request_rate, request_burst, listing_backend, freshness_hours, prune_max_percent, prune_sidecars, output_profiles = result
             parsed_url = urlparse(url)
 
             protocol = parsed_url.scheme
@@ -197,7 +236,15 @@ class DBHandler:
                 'download_enabled': download_enabled,
                 'update_mode': update_mode,
                 'download_interval_range': (min_interval, max_interval),  # 返回最小和最大间隔
-                'strm_suffix': strm_suffix or '-转码'  # 默认后缀
+                'strm_suffix': strm_suffix or '-转码',  # 默认后缀
+                'crawl_concurrency': max(1, int(crawl_concurrency or 1)),  # 目录遍历并发数，1 表示串行
+                'request_rate': float(request_rate) if request_rate is not None else 2.0,  # 每秒请求数，0 表示不限速
+                'request_burst': max(1, int(request_burst or 5)),  # 允许的突发请求数
+                'listing_backend': listing_backend or 'webdav',  # 目录列表后端：webdav、webdav_bulk 或 alist_api
+                'freshness_hours': float(freshness_hours) if freshness_hours else 24.0,  # 目录列表的新鲜度窗口（小时）
+                'prune_max_percent': float(prune_max_percent) if prune_max_percent is not None else 10.0,  # 单次最多删除的 .strm 百分比，0 表示不自动删除
+                'prune_sidecars': int(prune_sidecars or 0),  # 删除 .strm 时是否同时删除同名的字幕、图片、元数据文件
+                'output_profiles': load_output_profiles(output_profiles)  # 共用同一次遍历的其他输出
             }
         else:
             return None
@@ -266,6 +313,60 @@ class DBHandler:
 
 
 
+    def enqueue_sync_path(self, config_id, path, now):
+        """
+        把待同步的子目录加入 sync_queue，并与队列中已有的路径合并：
+        已有相同路径或其父目录时只更新通知时间；新路径是已有路径的父目录时，用新路径替换这些子路径。
+        返回最终排队的路径。
+        """
+        self.cursor.execute('SELECT path, first_queued FROM sync_queue WHERE config_id = ?', (config_id,))
+        rows = self.cursor.fetchall()
+
+        for queued_path, _ in rows:
+            if queued_path == path or queued_path == '' or path.startswith(queued_path + '/'):
+                self.cursor.execute('UPDATE sync_queue SET last_queued = ? WHERE config_id = ? AND path = ?',
+                                    (now, config_id, queued_path))
+                self.conn.commit()
+                return queued_path
+
+        first_queued = now
+        for queued_path, queued_at in rows:
+            if path == '' or queued_path.startswith(path + '/'):
+                first_queued = min(first_queued, queued_at)
+                self.cursor.execute('DELETE FROM sync_queue WHERE config_id = ? AND path = ?', (config_id, queued_path))
+        self.cursor.execute('INSERT INTO sync_queue (config_id, path, first_queued, last_queued) VALUES (?, ?, ?, ?)',
+                            (config_id, path, first_queued, now))
+        self.conn.commit()
+        return path
+
+    def get_sync_queue(self):
+        """
+        按配置分组返回 sync_queue：{config_id: [(path, first_queued, last_queued), ...]}
+        """
+        self.cursor.execute('SELECT config_id, path, first_queued, last_queued FROM sync_queue ORDER BY config_id, path')
+        queue = {}
+        for config_id, path, first_queued, last_queued in self.cursor.fetchall():
+            queue.setdefault(config_id, []).append((path, first_queued, last_queued))
+        return queue
+
+    def remove_sync_paths(self, config_id, entries):
+        """
+        从 sync_queue 删除已同步完成的路径。entries 为 get_sync_queue 返回的条目，
+        读取之后又收到新通知的路径（last_queued 更新过）保留在队列中，留待下一次同步。
+        """
+        self.cursor.executemany('DELETE FROM sync_queue WHERE config_id = ? AND path = ? AND last_queued <= ?',
+                                [(config_id, path, last_queued) for path, _, last_queued in entries])
+        self.conn.commit()
+
+    def requeue_sync_paths(self, config_id, entries, now):
+        """
+        同步失败后保留队列中的路径并重新开始计时，等待 debounce 秒后重试。
+        """
+        self.cursor.executemany('''UPDATE sync_queue SET first_queued = ?, last_queued = MAX(last_queued, ?)
+                                   WHERE config_id = ? AND path = ?''',
+                                [(now, now, config_id, path) for path, _, _ in entries])
+        self.conn.commit()
+
     def close(self):
         # 关闭数据库连接
         self.conn.close()
@@ -87,19 +87,19 @@ def debug_download_status(config_id):
         else:
             print(f"❌ 日志文件不存在: {log_file}")
         
-        # 检查缓存文件
-        cache_file = f"cache/webdav_directory_cache_{config_id}.json"
+        # 检查远程目录树索引
+        cache_file = f"cache/tree_index_{config_id}.db"
         if os.path.exists(cache_file):
-            print(f"\n📁 缓存文件存在: {cache_file}")
+            print(f"\n📁 远程目录树索引存在: {cache_file}")
             try:
-                import json
-                with open(cache_file, 'r', encoding='utf-8') as f:
-                    cache_data = json.load(f)
-                print(f"  缓存文件大小: {len(cache_data)} 个项目")
+                import sqlite3
+                with sqlite3.connect(cache_file) as conn:
+                    count = conn.execute('SELECT COUNT(*) FROM remote_tree').fetchone()[0]
+                print(f"  索引大小: {count} 个条目")
             except Exception as e:
-                print(f"❌ 读取缓存文件失败: {e}")
+                print(f"❌ 读取远程目录树索引失败: {e}")
         else:
-            print(f"❌ 缓存文件不存在: {cache_file}")
+            print(f"❌ 远程目录树索引不存在: {cache_file}")
         
     except Exception as e:
         print(f"❌ 调试失败: {e}")
@@ -33,7 +33,15 @@ def init_database():
         download_enabled INTEGER DEFAULT 1,
         update_mode TEXT DEFAULT 'incremental',
         download_interval_range TEXT DEFAULT '1-3',
-        strm_suffix TEXT DEFAULT '-转码'
+        strm_suffix TEXT DEFAULT '-转码',
+        crawl_concurrency INTEGER DEFAULT 1,
+        request_rate REAL DEFAULT 2,
+        request_burst INTEGER DEFAULT 5,
+        listing_backend TEXT DEFAULT 'webdav',
+        freshness_hours REAL DEFAULT 24,
+        prune_max_percent REAL DEFAULT 10,
+        prune_sidecars INTEGER DEFAULT 0,
+        output_profiles TEXT
     )''')
 
     # Create user_config table
@@ -0,0 +1,207 @@
+import threading
+from collections import namedtuple
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote, unquote
+
+import requests
+
+# AList 的 WebDAV 挂载前缀，配置中的 rootpath 均以此开头
+DAV_PREFIX = '/dav'
+
+# 与 AList(Go) 生成的 WebDAV href 保持一致的路径转义规则
+PATH_SAFE_CHARS = "/$&+,:;=@"
+
+# 列表后端返回的统一条目：
+# name 为 WebDAV 形式的完整路径（URL 编码，目录以 '/' 结尾），size 为字节数，
+# mtime 为 Unix 时间戳（整数秒），is_directory 表示是否为目录
+RemoteEntry = namedtuple('RemoteEntry', ['name', 'size', 'mtime', 'is_directory'])
+
+
+def parse_http_date(value):
+    """
+    解析 WebDAV getlastmodified 中的 RFC 1123 时间，返回整数时间戳，无法解析时返回 0。
+    """
+    if not value:
+        return 0
+    try:
+        return int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError, IndexError):
+        return 0
+
+
+def parse_iso_time(value):
+    """
+    解析 AList API 返回的 ISO 8601 时间（如 2024-01-01T12:00:00.123+08:00），返回整数时间戳。
+    """
+    if not value:
+        return 0
+    value = value.replace('Z', '+00:00')
+    # Python 3.9 的 fromisoformat 只接受 3 或 6 位小数，统一截掉小数部分
+    if '.' in value:
+        head, _, tail = value.partition('.')
+        offset = ''
+        for sign in ('+', '-'):
+            if sign in tail:
+                offset = sign + tail.split(sign, 1)[1]
+                break
+        value = head + offset
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        return 0
+
+
+def normalize_directory(path):
+    """
+    目录路径的规范形式（解码、去掉末尾 '/'），用于比较同一目录的不同写法。
+    """
+    return unquote(path).rstrip('/')
+
+
+class ListingBackend:
+    """
+    远程目录列表后端接口。list_directory 返回目录下的直接子条目（不含目录自身），
+    实现必须是线程安全的，以便并发遍历时在多个工作线程间共享。
+    """
+
+    name = 'base'
+
+    def list_directory(self, directory):
+        raise NotImplementedError
+
+
+class WebDAVListingBackend(ListingBackend):
+    """
+    通过 PROPFIND（Depth: 1）逐个目录列出，client 为 webdav_client.WebDAVClient，
+    其连接池在各工作线程间共享。
+    """
+
+    name = 'webdav'
+
+    def __init__(self, client, rate_limiter):
+        self.client = client
+        self.rate_limiter = rate_limiter
+
+    def list_directory(self, directory):
+        self.rate_limiter.acquire()  # 每次 PROPFIND 请求都需要获取令牌
+        current = normalize_directory(directory)
+        # PROPFIND 的结果包含目录自身，跳过以免重复遍历
+        return [entry for entry in self.client.propfind(directory) if normalize_directory(entry.name) != current]
+
+
+class AListAPIListingBackend(ListingBackend):
+    """
+    通过 AList 原生接口 /api/fs/list 分页列出目录，返回 JSON，比 WebDAV PROPFIND 更轻量。
+    """
+
+    name = 'alist_api'
+
+    def __init__(self, url, token, rate_limiter, per_page=1000):
+        self.list_url = f"{url}/api/fs/list"
+        self.headers = {"Authorization": token}
+        self.rate_limiter = rate_limiter
+        self.per_page = per_page
+        self.thread_state = threading.local()
+
+    def _session(self):
+        session = getattr(self.thread_state, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self.thread_state.session = session
+        return session
+
+    @staticmethod
+    def to_api_path(directory):
+        # WebDAV 路径 /dav/电影/ -> API 路径 /电影
+        path = unquote(directory)
+        if path.startswith(DAV_PREFIX + '/') or path == DAV_PREFIX:
+            path = path[len(DAV_PREFIX):]
+        return '/' + path.strip('/')
+
+    def list_directory(self, directory):
+        api_path = self.to_api_path(directory)
+        base = api_path.rstrip('/')
+        entries = []
+        page = 1
+        while True:
+            self.rate_limiter.acquire()  # 每一页都是一次独立的请求
+            payload = {
+                "path": api_path,
+                "page": page,
+                "per_page": self.per_page,
+                "refresh": False
+            }
+            response = self._session().post(self.list_url, headers=self.headers, json=payload, timeout=60)
+            response.raise_for_status()
+            result = response.json()
+            if result.get('code') != 200:
+                raise RuntimeError(f"/api/fs/list 返回错误: {result.get('code')}, {result.get('message')}")
+
+            data = result.get('data') or {}
+            content = data.get('content') or []
+            for item in content:
+                is_directory = bool(item.get('is_dir'))
+                name = DAV_PREFIX + quote(f"{base}/{item['name']}", safe=PATH_SAFE_CHARS)
+                if is_directory:
+                    name += '/'
+                entries.append(RemoteEntry(name, int(item.get('size') or 0), parse_iso_time(item.get('modified')), is_directory))
+
+            total = data.get('total') or 0
+            if not content or len(entries) >= total or self.per_page <= 0:
+                break
+            page += 1
+        return entries
+
+
+class WebDAVBulkListingBackend(WebDAVListingBackend):
+    """
+    批量列表模式：对根路径发送一次 Depth: infinity 的 PROPFIND，流式解析整个目录树，
+    之后各目录的列表请求直接从预取结果中返回，不再逐个目录发起请求。
+    服务器拒绝 Depth: infinity 或请求失败时自动回退到逐目录 PROPFIND。
+    有的服务器不报错，只按 Depth: 1 返回，子目录的内容不在结果中；因此只有结果中确实出现了子条目的目录才从预取结果返回，
+    其它目录（包括空目录）仍逐个列出，不会被当作空目录。
+    """
+
+    name = 'webdav_bulk'
+
+    def __init__(self, client, rate_limiter, root_directory, logger):
+        super().__init__(client, rate_limiter)
+        self.root_directory = root_directory
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.prefetched = None  # 规范化目录路径 -> 子条目列表，只包含结果中出现了子条目的目录
+        self.bulk_failed = False
+
+    def _prefetch(self):
+        root = quote(normalize_directory(self.root_directory) + '/', safe=PATH_SAFE_CHARS)
+        self.logger.info(f"使用 Depth: infinity 批量获取目录树: {unquote(root)}")
+        self.rate_limiter.acquire()
+        prefetched = {}
+        count = 0
+        try:
+            for entry in self.client.propfind(root, depth='infinity'):
+                path = normalize_directory(entry.name)
+                # 根目录自身的 response 不属于任何已请求的目录
+                if path != normalize_directory(root):
+                    prefetched.setdefault(path.rsplit('/', 1)[0], []).append(entry)
+                count += 1
+        except Exception as e:
+            # 服务器拒绝（如 403 propfind-finite-depth）、网络错误或响应不完整，一律回退
+            self.logger.warning(f"批量 PROPFIND 不可用，回退到逐目录列表: {e}")
+            return None
+
+        self.logger.info(f"批量获取完成，共 {count} 个条目，{len(prefetched)} 个目录的子条目在结果中")
+        return prefetched
+
+    def list_directory(self, directory):
+        with self.lock:
+            if self.prefetched is None and not self.bulk_failed:
+                self.prefetched = self._prefetch()
+                self.bulk_failed = self.prefetched is None
+            entries = self.prefetched.pop(normalize_directory(directory), None) if self.prefetched else None
+
+        if entries is not None:
+            return entries
+        # 不在批量结果中的目录（或批量模式不可用）逐个列出
+        return super().list_directory(directory)
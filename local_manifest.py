@@ -0,0 +1,293 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from itertools import groupby
+
+from path_index import ROOT, PathIndex
+
+# 路径前缀范围查询的上界
+MAX_CHAR = '\U0010ffff'
+# 修改时间距扫描时刻不足该秒数的目录，扫描期间可能仍有写入（部分文件系统的时间精度只有 1 秒），下次运行时重新扫描
+RECENT_DIRECTORY_SECONDS = 2
+
+
+def content_hash(data):
+    """
+    文件内容的摘要，data 为 bytes 或 str。
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def output_manifest_key(config_id, index):
+    """
+    配置第 index 个输出（0 为配置本身，见 main.output_profiles）的本地文件清单名称。
+    """
+    return config_id if index == 0 else f'{config_id}_{index}'
+
+
+class LocalManifest:
+    """
+    本地目标目录的持久化清单，保存在 cache/local_manifest_<config_id>.db（SQLite）中，
+    取代每次运行对整个 target_directory 的 os.walk。
+    files 表每个本地文件一行：directory 为相对于 target_directory 的目录（根目录为 '.'），
+    content_hash 为本工具写入该文件时记录的内容摘要（外部写入或内容未知时为空）。
+    directories 表记录每个目录上次扫描时的修改时间：刷新时只对每个已知目录做一次 stat，
+    修改时间变化（目录中有条目被增删或改名）的目录才用 os.scandir 重新列出，新出现的子目录整体扫描。
+    运行过程中写入或删除的文件由 record_file、forget_file 记入清单，get_file 查询已记录的内容摘要，
+    这三个方法可在多个线程中调用，save 时统一写入数据库。
+    """
+
+    def __init__(self, config_id, local_root, logger):
+        cache_dir = 'cache'
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.db_file = os.path.join(cache_dir, f'local_manifest_{config_id}.db')
+        self.local_root = local_root
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.pending = {}
+        # 写入阶段的线程也会通过 get_file 查询，查询时持有 self.lock
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.initialize_tables()
+
+    def initialize_tables(self):
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                                directory TEXT,
+                                name TEXT,
+                                size INTEGER,
+                                mtime_ns INTEGER,
+                                content_hash TEXT,
+                                PRIMARY KEY (directory, name))''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS directories (
+                                path TEXT PRIMARY KEY,
+                                mtime_ns INTEGER)''')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        # 因超过单次删除上限而推迟清理的云端已删除条目（远程路径）
+        self.conn.execute('CREATE TABLE IF NOT EXISTS deferred_prune (path TEXT PRIMARY KEY, is_dir INTEGER)')
+
+        # 目标目录变化后旧清单不再适用，整体清空
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'local_root'").fetchone()
+        if row is not None and row[0] != self.local_root:
+            self.logger.info("配置的目标目录已变化，清空本地文件清单。")
+            self.conn.execute('DELETE FROM files')
+            self.conn.execute('DELETE FROM directories')
+            self.conn.execute('DELETE FROM deferred_prune')
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('local_root', ?)", (self.local_root,))
+        self.conn.commit()
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+        self.conn.commit()
+
+    def deferred_prune(self):
+        return self.conn.execute('SELECT path, is_dir FROM deferred_prune').fetchall()
+
+    def defer_prune(self, entries):
+        """
+        用 entries（(远程路径, 是否目录)）替换推迟清理的条目，传入空列表即清空。
+        """
+        self.conn.execute('DELETE FROM deferred_prune')
+        self.conn.executemany('INSERT INTO deferred_prune (path, is_dir) VALUES (?, ?)',
+                              [(path, int(is_dir)) for path, is_dir in entries])
+        self.conn.commit()
+
+    def relative_path(self, local_path):
+        return os.path.relpath(local_path, self.local_root)
+
+    def refresh(self):
+        """
+        使清单与文件系统一致，返回 (检查的目录数, 重新扫描的目录数)。
+        """
+        if not os.path.isdir(self.local_root):
+            self.conn.execute('DELETE FROM files')
+            self.conn.execute('DELETE FROM directories')
+            self.conn.commit()
+            return 0, 0
+
+        known = dict(self.conn.execute('SELECT path, mtime_ns FROM directories'))
+        if ROOT not in known:
+            known = {}
+        checked = 0
+        to_scan = [ROOT] if not known else []
+        removed = []
+        for directory, mtime_ns in known.items():
+            checked += 1
+            try:
+                stat = os.stat(os.path.join(self.local_root, directory))
+            except OSError:
+                removed.append(directory)
+                continue
+            if stat.st_mtime_ns != mtime_ns:
+                to_scan.append(directory)
+
+        for directory in removed:
+            self.remove_directory(directory)
+
+        scanned = 0
+        while to_scan:
+            directory = to_scan.pop()
+            scanned += 1
+            for subdirectory in self.scan_directory(directory):
+                if subdirectory not in known:
+                    to_scan.append(subdirectory)
+        self.conn.commit()
+        return checked, scanned
+
+    def scan_directory(self, directory):
+        """
+        用 os.scandir 重新列出一个目录，更新其中的文件行；返回其中的子目录（相对路径）。
+        大小和修改时间未变化的文件保留已记录的内容摘要。
+        """
+        full_path = os.path.join(self.local_root, directory)
+        try:
+            directory_stat = os.stat(full_path)
+            entries = list(os.scandir(full_path))
+        except OSError as e:
+            self.logger.error(f"扫描本地目录时出错: {full_path}，错误: {e}")
+            self.remove_directory(directory)
+            return []
+
+        stored = {
+            name: (size, mtime_ns, digest)
+            for name, size, mtime_ns, digest in self.conn.execute(
+                'SELECT name, size, mtime_ns, content_hash FROM files WHERE directory = ?', (directory,))
+        }
+        subdirectories = []
+        rows = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(os.path.normpath(os.path.join(directory, entry.name)))
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            previous = stored.pop(entry.name, None)
+            if previous is not None and previous[:2] == (stat.st_size, stat.st_mtime_ns):
+                continue
+            rows.append((directory, entry.name, stat.st_size, stat.st_mtime_ns, None))
+        self.conn.executemany('INSERT OR REPLACE INTO files (directory, name, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?, ?)',
+                              rows)
+        self.conn.executemany('DELETE FROM files WHERE directory = ? AND name = ?', [(directory, name) for name in stored])
+
+        # 刚修改过的目录可能在扫描期间仍有写入，不记录修改时间，下次运行时重新扫描
+        mtime_ns = directory_stat.st_mtime_ns
+        if time.time() - directory_stat.st_mtime < RECENT_DIRECTORY_SECONDS:
+            mtime_ns = None
+        self.conn.execute('INSERT OR REPLACE INTO directories (path, mtime_ns) VALUES (?, ?)', (directory, mtime_ns))
+        return subdirectories
+
+    def remove_directory(self, directory):
+        """
+        从清单中删除已不存在的目录及其所有子目录和文件。
+        """
+        lower = directory + os.sep
+        upper = lower + MAX_CHAR
+        self.conn.execute('DELETE FROM files WHERE directory = ? OR (directory > ? AND directory < ?)', (directory, lower, upper))
+        self.conn.execute('DELETE FROM directories WHERE path = ? OR (path > ? AND path < ?)', (directory, lower, upper))
+
+    def path_index(self, name_filter=None):
+        """
+        从清单逐行构建只读的 PathIndex，name_filter(文件名) 为 False 的文件不加入索引。
+        """
+        index = PathIndex()
+        for (directory,) in self.conn.execute('SELECT path FROM directories'):
+            index.find(directory, create=True)
+        rows = self.conn.execute('SELECT directory, name FROM files ORDER BY directory')
+        for directory, group in groupby(rows, key=lambda row: row[0]):
+            names = [name for _, name in group if name_filter is None or name_filter(name)]
+            if names:
+                index.add_directory(directory, names)
+        return index
+
+    def iter_files(self, suffix=None):
+        """
+        逐行返回清单中的本地文件 (完整路径, 大小)，suffix 不为空时只返回以其结尾（不区分大小写）的文件。
+        """
+        for directory, name, size in self.conn.execute('SELECT directory, name, size FROM files'):
+            if suffix is not None and not name.lower().endswith(suffix):
+                continue
+            if directory == ROOT:
+                yield os.path.join(self.local_root, name), size
+            else:
+                yield os.path.join(self.local_root, directory, name), size
+
+    def get_file(self, local_path):
+        """
+        返回清单中记录的 (大小, 修改时间(纳秒), 内容摘要)，未记录时返回 None。
+        """
+        directory, name = os.path.split(self.relative_path(local_path))
+        with self.lock:
+            if local_path in self.pending:
+                return self.pending[local_path]
+            return self.conn.execute('SELECT size, mtime_ns, content_hash FROM files WHERE directory = ? AND name = ?',
+                                     (directory or ROOT, name)).fetchone()
+
+    def record_file(self, local_path, digest=None):
+        """
+        记录本工具刚写入的文件及其内容摘要。
+        """
+        try:
+            stat = os.stat(local_path)
+        except OSError:
+            return
+        with self.lock:
+            self.pending[local_path] = (stat.st_size, stat.st_mtime_ns, digest)
+
+    def forget_file(self, local_path):
+        with self.lock:
+            self.pending[local_path] = None
+
+    def save(self):
+        """
+        把运行过程中记录的写入和删除保存到数据库。所在目录的修改时间不更新，下次运行时会重新扫描这些目录。
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        for local_path, record in pending.items():
+            directory, name = os.path.split(self.relative_path(local_path))
+            directory = directory or ROOT
+            if record is None:
+                self.conn.execute('DELETE FROM files WHERE directory = ? AND name = ?', (directory, name))
+            else:
+                self.conn.execute('INSERT OR REPLACE INTO files (directory, name, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?, ?)',
+                                  (directory, name) + record)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def open_manifest_for_directory(db_handler, local_root, logger):
+    """
+    打开目标目录为 local_root 的配置所使用的本地文件清单并刷新；没有对应的配置时使用按目录路径命名的单独清单。
+    """
+    normalized_root = os.path.normpath(os.path.abspath(local_root))
+    manifest_key = 'dir_' + hashlib.sha1(normalized_root.encode('utf-8')).hexdigest()[:12]
+    for config_id, _ in db_handler.get_all_configurations():
+        config = db_handler.get_webdav_config(config_id)
+        if not config:
+            continue
+        targets = [config['target_directory']] + [profile['target_directory'] for profile in config.get('output_profiles') or []]
+        for index, target_directory in enumerate(targets):
+            if os.path.normpath(os.path.abspath(target_directory)) == normalized_root:
+                manifest_key = output_manifest_key(config_id, index)
+                local_root = target_directory
+                break
+        else:
+            continue
+        break
+    manifest = LocalManifest(manifest_key, local_root, logger)
+    manifest.refresh()
+    return manifest
@@ -1,14 +1,28 @@
+import argparse
+import hashlib
 import random
+import shutil
 import sys
 import easywebdav
-import json
 import os
-from urllib.parse import unquote
+from urllib.parse import quote, unquote
 import requests
 import time
-from queue import Queue
+import threading
 from db_handler import DBHandler
 from logger import setup_logger
+from rate_limiter import RateLimiter
+from listing_backend import WebDAVListingBackend, WebDAVBulkListingBackend, AListAPIListingBackend, PATH_SAFE_CHARS, DAV_PREFIX
+from crawl_checkpoint import CrawlCheckpoint
+from sync_plan import SyncPlan
+from crawler import RemoteCrawler
+from tree_index import RemoteTreeIndex
+from local_manifest import LocalManifest, content_hash, output_manifest_key
+from path_index import ROOT
+from remote_tree import index_directories, compute_digests, diff_trees, listing_changes
+from webdav_client import WebDAVClient
+from pipeline import StageQueue, start_stage
+from run_lock import RUN_LOCKED_EXIT_CODE, sync_run_lock
 
 # 初始化全局计数器
 strm_file_counter = 0  # 总的 strm 文件数量
@@ -17,8 +31,31 @@ download_file_counter = 0  # 已下载的文件数量
 total_download_file_counter = 0  # 总共需要下载的文件数量
 directory_strm_file_counter = {}  # 每个子目录下创建的 strm 文件数量
 existing_strm_file_counter = 0  # 已存在的 .strm 文件数量
-download_queue = Queue()  # 下载队列
+strm_queue = StageQueue()  # 写入阶段队列（目录创建和 .strm 生成）
+download_queue = StageQueue()  # 下载阶段队列
 found_video_files = set()
+counter_lock = threading.Lock()  # 并发遍历时保护上述计数器
+rate_limiter = RateLimiter(0)  # 请求限流器，由 process_with_cache 根据配置初始化
+local_manifests = {}  # 各输出目录的本地文件清单 {target_directory: LocalManifest}，由 process_with_cache 根据配置初始化
+extra_outputs = []  # 配置本身之外的其他输出 [(输出配置, 本地目录树)]，见 output_profiles
+rewritten_strm_file_counter = 0  # 内容已过期而重写的 .strm 文件数量
+# .strm 链接的生成方式变化时递增，使已有的 .strm 文件在下次运行时按新方式检查一遍
+STRM_LINK_FORMAT = 2
+# .strm 链接模板的默认值：{base} 为 协议://主机:端口，{path} 为去掉 /dav 前缀并编码后的远程路径
+DEFAULT_URL_TEMPLATE = '{base}/d{path}'
+# 写入阶段的线程数：NAS/NFS 上每次创建、写入、修改权限都是一次网络往返，多个线程并发写入不同目录
+STRM_WRITER_THREADS = 8
+ensured_directories = set()  # 本次运行中已确认存在的本地目录
+chmod_required = True  # 当前 umask 下新建的文件和目录是否需要再 chmod 才能得到 777 权限
+strm_write_started = None  # 写入阶段第一次和最后一次写入 .strm 的时间，用于统计写入速度
+strm_write_finished = None
+strm_write_count = 0  # 本次运行写入（新建或重写）的 .strm 文件数量
+sync_plan = None  # 干跑模式（--plan）下的变更计划，为 None 时正常执行
+# 清理云端已删除条目时，单次运行最多删除本地 .strm 文件总数的百分比（配置未指定时的默认值），删除数量不超过 PRUNE_MIN_FILES 时不限制
+PRUNE_MAX_PERCENT = 10
+PRUNE_MIN_FILES = 10
+# 与视频同名的附属图片常用的后缀（Kodi、Jellyfin、Emby 的命名方式）
+SIDECAR_SUFFIXES = ('-poster', '-fanart', '-thumb', '-landscape', '-banner', '-clearlogo', '-clearart', '-disc')
 
 
 
@@ -32,180 +69,622 @@ def connect_webdav(config):
         protocol=config['protocol']
     )
 
-def load_cached_tree(config_id, logger):
-    # 确保 cache 目录存在
-    cache_dir = 'cache'
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)  # 自动创建 cache 目录
+def create_listing_backend(config, logger, token=None):
+    """
+    根据配置选择目录列表后端：webdav（逐目录 PROPFIND）、webdav_bulk（Depth: infinity 批量 PROPFIND）
+    或 alist_api（/api/fs/list 分页接口）。
+    """
+    backend_name = config.get('listing_backend', 'webdav')
+    if backend_name == 'alist_api':
+        if token:
+            url = f"{config['protocol']}://{config['host']}:{config['port']}"
+            logger.info("使用 AList API 列表后端遍历目录")
+            return AListAPIListingBackend(url, token, rate_limiter)
+        logger.error("无法获取 JWT Token，AList API 列表后端不可用，回退到 WebDAV 列表后端。")
+
+    # WebDAV 列表使用专用的轻量客户端，连接池大小与遍历并发数一致
+    client = WebDAVClient(config, pool_size=config.get('crawl_concurrency', 1))
+    if backend_name == 'webdav_bulk':
+        logger.info("使用 WebDAV 批量列表模式遍历目录")
+        return WebDAVBulkListingBackend(client, rate_limiter, config['rootpath'], logger)
+    logger.info("使用 WebDAV 列表后端遍历目录")
+    return WebDAVListingBackend(client, rate_limiter)
+
+def normalize_sync_paths(rootpath, paths):
+    """
+    把部分同步的子路径（相对于 rootpath，或以 rootpath 开头的完整路径）转换为已编码的远程目录路径。
+    去掉重复路径和已被其它所选路径包含的子路径；包含根目录本身时返回 None，表示同步整个根目录。
+    """
+    root = unquote(rootpath).rstrip('/')
+    directories = []
+    for path in paths:
+        path = unquote(path.strip()).strip('/')
+        if not path:
+            continue
+        if root and ('/' + path + '/').startswith(root + '/'):
+            path = ('/' + path)[len(root):].strip('/')
+        if not path:
+            return None
+        if '..' in path.split('/'):
+            raise ValueError(f"子路径不能包含 '..': {path}")
+        directories.append(f"{root}/{path}/")
+
+    selected = []
+    for directory in sorted(set(directories)):
+        # 已选中的父目录会遍历整个子树，子路径无需单独同步
+        if not any(directory.startswith(parent) for parent in selected):
+            selected.append(directory)
+    return [quote(directory, safe=PATH_SAFE_CHARS) for directory in selected]
+
+def load_tree_index(config_id, config, logger):
+    """
+    打开配置的远程目录树索引（首次使用时导入旧版 JSON 缓存），同时加载上次的目录树，
+    用于增量更新时的剪枝和运行结束后的变化对比。返回 (tree_index, previous_tree)，索引为空时 previous_tree 为 None。
+    """
+    tree_index = RemoteTreeIndex(config_id, config['rootpath'], logger)
+    tree_index.import_legacy_cache()
+    if not tree_index.has_entries():
+        return tree_index, None
 
-    # 设置缓存文件路径
-    cache_file = os.path.join(cache_dir, f'webdav_directory_cache_{config_id}.json')
+    start = time.monotonic()
+    cached_tree = tree_index.load_tree()
+    logger.info(f"已从远程目录树索引加载缓存目录树，共 {tree_index.count_entries()} 个条目，耗时 {time.monotonic() - start:.2f} 秒")
+    return tree_index, cached_tree
 
-    # 加载缓存文件
-    if os.path.exists(cache_file):
-        try:
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.info(f"加载缓存文件出错: {e}")
-    return None
+def save_tree_digests(tree_index, tree, logger):
+    """
+    为遍历得到的目录树补算 Merkle 摘要（复用缓存子树上已有的摘要）并写入索引，返回根目录摘要。
+    """
+    root_digest, computed = compute_digests(tree)
+    tree_index.update_digests(computed)
+    logger.info(f"已计算 {len(computed)} 个目录的摘要")
+    return root_digest
 
-def save_tree_to_cache(file_tree, config_id, logger):
-    # 确保 cache 目录存在
-    cache_dir = 'cache'
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)  # 自动创建 cache 目录
+def diff_previous_tree(previous_tree, current_tree, sync_paths=None):
+    """
+    对比上次与本次的目录树，返回变化集（见 remote_tree.diff_trees）。
+    部分同步时 current_tree 为所选子目录节点列表，只对比这些子目录内部的变化。
+    """
+    if not sync_paths:
+        return diff_trees(previous_tree, current_tree)
+
+    previous_directories = index_directories(previous_tree) if previous_tree else {}
+    changes = []
+    for node in current_tree:
+        # 列出失败的子目录无法判断变化
+        if node['children'] is None:
+            continue
+        previous = previous_directories.get(node['name'])
+        changes.extend(diff_trees(previous['children'] if previous else None, node['children']))
+    return changes
+
+def local_path_for(remote_path, config):
+    """
+    远程路径（解码后）对应的本地路径，与写入阶段去掉根路径部分的方式一致。
+    """
+    return os.path.join(config['target_directory'], remote_path.replace(config['rootpath'], '').strip('/'))
 
-    # 设置缓存文件路径
-    cache_file = os.path.join(cache_dir, f'webdav_directory_cache_{config_id}.json')
+def output_profiles(config):
+    """
+    配置的所有输出：第一个是配置本身，其后是 output_profiles 中声明的其他输出（各自的目标目录、.strm 后缀和链接模板），
+    它们共用同一次遍历的结果。
+    """
+    profiles = [config]
+    for index, profile in enumerate(config.get('output_profiles') or [], start=1):
+        # 每个目标目录只能属于一个输出，重复的输出忽略
+        if any(os.path.normpath(profile['target_directory']) == os.path.normpath(existing['target_directory']) for existing in profiles):
+            continue
+        profiles.append(dict(config, target_directory=profile['target_directory'],
+                             strm_suffix=profile.get('strm_suffix', ''), url_template=profile.get('url_template'),
+                             output_profiles=[], output_index=index))
+    return profiles
+
+def output_path(local_path, config, profile):
+    """
+    配置本身目标目录下的路径在另一个输出中对应的路径。
+    """
+    return os.path.normpath(os.path.join(profile['target_directory'], os.path.relpath(local_path, config['target_directory'])))
 
-    # 保存缓存文件
-    try:
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump(file_tree, f, ensure_ascii=False, indent=4)
-        logger.info(f"目录树缓存文件 '{cache_file}' 保存成功。")
-    except Exception as e:
-        logger.info(f"保存目录树缓存文件出错: {e}")
+def manifest_for(config):
+    return local_manifests[config['target_directory']]
 
-# 比较两个目录树，如果相同返回 True，否则返回 False
-def compare_directory_trees(cached_tree, current_tree):
-    if len(cached_tree) != len(current_tree):
-        return False
-    for cached_file, current_file in zip(cached_tree, current_tree):
-        if cached_file['name'] != current_file['name'] or \
-           cached_file['size'] != current_file['size'] or \
-           cached_file['modified'] != current_file['modified']:
-            return False
-    return True
-
-def build_local_directory_tree(local_root, script_config, logger, config=None):
-    """
-    构建本地目录树，包括所有 .strm 文件和其他需要下载的元数据文件的信息。
-    """
-    local_tree = {}
-    for root, dirs, files in os.walk(local_root):
-        relative_root = os.path.relpath(root, local_root)
-        local_tree[relative_root] = set()
-        for file in files:
-            # 记录 .strm 文件和其他需要下载的文件（字幕、图片、元数据等）
-            file_extension = os.path.splitext(file)[1].lower().lstrip('.')
-            if file.lower().endswith('.strm') or \
-               file_extension in script_config['subtitle_formats'] or \
-               file_extension in script_config['image_formats'] or \
-               file_extension in script_config['metadata_formats']:
-                local_tree[relative_root].add(file)
-    logger.info("本地目录树已加载，包括 .strm 文件和需要下载的文件。")
-    return local_tree
+def alist_path(file_name):
+    """
+    远程路径在 AList 中的路径（已编码）：file_name 可以是已编码或解码后的 WebDAV 路径，
+    统一解码、只去掉开头的 /dav 前缀后按固定规则重新编码，路径中其它位置的 "/dav" 保持不变。
+    """
+    path = unquote(file_name)
+    if path.startswith(DAV_PREFIX + '/'):
+        path = path[len(DAV_PREFIX):]  # 去掉 /dav/ 前缀
+    return quote(path, safe=PATH_SAFE_CHARS)
 
+def strm_link(file_name, config):
+    """
+    视频文件的 .strm 内容（AList 直链）。路径按 alist_path 的规则编码，不同列表后端、不同运行得到的链接一致。
+    """
+    # 根据 protocol 参数生成相应的链接，http 或 https；输出配置可以指定自己的链接模板
+    template = config.get('url_template') or DEFAULT_URL_TEMPLATE
+    return template.format(base=f"{config['protocol']}://{config['host']}:{config['port']}", protocol=config['protocol'],
+                           host=config['host'], port=config['port'], path=alist_path(file_name))
 
-def list_files_recursive_with_cache(webdav, directory, config, script_config, size_threshold, download_enabled, logger, local_tree, min_interval, max_interval, visited=None):
-    global video_file_counter, strm_file_counter, directory_strm_file_counter, total_download_file_counter
-    decoded_directory = unquote(directory)
-    interval = random.randint(min_interval, max_interval)
+def strm_link_signature(config):
+    """
+    决定 .strm 内容的配置（协议、主机、端口、链接模板）和链接生成方式，变化时需要检查所有已有的 .strm 文件。
+    """
+    signature = f"{STRM_LINK_FORMAT}|{config['protocol']}://{config['host']}:{config['port']}"
+    if config.get('url_template'):
+        signature += f"|{config['url_template']}"
+    return signature
 
-    if visited is None:
-        visited = set()
+def strm_content_current(strm_file_path, http_link, config):
+    """
+    判断已存在的 .strm 文件内容是否就是 http_link：优先使用本地文件清单中记录的内容摘要，
+    没有记录时读取一次文件并把摘要记入清单，之后的运行不再读取未变化的文件。
+    """
+    expected = content_hash(http_link)
+    local_manifest = manifest_for(config)
+    record = local_manifest.get_file(strm_file_path)
+    if record is not None and record[2]:
+        return record[2] == expected
+    try:
+        with open(strm_file_path, 'r', encoding='utf-8') as strm_file:
+            current = content_hash(strm_file.read())
+    except (OSError, UnicodeDecodeError):
+        return False
+    local_manifest.record_file(strm_file_path, current)
+    return current == expected
+
+def rewrite_strm_file(strm_file_path, http_link, config, logger):
+    global rewritten_strm_file_counter
+    if sync_plan is not None:
+        sync_plan.add('strm_update', strm_file_path, len(http_link.encode('utf-8')))
+        with counter_lock:
+            rewritten_strm_file_counter += 1
+        return
+    begin_strm_write()
+    with open(strm_file_path, 'w', encoding='utf-8') as strm_file:
+        strm_file.write(http_link)
+    manifest_for(config).record_file(strm_file_path, content_hash(http_link))
+    with counter_lock:
+        rewritten_strm_file_counter += 1
+    end_strm_write()
+    logger.info(f".strm 文件内容已过期，已重写: {strm_file_path}")
+
+def begin_strm_write():
+    global strm_write_started
+    with counter_lock:
+        if strm_write_started is None:
+            strm_write_started = time.monotonic()
+
+def end_strm_write():
+    global strm_write_finished, strm_write_count
+    with counter_lock:
+        strm_write_finished = time.monotonic()
+        strm_write_count += 1
+
+def refresh_strm_links(tree_index, config, script_config, size_threshold, local_tree, logger):
+    """
+    链接相关的配置变化后，按远程目录树索引检查所有已存在的 .strm 文件，只重写内容与新链接不一致的文件。
+    增量更新时未变化的目录不会进入写入阶段，因此需要这一遍检查。返回重写的文件数。
+    """
+    global rewritten_strm_file_counter
+    start = time.monotonic()
+    before = rewritten_strm_file_counter
+    checked = 0
+    for remote_path, _ in tree_index.iter_files(size_threshold * 1024 * 1024):
+        file_extension = os.path.splitext(remote_path)[1].lower().lstrip('.')
+        if file_extension not in script_config['video_formats']:
+            continue
+        local_directory = os.path.dirname(local_path_for(remote_path, config))
+        strm_file_name = get_strm_file_name(remote_path, config)
+        if not local_tree.contains(os.path.relpath(local_directory, config['target_directory']), strm_file_name):
+            continue
+        checked += 1
+        strm_file_path = os.path.join(local_directory, strm_file_name)
+        http_link = strm_link(remote_path, config)
+        if not strm_content_current(strm_file_path, http_link, config):
+            try:
+                rewrite_strm_file(strm_file_path, http_link, config, logger)
+            except Exception as e:
+                logger.error(f"重写 .strm 文件时出错: {strm_file_path}，错误: {e}")
+    rewritten = rewritten_strm_file_counter - before
+    logger.info(f"链接配置已变化，检查了 {checked} 个已有的 .strm 文件，重写 {rewritten} 个，耗时 {time.monotonic() - start:.2f} 秒")
+    return rewritten
+
+def get_strm_file_name(file_name, config):
+    """
+    视频文件对应的 .strm 文件名（不含目录），file_name 可以是已编码或解码后的远程路径。
+    """
+    base_name = os.path.splitext(os.path.basename(unquote(file_name)))[0]
+    return base_name + config.get('strm_suffix', '-转码') + ".strm"
 
-    # 检查是否已经访问过该目录，避免循环递归
-    if directory in visited:
-        return []
+def sidecar_prefixes(base_name):
+    return (base_name + '.',) + tuple(base_name + suffix + '.' for suffix in SIDECAR_SUFFIXES)
 
-    visited.add(directory)
+def remaining_video_names(tree_index, directory, removed, video_formats):
+    """
+    远程目录中仍然存在的视频的文件名（不含扩展名），directory 为解码后以 '/' 结尾的远程目录路径。
+    干跑时索引未更新，本次删除的条目仍在索引中，需要排除。
+    """
+    if tree_index is None:
+        return []
+    return [os.path.splitext(os.path.basename(path))[0] for path in tree_index.list_files(directory)
+            if path not in removed and os.path.splitext(path)[1].lower().lstrip('.') in video_formats]
 
-    try:
-        logger.info(f"尝试遍历目录: {decoded_directory}")
-        files = webdav.ls(directory)  # 列出 WebDAV 中的文件
-        file_tree = []
+def orphan_sidecars(remote_path, local_directory, local_tree, config, download_formats, remaining_videos=()):
+    """
+    已删除视频在本地的附属文件：与视频同名（如 电影.nfo、电影.zh.srt）或带常见海报后缀（如 电影-poster.jpg）、
+    且属于需要下载的格式的文件。文件名来自本地目录树，不访问文件系统。
+    remaining_videos 为同一目录中仍存在的视频名（不含扩展名），属于这些视频的文件保留，
+    例如删除 Alien.mkv 时不删除 Alien.Resurrection.nfo。
+    """
+    base_name = os.path.splitext(os.path.basename(remote_path))[0]
+    node = local_tree.find(os.path.relpath(local_directory, config['target_directory']))
+    if node is None:
+        return []
+    prefixes = sidecar_prefixes(base_name)
+    kept_prefixes = tuple(prefix for name in remaining_videos if name != base_name and name.startswith(base_name)
+                          for prefix in sidecar_prefixes(name))
+    return [os.path.join(local_directory, name) for name in node.names
+            if name.startswith(prefixes) and not (kept_prefixes and name.startswith(kept_prefixes))
+            and os.path.splitext(name)[1].lower().lstrip('.') in download_formats]
+
+def remove_orphaned_files(changes, config, script_config, logger, local_tree, tree_index=None):
+    """
+    根据变化集清理云端已删除的条目：删除视频对应的 .strm 文件（开启 prune_sidecars 时连同同名的字幕、图片、元数据文件）
+    和已下载的字幕、图片、元数据文件，再删除因此变空的本地目录。
+    本次要删除的 .strm 文件超过本地 .strm 文件总数的 prune_max_percent% 时（不超过 PRUNE_MIN_FILES 个时不限制），
+    视为云端异常（如存储未挂载），本次不删除任何文件，这些条目记入本地文件清单，以后的运行中如果仍未在云端出现再删除。
+    """
+    download_formats = set(script_config['subtitle_formats']) | set(script_config['image_formats']) | set(script_config['metadata_formats'])
+    max_percent = config.get('prune_max_percent', PRUNE_MAX_PERCENT)
+    if max_percent <= 0:
+        if any(change[0] == 'removed' for change in changes):
+            logger.info("已关闭自动删除（prune_max_percent 为 0），保留云端已不存在的本地文件。")
+        return
 
-        # 处理本地目录路径，去掉 WebDAV 上的根目录部分
-        local_relative_path = decoded_directory.replace(config['rootpath'], '').lstrip('/')
-        local_directory = os.path.join(config['target_directory'], local_relative_path)
-        os.makedirs(local_directory, exist_ok=True)  # 确保本地目录存在
+    # 本次变化集中的删除，加上以前因超过上限而推迟、至今仍未在云端重新出现的删除
+    local_manifest = manifest_for(config)
+    removed = {path: is_directory for change, path, is_directory, _, _ in changes if change == 'removed'}
+    deferred = local_manifest.deferred_prune()
+    for path, is_directory in deferred:
+        if path not in removed and (tree_index is None or not tree_index.has_entry(path)):
+            removed[path] = is_directory
+
+    local_files = []
+    removed_directories = []
+    remaining_videos = {}
+    for path, is_directory in removed.items():
+        if is_directory:
+            removed_directories.append(local_path_for(path, config))
+            continue
+        local_directory = os.path.dirname(local_path_for(path, config))
+        file_extension = os.path.splitext(path)[1].lower().lstrip('.')
+        if file_extension in script_config['video_formats']:
+            local_files.append(os.path.join(local_directory, get_strm_file_name(path, config)))
+            if config.get('prune_sidecars'):
+                directory = os.path.dirname(path) + '/'
+                if directory not in remaining_videos:
+                    remaining_videos[directory] = remaining_video_names(tree_index, directory, removed,
+                                                                        script_config['video_formats'])
+                local_files.extend(orphan_sidecars(path, local_directory, local_tree, config, download_formats,
+                                                   remaining_videos[directory]))
+        elif file_extension in download_formats:
+            local_files.append(os.path.join(local_directory, os.path.basename(path)))
+    local_files = [local_file for local_file in dict.fromkeys(local_files) if os.path.isfile(local_file)]
+
+    strm_deletes = sum(1 for local_file in local_files if local_file.endswith('.strm'))
+    if strm_deletes > PRUNE_MIN_FILES:
+        local_strm_files = sum(1 for _, name in local_tree.iter_files() if name.lower().endswith('.strm'))
+        if strm_deletes > local_strm_files * max_percent / 100:
+            logger.warning(f"本次需要删除 {strm_deletes} 个 .strm 文件，超过本地 {local_strm_files} 个 .strm 文件的 "
+                           f"{max_percent:g}%，可能是云端存储异常，本次不删除任何文件。确认云端确实已删除后，"
+                           f"可调高配置中的单次删除上限再运行。")
+            if sync_plan is None:
+                local_manifest.defer_prune(removed.items())
+            return
 
+    removed_files = 0
+    for local_file in local_files:
+        if sync_plan is not None:
+            sync_plan.add('strm_delete' if local_file.endswith('.strm') else 'file_delete', local_file,
+                          os.path.getsize(local_file))
+            continue
         try:
-            os.chmod(local_directory, 0o777)
-            logger.info(f"目录权限已设置为 777: {local_directory}")
+            os.remove(local_file)
+            removed_files += 1
+            local_manifest.forget_file(local_file)
+            logger.info(f"云端文件已删除，删除本地文件: {local_file}")
         except Exception as e:
-            logger.error(f"设置目录权限时出错: {e}")
+            logger.error(f"删除本地文件时出错: {local_file}，错误: {e}")
+    if sync_plan is not None:
+        return
+    if deferred:
+        local_manifest.defer_prune([])
+
+    # 先删除较深的目录；目录中还有其它文件时保留
+    for local_directory in sorted(removed_directories, key=len, reverse=True):
+        try:
+            os.rmdir(local_directory)
+            logger.info(f"云端目录已删除，删除本地空目录: {local_directory}")
+        except OSError:
+            pass
+    if removed_files:
+        logger.info(f"共删除 {removed_files} 个云端已不存在的本地文件")
+
+def build_local_directory_tree(manifest, script_config, logger):
+    """
+    构建本地目录树（PathIndex），包括所有 .strm 文件和其他需要下载的元数据文件的信息。
+    目录树来自持久化的本地文件清单，只重新扫描修改时间变化的目录，不再遍历整个目标目录。
+    """
+    def tracked(file):
+        # 记录 .strm 文件和其他需要下载的文件（字幕、图片、元数据等）
+        file_extension = os.path.splitext(file)[1].lower().lstrip('.')
+        return file.lower().endswith('.strm') or \
+            file_extension in script_config['subtitle_formats'] or \
+            file_extension in script_config['image_formats'] or \
+            file_extension in script_config['metadata_formats']
+
+    start = time.monotonic()
+    checked, scanned = manifest.refresh()
+    local_tree = manifest.path_index(tracked)
+    logger.info(f"本地目录树已加载，包括 .strm 文件和需要下载的文件（检查 {checked} 个目录，重新扫描 {scanned} 个，"
+                f"耗时 {time.monotonic() - start:.2f} 秒）。")
+    return local_tree
+
+
+def current_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def local_directory_known(local_directory, config, local_tree):
+    """
+    本地目录树中是否已有该目录。目录树的根节点总是存在，不能说明目标目录本身已创建，目标目录总是视为未知。
+    """
+    if local_tree is None:
+        return False
+    relative_dir = os.path.relpath(local_directory, config['target_directory'])
+    return relative_dir != ROOT and relative_dir in local_tree
+
 
-        # 初始化该目录的 strm 文件计数器
+def ensure_local_directory(local_directory, logger, exists=False):
+    """
+    确保本地目录存在，每个目录每次运行只处理一次；exists 为 True（本地目录树中已有该目录）时不再访问文件系统。
+    新建目录时只在 umask 会去掉部分权限时才 chmod。干跑模式下只把不存在的目录记入计划。
+    """
+    with counter_lock:
+        if local_directory in ensured_directories:
+            return
+        if sync_plan is not None:
+            # 多个写入线程可能同时处理同一目录，干跑时在锁内登记，避免重复计入计划
+            ensured_directories.add(local_directory)
+    if sync_plan is not None:
+        if not exists and not os.path.isdir(local_directory):
+            sync_plan.add('directory_create', local_directory)
+        return
+    if not exists:
+        os.makedirs(local_directory, mode=0o777, exist_ok=True)  # 确保本地目录存在
+        if chmod_required:
+            try:
+                os.chmod(local_directory, 0o777)
+                logger.info(f"目录权限已设置为 777: {local_directory}")
+            except Exception as e:
+                logger.error(f"设置目录权限时出错: {e}")
+    with counter_lock:
+        ensured_directories.add(local_directory)
+
+
+def dispatch_listing(directory, files, config, script_config, download_enabled, logger, local_tree, modified=()):
+    """
+    处理一个已列出的远程目录：把目录创建和 .strm 生成交给写入阶段，把字幕、图片、元数据交给下载阶段。
+    modified 为大小或修改时间发生变化的条目名，这些文件即使本地已存在也会重新下载。
+    本函数运行在遍历线程上，只做分类，不做任何磁盘或网络 IO。
+    """
+    global video_file_counter, total_download_file_counter
+    decoded_directory = unquote(directory)
+
+    # 处理本地目录路径，去掉 WebDAV 上的根目录部分
+    local_relative_path = decoded_directory.replace(config['rootpath'], '').lstrip('/')
+    local_directory = os.path.join(config['target_directory'], local_relative_path)
+
+    # 初始化该目录的 strm 文件计数器
+    with counter_lock:
         directory_strm_file_counter[decoded_directory] = 0
 
-        for f in files:
-            decoded_file_name = unquote(f.name)
-            is_directory = f.name.endswith('/')
-            file_info = {
-                'name': decoded_file_name,
-                'size': f.size,
-                'modified': f.mtime,
-                'is_directory': is_directory,
-                'children': [] if is_directory else None
-            }
-
-            # 如果是文件夹，递归获取其子文件
-            if is_directory:
-                file_info['children'] = list_files_recursive_with_cache(webdav, f.name, config, script_config, size_threshold, download_enabled, logger, local_tree, min_interval, max_interval, visited)
-                time.sleep(interval)
-            else:
-                file_extension = os.path.splitext(f.name)[1].lower().lstrip('.')
-                time.sleep(interval)
-                # 根据不同格式执行不同操作
-                if file_extension in script_config['video_formats']:
-                    logger.info(f"找到视频文件: {decoded_file_name}")
-                    video_file_counter += 1  # 增加视频文件计数
-                    create_strm_file(f.name, f.size, config, script_config['video_formats'], local_directory,
-                                     decoded_directory, size_threshold, logger, local_tree)
-                # 检查本地目录树中是否已经存在文件，如果存在则跳过
-                elif download_enabled and (
-                        file_extension in script_config['subtitle_formats'] or
-                        file_extension in script_config['image_formats'] or
-                        file_extension in script_config['metadata_formats']):
-                    relative_dir = os.path.relpath(local_directory, config['target_directory'])
-                    if relative_dir in local_tree and os.path.basename(decoded_file_name) in local_tree[relative_dir]:
-                        logger.info(f"跳过文件下载: {decoded_file_name}（本地已存在）")
-                        continue
-
-                    logger.info(f"找到需要下载的文件: {decoded_file_name}")
-                    total_download_file_counter += 1  # 记录需要下载的文件总数
-                    # 将下载任务加入队列（无需创建线程）
-                    download_queue.put((webdav, f.name, local_directory, f.size, config))
+    # 同一目录的视频文件合并为一个写入任务，写入阶段先确保目录存在再逐个生成 .strm
+    videos = []
+
+    for f in files:
+        if f.is_directory:
+            continue
+
+        decoded_file_name = unquote(f.name)
+        file_extension = os.path.splitext(f.name)[1].lower().lstrip('.')
+        # 根据不同格式执行不同操作
+        if file_extension in script_config['video_formats']:
+            logger.info(f"找到视频文件: {decoded_file_name}")
+            with counter_lock:
+                video_file_counter += 1  # 增加视频文件计数
+            videos.append((f.name, f.size))
+        # 检查本地目录树中是否已经存在文件，如果存在则跳过
+        elif download_enabled and (
+                file_extension in script_config['subtitle_formats'] or
+                file_extension in script_config['image_formats'] or
+                file_extension in script_config['metadata_formats']):
+            overwrite = f.name in modified
+            relative_dir = os.path.relpath(local_directory, config['target_directory'])
+            # 所有输出中都已存在时才跳过，否则下载（或复制）到缺少该文件的输出
+            if not overwrite and local_tree.contains(relative_dir, os.path.basename(decoded_file_name)) and \
+                    all(profile_tree.contains(relative_dir, os.path.basename(decoded_file_name)) for _, profile_tree in extra_outputs):
+                logger.info(f"跳过文件下载: {decoded_file_name}（本地已存在）")
+                continue
+
+            logger.info(f"找到需要下载的文件: {decoded_file_name}")
+            with counter_lock:
+                total_download_file_counter += 1  # 记录需要下载的文件总数
+            # 将下载任务交给下载阶段，与遍历同时进行
+            download_queue.put((f.name, local_directory, f.size, overwrite))
+        else:
+            # 记录跳过的文件信息
+            if not download_enabled:
+                if file_extension in script_config['subtitle_formats']:
+                    logger.info(f"跳过字幕文件: {decoded_file_name}（下载功能已禁用）")
+                elif file_extension in script_config['image_formats']:
+                    logger.info(f"跳过图片文件: {decoded_file_name}（下载功能已禁用）")
+                elif file_extension in script_config['metadata_formats']:
+                    logger.info(f"跳过元数据文件: {decoded_file_name}（下载功能已禁用）")
                 else:
-                    # 记录跳过的文件信息
-                    if not download_enabled:
-                        if file_extension in script_config['subtitle_formats']:
-                            logger.info(f"跳过字幕文件: {decoded_file_name}（下载功能已禁用）")
-                        elif file_extension in script_config['image_formats']:
-                            logger.info(f"跳过图片文件: {decoded_file_name}（下载功能已禁用）")
-                        elif file_extension in script_config['metadata_formats']:
-                            logger.info(f"跳过元数据文件: {decoded_file_name}（下载功能已禁用）")
-                        else:
-                            logger.info(f"跳过非视频文件: {decoded_file_name}（格式: {file_extension}）")
-                    else:
-                        logger.info(f"跳过非目标文件: {decoded_file_name}（格式: {file_extension}）")
-
-            file_tree.append(file_info)
-
-        return file_tree
-    except Exception as e:
-        logger.info(f"Error listing files: {e}")
-        return []
+                    logger.info(f"跳过非视频文件: {decoded_file_name}（格式: {file_extension}）")
+            else:
+                logger.info(f"跳过非目标文件: {decoded_file_name}（格式: {file_extension}）")
 
+    strm_queue.put(('batch', local_directory, decoded_directory, tuple(videos)))
 
 
-def download_files_with_interval(min_interval, max_interval, logger):
-    global download_file_counter, total_download_file_counter
-    while not download_queue.empty():
-        webdav, file_name, local_path, expected_size, config = download_queue.get()
+def run_sync_pipeline(backend, config, script_config, size_threshold, download_enabled, logger, local_tree, checkpoint=None, cached_tree=None, start_directories=None,
+                      tree_index=None, run_id=None, max_listing_age=None):
+    """
+    以流水线方式同步远程目录树：
+    遍历阶段（RemoteCrawler 生成器）逐个产出已列出的目录 -> 写入阶段创建目录和 .strm 文件 -> 下载阶段下载字幕、元数据和图片。
+    各阶段之间通过有界队列连接，下载与遍历同时进行。传入 checkpoint 时会定期保存进度，
+    存在有效检查点时从中断处继续。传入 cached_tree 时跳过修改时间和大小未变化的子目录。
+    传入 start_directories 时只同步这些子目录，返回各子目录节点组成的列表，否则返回完整的远程目录树。
+    传入 tree_index 时遍历结果逐个目录写入远程目录树索引。传入 max_listing_age（秒）时，超过该时间未列出的缓存目录不参与剪枝。
+    缓存中已有某个目录的列表时，只处理该目录中新增和大小或修改时间变化的文件。根目录列出失败时返回 None。
+    """
+    global video_file_counter, strm_file_counter, total_download_file_counter, existing_strm_file_counter, strm_queue, download_queue
+
+    state = checkpoint.load() if checkpoint else None
+    crawler = RemoteCrawler(backend, config['rootpath'], config.get('crawl_concurrency', 1), logger, state, cached_tree,
+                            start_directories, tree_index, run_id, max_listing_age)
+
+    strm_queue = StageQueue()
+    download_queue = StageQueue()
+
+    global ensured_directories, chmod_required, strm_write_started, strm_write_finished, strm_write_count
+    ensured_directories = set()
+    chmod_required = current_umask() & 0o777 != 0
+    strm_write_started = strm_write_finished = None
+    strm_write_count = 0
+
+    # 任务中的路径都在配置本身的目标目录下，写入阶段按同样的相对路径写入每个输出
+    outputs = [(config, local_tree)] + extra_outputs
+
+    def ensure_directory(local_directory, profile, profile_tree):
+        ensure_local_directory(local_directory, logger, local_directory_known(local_directory, profile, profile_tree))
+
+    def write_videos(local_directory, decoded_directory, videos):
+        for profile, profile_tree in outputs:
+            profile_directory = local_directory if profile is config else output_path(local_directory, config, profile)
+            ensure_directory(profile_directory, profile, profile_tree)
+            for file_name, file_size in videos:
+                create_strm_file(file_name, file_size, profile, script_config['video_formats'], profile_directory,
+                                 decoded_directory, size_threshold, logger, profile_tree)
+
+    def write_strm(task):
+        # 写入阶段由多个线程并发处理，每个任务自行确保所在目录存在
+        if task[0] == 'dir':
+            for profile, profile_tree in outputs:
+                ensure_directory(task[1] if profile is config else output_path(task[1], config, profile), profile, profile_tree)
+        elif task[0] == 'batch':
+            _, local_directory, decoded_directory, videos = task
+            write_videos(local_directory, decoded_directory, videos)
+        else:
+            # 旧检查点中按文件保存的任务
+            _, file_name, file_size, local_directory, decoded_directory = task
+            write_videos(local_directory, decoded_directory, [(file_name, file_size)])
+
+    min_interval, max_interval = config['download_interval_range']
+
+    def download(task):
+        global download_file_counter
+        file_name, local_path, expected_size = task[:3]
+        overwrite = task[3] if len(task) > 3 else False  # 旧检查点中的任务没有该字段
+        requested = False
         try:
-            download_file(webdav, file_name, local_path, expected_size, config, logger)
+            requested = download_file(file_name, local_path, expected_size, config, logger, overwrite, local_tree)
+            if extra_outputs:
+                copy_to_outputs(file_name, local_path, expected_size, config, extra_outputs, logger, overwrite)
         finally:
-            download_file_counter += 1
+            with counter_lock:
+                download_file_counter += 1
             logger.info(f"文件下载进度: {download_file_counter}/{total_download_file_counter}")
-            download_queue.task_done()
+        # 使用从数据库读取的随机下载间隔范围，只在实际发起了下载请求后等待；
+        # 本地文件已存在而跳过、只复制到其他输出、干跑时没有访问服务器，无需等待
+        if requested:
+            time.sleep(random.randint(min_interval, max_interval))
+
+    stages = start_stage('写入', strm_queue, write_strm, logger, STRM_WRITER_THREADS)
+    if download_enabled:
+        stages += start_stage('下载', download_queue, download, logger)
+
+    if state:
+        # 恢复检查点中尚未完成的写入和下载任务，以及计数器
+        counters = state.get('counters', {})
+        video_file_counter = counters.get('video', 0)
+        strm_file_counter = counters.get('strm', 0)
+        existing_strm_file_counter = counters.get('existing_strm', 0)
+        total_download_file_counter = counters.get('total_download', 0)
+        pending_tasks = state.get('pending_tasks', {})
+        for task in pending_tasks.get('strm', []):
+            if task[0] == 'batch':
+                # JSON 中的列表还原为元组，任务需要可哈希
+                task = task[:3] + [tuple(tuple(video) for video in task[3])]
+            strm_queue.put(tuple(task))
+        if download_enabled:
+            for task in pending_tasks.get('download', []):
+                download_queue.put(tuple(task))
+        logger.info(f"从遍历检查点继续: 待遍历目录 {len(crawler.frontier)} 个，"
+                    f"待写入任务 {len(pending_tasks.get('strm', []))} 个，待下载文件 {len(pending_tasks.get('download', []))} 个")
+
+    for directory, files in crawler.iter_listings():
+        modified = set()
+        previous = crawler.previous_listing(directory)
+        if previous is not None:
+            changes = listing_changes(previous, files)
+            files = [f for f in files if f.name in changes]
+            modified = {name for name, change in changes.items() if change == 'modified'}
+        dispatch_listing(directory, files, config, script_config, download_enabled, logger, local_tree, modified)
+        if checkpoint and checkpoint.due():
+            save_crawl_checkpoint(checkpoint, crawler)
+
+    logger.info("目录遍历完成，等待写入和下载阶段处理剩余任务...")
+    strm_queue.close()
+    download_queue.close()
+    for stage in stages:
+        while stage.is_alive():
+            stage.join(timeout=1)
+            if checkpoint and checkpoint.due():
+                save_crawl_checkpoint(checkpoint, crawler)
+
+    if crawler.root_failed:
+        logger.error("根目录列出失败，本次不更新目录摘要和变化集。")
+        return None
+    return crawler.tree
+
+
+def current_counters():
+    with counter_lock:
+        return {
+            'video': video_file_counter,
+            'strm': strm_file_counter,
+            'existing_strm': existing_strm_file_counter,
+            'total_download': total_download_file_counter
+        }
+
+
+def save_crawl_checkpoint(checkpoint, crawler):
+    # 先提交索引再保存检查点，续跑时重新列出的目录在索引中只是被重复写入
+    if crawler.tree_index:
+        crawler.tree_index.commit()
+    pending_tasks = {
+        'strm': strm_queue.snapshot(),
+        'download': download_queue.snapshot()
+    }
+    checkpoint.save(crawler.tree, crawler.pending(), crawler.visited, pending_tasks, current_counters())
 
-        # 使用从数据库读取的随机下载间隔范围
-        interval = random.randint(min_interval, max_interval)
-        time.sleep(interval)
 
 def create_strm_file(file_name, file_size, config, video_formats, local_directory, directory, size_threshold, logger, local_tree):
     global strm_file_counter, directory_strm_file_counter, existing_strm_file_counter
@@ -224,69 +703,94 @@ def create_strm_file(file_name, file_size, config, video_formats, local_director
         logger.info(f"跳过生成 .strm 文件: {decoded_name}（文件大小小于 {size_threshold} MB）")
         return
 
-    clean_file_name = file_name.replace('/dav', '')  # 去掉 /dav/ 前缀
-    # 根据 protocol 参数生成相应的链接，http 或 https
-    http_link = f"{config['protocol']}://{config['host']}:{config['port']}/d{clean_file_name}"
+    http_link = strm_link(file_name, config)
 
-    decoded_file_name = unquote(file_name).replace('/dav/', '')  # 解码为中文
-    # 获取配置中的strm后缀，默认为'-转码'
-    strm_suffix = config.get('strm_suffix', '-转码')
-    base_name = os.path.splitext(os.path.basename(decoded_file_name))[0]
-    strm_file_name = base_name + strm_suffix + ".strm"
+    # .strm 文件名使用配置中的后缀，默认为'-转码'
+    strm_file_name = get_strm_file_name(file_name, config)
     strm_file_path = os.path.join(local_directory, strm_file_name)
 
-    # 检查本地是否已存在 .strm 文件（使用本地目录树）
+    # 检查本地是否已存在 .strm 文件（使用本地目录树），已存在时只在内容与当前链接不一致时重写
     relative_dir = os.path.relpath(local_directory, config['target_directory'])
-    if relative_dir in local_tree and strm_file_name in local_tree[relative_dir]:
-        logger.info(f"跳过生成 .strm 文件: {strm_file_path}（本地已存在）")
-        existing_strm_file_counter += 1  # 计数已存在的 .strm 文件
+    if local_tree.contains(relative_dir, strm_file_name):
+        if strm_content_current(strm_file_path, http_link, config):
+            logger.info(f"跳过生成 .strm 文件: {strm_file_path}（本地已存在）")
+            with counter_lock:
+                existing_strm_file_counter += 1  # 计数已存在的 .strm 文件
+            return
+        try:
+            rewrite_strm_file(strm_file_path, http_link, config, logger)
+        except Exception as e:
+            logger.info(f"重写 .strm 文件时出错: {file_name}，错误: {e}")
+        return
+
+    if sync_plan is not None:
+        sync_plan.add('strm_create', strm_file_path, len(http_link.encode('utf-8')))
+        with counter_lock:
+            strm_file_counter += 1
+            directory_strm_file_counter[directory] = directory_strm_file_counter.get(directory, 0) + 1
         return
 
     try:
-        logger.info(f"创建 .strm 文件: {strm_file_path}")
-        with open(strm_file_path, 'w', encoding='utf-8') as strm_file:
+        begin_strm_write()
+        # 创建时直接请求 777 权限，umask 不去掉任何权限时不需要再 chmod
+        with os.fdopen(os.open(strm_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o777), 'w', encoding='utf-8') as strm_file:
             strm_file.write(http_link)  # 写入链接
-            decoded_name = unquote(strm_file_path)
-        logger.info(f".strm 文件已创建: {decoded_name}")
-
-        # 设置文件权限为 777
-        os.chmod(strm_file_path, 0o777)
-        logger.info(f"文件权限已设置为 777: {strm_file_path}")
+        if chmod_required:
+            os.chmod(strm_file_path, 0o777)
+        manifest_for(config).record_file(strm_file_path, content_hash(http_link))
+        logger.info(f".strm 文件已创建: {strm_file_path}")
 
         # 更新计数器
-        strm_file_counter += 1
-        directory_strm_file_counter[directory] += 1  # 更新子目录下的 strm 文件数量
+        with counter_lock:
+            strm_file_counter += 1
+            directory_strm_file_counter[directory] = directory_strm_file_counter.get(directory, 0) + 1  # 更新子目录下的 strm 文件数量
+        end_strm_write()
     except Exception as e:
         logger.info(f"创建 .strm 文件时出错: {file_name}，错误: {e}")
 
-def download_file(webdav, file_name, local_path, expected_size, config, logger):
-    global download_file_counter, total_download_file_counter
-
+def download_file(file_name, local_path, expected_size, config, logger, overwrite=False, local_tree=None):
+    """
+    下载字幕、图片、元数据等文件，返回是否向服务器发起了下载请求（本地已存在而跳过、干跑时为 False）。
+    """
     # 检查是否允许下载文件
     if config.get('download_enabled', 1) == 0:
         logger.info(f"下载功能已禁用，跳过下载文件: {file_name}")
-        return
+        return False
 
+    requested = False
     try:
         # 本地文件路径，解码为中文文件名
         local_file_path = os.path.join(local_path, os.path.basename(unquote(file_name)))
 
-        # 如果文件已存在，跳过下载
-        if os.path.exists(local_file_path):
+        # 下载阶段可能先于写入阶段处理到该目录，确保本地目录存在
+        ensure_local_directory(local_path, logger, local_directory_known(local_path, config, local_tree))
+
+        # 如果文件已存在，跳过下载（云端文件已变化时重新下载覆盖）；有本地目录树时直接查询，不访问文件系统
+        if local_tree is not None:
+            exists = local_tree.contains(os.path.relpath(local_path, config['target_directory']), os.path.basename(local_file_path))
+        else:
+            exists = os.path.exists(local_file_path)
+        if exists and not overwrite:
             logger.info(f"跳过文件下载: {local_file_path}（本地已存在）")
-            return
+            return False
+        if sync_plan is not None:
+            sync_plan.add('download_overwrite' if exists else 'download', local_file_path, expected_size)
+            return False
 
-        clean_file_name = file_name.replace('/dav', '')
-        # 根据协议动态生成下载链接
-        file_url = f"{config['protocol']}://{config['host']}:{config['port']}/d{clean_file_name}"
+        # 根据协议动态生成下载链接，路径编码方式与 .strm 链接一致
+        file_url = f"{config['protocol']}://{config['host']}:{config['port']}/d{alist_path(file_name)}"
 
         logger.info(f"正在下载文件: {file_url}")
+        rate_limiter.acquire()
+        requested = True
         response = requests.get(file_url, auth=(config['username'], config['password']), stream=True, allow_redirects=True)
 
+        digest = hashlib.sha1()
         if response.status_code == 200:
             with open(local_file_path, 'wb') as f:
                 for chunk in response.iter_content(chunk_size=8192):
                     f.write(chunk)
+                    digest.update(chunk)
             logger.info(f"文件下载成功: {local_file_path}")
 
             os.chmod(local_file_path, 0o777)
@@ -298,13 +802,75 @@ def download_file(webdav, file_name, local_path, expected_size, config, logger):
         actual_size = os.path.getsize(local_file_path)
         if actual_size == expected_size:
             logger.info(f"文件已成功下载: {local_file_path}（大小: {actual_size} 字节）")
-            download_file_counter += 1
-            logger.info(f"文件下载进度: {download_file_counter}/{total_download_file_counter}")
+            manifest_for(config).record_file(local_file_path, digest.hexdigest())
         else:
             logger.info(f"文件大小不匹配: {local_file_path}。预期: {expected_size}，实际: {actual_size}")
             os.remove(local_file_path)
+            manifest_for(config).forget_file(local_file_path)
     except Exception as e:
         logger.info(f"下载文件时出错: {file_name}，错误: {e}")
+    return requested
+
+def copy_to_outputs(file_name, local_path, expected_size, config, outputs, logger, overwrite=False):
+    """
+    把配置本身目标目录中已下载的字幕、图片、元数据文件复制到其他输出（outputs 为 [(输出配置, 本地目录树)]），
+    其他输出不再重复下载，远程请求数不随输出数量增加。
+    """
+    source_file = os.path.join(local_path, os.path.basename(unquote(file_name)))
+    relative_dir = os.path.relpath(local_path, config['target_directory'])
+    for profile, profile_tree in outputs:
+        target_directory = output_path(local_path, config, profile)
+        target_file = os.path.join(target_directory, os.path.basename(source_file))
+        if not overwrite and profile_tree.contains(relative_dir, os.path.basename(source_file)):
+            continue
+        if sync_plan is not None:
+            sync_plan.add('file_copy', target_file, expected_size)
+            continue
+        if not os.path.isfile(source_file) or os.path.getsize(source_file) != expected_size:
+            logger.info(f"源文件不存在或不完整，跳过复制: {target_file}")
+            continue
+        try:
+            ensure_local_directory(target_directory, logger, local_directory_known(target_directory, profile, profile_tree))
+            shutil.copyfile(source_file, target_file)
+            if chmod_required:
+                os.chmod(target_file, 0o777)
+            manifest_for(profile).record_file(target_file)
+            logger.info(f"文件已复制到其他输出: {target_file}")
+        except Exception as e:
+            logger.error(f"复制文件到其他输出时出错: {target_file}，错误: {e}")
+
+def backfill_output(tree_index, config, profile, profile_tree, script_config, size_threshold, download_enabled, logger):
+    """
+    新增的输出或其链接配置变化后，按远程目录树索引为每个视频生成（或重写内容已过期的）该输出中的 .strm 文件，
+    并从配置本身的目标目录复制已下载的文件。增量更新时未变化的目录不会进入写入阶段，因此需要这一遍补齐。
+    """
+    start = time.monotonic()
+    before = strm_file_counter, rewritten_strm_file_counter
+    download_formats = set(script_config['subtitle_formats']) | set(script_config['image_formats']) | set(script_config['metadata_formats'])
+    for remote_path, size in tree_index.iter_files():
+        file_extension = os.path.splitext(remote_path)[1].lower().lstrip('.')
+        if file_extension in script_config['video_formats']:
+            if size < size_threshold * 1024 * 1024:
+                continue
+            local_directory = os.path.dirname(local_path_for(remote_path, profile))
+            strm_file_path = os.path.join(local_directory, get_strm_file_name(remote_path, profile))
+            if manifest_for(profile).get_file(strm_file_path) is not None:
+                # 已存在（包括本次运行中写入阶段刚生成的）时只检查内容
+                http_link = strm_link(remote_path, profile)
+                if not strm_content_current(strm_file_path, http_link, profile):
+                    try:
+                        rewrite_strm_file(strm_file_path, http_link, profile, logger)
+                    except Exception as e:
+                        logger.error(f"重写 .strm 文件时出错: {strm_file_path}，错误: {e}")
+                continue
+            ensure_local_directory(local_directory, logger, local_directory_known(local_directory, profile, profile_tree))
+            create_strm_file(remote_path, size, profile, script_config['video_formats'], local_directory,
+                             os.path.dirname(remote_path), size_threshold, logger, profile_tree)
+        elif download_enabled and file_extension in download_formats:
+            local_directory = os.path.dirname(local_path_for(remote_path, config))
+            copy_to_outputs(remote_path, local_directory, size, config, [(profile, profile_tree)], logger)
+    logger.info(f"已补齐输出 {profile['target_directory']}：新建 {strm_file_counter - before[0]} 个、"
+                f"重写 {rewritten_strm_file_counter - before[1]} 个 .strm 文件，耗时 {time.monotonic() - start:.2f} 秒")
 
 def get_jwt_token(url, username, password, logger):
     api_url = f"{url}/api/auth/login"  # 动态构建 API 登录路径
@@ -314,6 +880,7 @@ def get_jwt_token(url, username, password, logger):
     }
 
     try:
+        rate_limiter.acquire()
         response = requests.post(api_url, json=payload)
         if response.status_code == 200:
             data = response.json()
@@ -337,6 +904,7 @@ def refresh_webdav_directory(url, token, path, logger):
     }
 
     try:
+        rate_limiter.acquire()
         response = requests.post(refresh_url, headers=headers, json=payload)
         if response.status_code == 200:
             logger.info(f"WebDAV 目录 '{path}' 刷新成功。")
@@ -346,12 +914,30 @@ def refresh_webdav_directory(url, token, path, logger):
         logger.error(f"刷新 WebDAV 目录时发生异常: {e}")
 
 
-def process_with_cache(webdav, config, script_config, config_id, size_threshold, logger, min_interval, max_interval):
-    global video_file_counter, strm_file_counter, download_file_counter, total_download_file_counter
+def process_with_cache(webdav, config, script_config, config_id, size_threshold, logger, min_interval, max_interval, sync_paths=None,
+                       max_listing_age=None, plan=False):
+    """
+    同步一个配置。sync_paths 为已编码的子目录列表（见 normalize_sync_paths）时只同步这些子目录，
+    结果合并进已有的缓存目录树。max_listing_age 见 run_sync_pipeline。
+    plan 为 True 时只干跑：照常遍历并与本地清单对比，但不修改目标目录、远程目录树索引和遍历检查点，
+    把需要执行的新建、重写、删除和下载汇总为变更计划（见 sync_plan.py）。
+    """
+    global video_file_counter, strm_file_counter, download_file_counter, total_download_file_counter, rate_limiter, local_manifests, \
+        extra_outputs, rewritten_strm_file_counter, sync_plan
+
+    # 按配置初始化请求限流器，只有真正发起 HTTP 请求时才会等待
+    rate_limiter = RateLimiter(config.get('request_rate', 0), config.get('request_burst', 1))
+    logger.info(f"请求限流: 每秒 {config.get('request_rate', 0)} 次，突发 {config.get('request_burst', 1)} 次")
 
     download_enabled = config.get('download_enabled', 1)
 
-    cached_tree = load_cached_tree(config_id, logger)
+    tree_index, previous_tree = load_tree_index(config_id, config, logger)
+    # 只有增量更新使用上次的目录树剪枝，全量更新重新列出所有目录
+    cached_tree = previous_tree if config.get('update_mode') == 'incremental' else None
+    sync_plan = SyncPlan(config_id) if plan else None
+    # 干跑时遍历结果不写入索引，下次正常运行仍与上次的目录树对比
+    run_id = tree_index.begin_run() if not plan else None
+    crawl_index = tree_index if not plan else None
 
     root_directory = config['rootpath']
 
@@ -359,6 +945,7 @@ def process_with_cache(webdav, config, script_config, config_id, size_threshold,
     protocol = config.get('protocol')
     host = config.get('host')
     port = config.get('port')
+    token = None
 
     if protocol and host and port:
         url = f"{protocol}://{host}:{port}"
@@ -369,7 +956,9 @@ def process_with_cache(webdav, config, script_config, config_id, size_threshold,
             logger.info(f"正在尝试刷新 WebDAV 根目录: {root_directory}")
             token = get_jwt_token(url, username, password, logger)
             if token:
-                refresh_webdav_directory(url, token, root_directory, logger)
+                # 部分同步时只刷新所选的子目录
+                for path in ([unquote(p) for p in sync_paths] if sync_paths else [root_directory]):
+                    refresh_webdav_directory(url, token, path, logger)
             else:
                 logger.error("无法获取 JWT Token，跳过刷新目录。")
         else:
@@ -377,59 +966,150 @@ def process_with_cache(webdav, config, script_config, config_id, size_threshold,
     else:
         logger.error("缺少协议、主机或端口，无法构建 API URL。")
 
-    # 加载本地目录树（增量更新和全量更新都需要使用）
-    local_tree = build_local_directory_tree(config['target_directory'], script_config, logger, config)
+    # 选择目录列表后端（AList API 后端复用上面获取的 Token）
+    backend = create_listing_backend(config, logger, token)
+
+    # 加载每个输出的本地目录树（增量更新和全量更新都需要使用）
+    profiles = output_profiles(config)
+    local_manifests = {}
+    local_trees = []
+    for profile in profiles:
+        manifest = LocalManifest(output_manifest_key(config_id, profile.get('output_index', 0)), profile['target_directory'], logger)
+        local_manifests[profile['target_directory']] = manifest
+        local_trees.append(build_local_directory_tree(manifest, script_config, logger))
+    local_tree = local_trees[0]
+    extra_outputs = list(zip(profiles[1:], local_trees[1:]))
+    if extra_outputs:
+        logger.info(f"共 {len(profiles)} 个输出，共用同一次遍历: {', '.join(profile['target_directory'] for profile in profiles)}")
+    rewritten_strm_file_counter = 0
+
+    # 遍历检查点：中断后重新运行时从上次的进度继续
+    checkpoint = CrawlCheckpoint(config_id, config, logger, sync_paths) if not plan else None
+
+    if plan:
+        logger.info("干跑模式：只生成变更计划，不修改目标目录。")
+    crawl_started = time.monotonic()
+    current_tree = None
+    if sync_paths:
+        logger.info(f"正在执行部分同步: {', '.join(unquote(p) for p in sync_paths)}")
+
+        # 所选子目录的结果直接写入索引中对应的位置，缺失的上级目录先补齐
+        if not plan:
+            for path in sync_paths:
+                tree_index.ensure_directory(unquote(path), run_id)
+        # 增量模式下子目录内部同样可以跳过未变化的子树
+        current_tree = run_sync_pipeline(
+            backend, config, script_config, size_threshold, download_enabled, logger, local_tree, checkpoint,
+            cached_tree, sync_paths, crawl_index, run_id, max_listing_age
+        )
+        logger.info("部分同步结果已写入远程目录树索引。")
 
-    if config.get('update_mode') == 'incremental':
+    elif config.get('update_mode') == 'incremental':
         logger.info("正在执行增量更新...")
 
         if cached_tree:
-            current_tree = list_files_recursive_with_cache(
-                webdav, root_directory, config, script_config, size_threshold, download_enabled, logger, local_tree, min_interval, max_interval, visited=None
+            # 与缓存对比目录的修改时间和大小，未变化的子树直接复用，不再重新列出
+            current_tree = run_sync_pipeline(
+                backend, config, script_config, size_threshold, download_enabled, logger, local_tree, checkpoint, cached_tree,
+                tree_index=crawl_index, run_id=run_id, max_listing_age=max_listing_age
             )
-            if compare_directory_trees(cached_tree, current_tree):
-                logger.info("本地目录树与云端一致，跳过更新。")
-                if not download_enabled:
-                    logger.info("下载功能已禁用，跳过下载任务。")
-            else:
-                logger.info("目录树发生变化，进行增量更新。")
-                save_tree_to_cache(current_tree, config_id, logger)
         else:
             logger.info("没有找到缓存的目录树，执行全量更新。")
-            current_tree = list_files_recursive_with_cache(
-                webdav, root_directory, config, script_config, size_threshold, download_enabled, logger, local_tree, min_interval, max_interval, visited=None
+            current_tree = run_sync_pipeline(
+                backend, config, script_config, size_threshold, download_enabled, logger, local_tree, checkpoint,
+                tree_index=crawl_index, run_id=run_id
             )
-            save_tree_to_cache(current_tree, config_id, logger)
 
     elif config.get('update_mode') == 'full':
         logger.info("正在执行全量更新...")
 
         # 在全量更新时，同样需要检查本地文件，快速跳过已经存在的文件
-        current_tree = list_files_recursive_with_cache(
-            webdav, root_directory, config, script_config, size_threshold, download_enabled, logger, local_tree, min_interval, max_interval, visited=None
+        current_tree = run_sync_pipeline(
+            backend, config, script_config, size_threshold, download_enabled, logger, local_tree, checkpoint,
+            tree_index=crawl_index, run_id=run_id
         )
-        save_tree_to_cache(current_tree, config_id, logger)  # 保存全量更新后的目录树到缓存
+    crawl_seconds = time.monotonic() - crawl_started
+
+    if current_tree is not None:
+        # 部分同步时上级目录的摘要保持为空，等下次完整运行时重新计算
+        if not plan:
+            save_tree_digests(tree_index, current_tree, logger)
+        changes = diff_previous_tree(previous_tree, current_tree, sync_paths)
+        if not changes:
+            logger.info("本地目录树与云端一致，跳过更新。")
+            if not download_enabled:
+                logger.info("下载功能已禁用，跳过下载任务。")
+        else:
+            summary = {change: 0 for change in ('added', 'removed', 'modified')}
+            for change in changes:
+                summary[change[0]] += 1
+            logger.info(f"目录树发生变化: 新增 {summary['added']} 个、删除 {summary['removed']} 个、"
+                        f"变化 {summary['modified']} 个条目（运行编号 {run_id}）")
+        for profile, profile_tree in zip(profiles, local_trees):
+            # 删除云端已不存在的条目对应的本地文件（包括以前因超过单次删除上限而推迟的）
+            remove_orphaned_files(changes, profile, script_config, logger, profile_tree, tree_index)
+
+            # 链接配置变化后，未进入写入阶段的已有 .strm 文件也需要检查一遍；新增的输出需要补齐所有文件
+            link_signature = strm_link_signature(profile)
+            if manifest_for(profile).get_meta('strm_link_signature') != link_signature:
+                if profile is config:
+                    refresh_strm_links(tree_index, config, script_config, size_threshold, local_tree, logger)
+                else:
+                    backfill_output(tree_index, config, profile, profile_tree, script_config, size_threshold, download_enabled, logger)
+                if not plan:
+                    manifest_for(profile).set_meta('strm_link_signature', link_signature)
 
     logger.info(f"总共创建了 {strm_file_counter} 个 .strm 文件")
+    if rewritten_strm_file_counter:
+        logger.info(f"总共重写了 {rewritten_strm_file_counter} 个内容已过期的 .strm 文件")
+    if strm_write_count and strm_write_finished > strm_write_started:
+        elapsed = strm_write_finished - strm_write_started
+        logger.info(f"写入 .strm 文件 {strm_write_count} 个，耗时 {elapsed:.2f} 秒，平均 {strm_write_count / elapsed:.1f} 个/秒"
+                    f"（{STRM_WRITER_THREADS} 个写入线程）")
     logger.info(f"总共发现了 {video_file_counter} 个视频文件")
+    logger.info(f"本次运行共发起 {rate_limiter.total_requests} 次请求，限流等待 {rate_limiter.total_wait_time:.1f} 秒")
 
     if download_enabled:
         logger.info(f"总共需要下载 {total_download_file_counter} 个文件")
-        # 传递下载间隔范围（最小值和最大值）
-        min_interval, max_interval = config['download_interval_range']
-        download_files_with_interval(min_interval, max_interval, logger)
         logger.info(f"总共下载了 {download_file_counter} 个文件")
     else:
         logger.info("下载功能已禁用，跳过所有下载任务。")
         logger.info("程序执行完成！")
 
+    if plan:
+        sync_plan.finish(config, crawl_seconds, rate_limiter.total_requests, logger)
+        sync_plan = None
+        tree_index.close()
+        for manifest in local_manifests.values():
+            manifest.close()
+        return
+
+    # 本次运行全部完成，记录到索引并删除遍历检查点
+    tree_index.finish_run(run_id, complete=not sync_paths)
+    tree_index.close()
+    for manifest in local_manifests.values():
+        manifest.save()
+        manifest.close()
+    checkpoint.clear()
+
 
 
 if __name__ == '__main__':
     db_handler = DBHandler()
 
-    config_id = int(sys.argv[1]) if len(sys.argv) > 1 else 1
-    task_id = sys.argv[2] if len(sys.argv) > 2 else None  # 获取任务ID，如果存在
+    parser = argparse.ArgumentParser(description='根据配置从 WebDAV 生成 .strm 文件')
+    parser.add_argument('config_id', nargs='?', type=int, default=1)
+    parser.add_argument('task_id', nargs='?', default=None)  # 获取任务ID，如果存在
+    scope = parser.add_mutually_exclusive_group()
+    scope.add_argument('--path', action='append', default=[],
+                       help='只同步根路径下的指定子目录（可多次指定），结果合并进已有缓存')
+    scope.add_argument('--refresh-stale', action='store_true',
+                       help='只重新列出超过配置的新鲜度窗口未列出的目录')
+    parser.add_argument('--plan', action='store_true',
+                        help='干跑：只输出并保存变更计划（新建、重写、删除、下载的数量和字节数及预计耗时），不修改目标目录')
+    args = parser.parse_args()
+    config_id = args.config_id
+    task_id = args.task_id
 
     # 设置日志
     if task_id:
@@ -447,6 +1127,12 @@ if __name__ == '__main__':
             logger.error(f"无法获取配置ID {config_id} 的配置，程序终止。")
             sys.exit(1)
 
+        # 同一配置同时只运行一个同步，避免争用远程目录树索引的写事务；干跑不修改索引，不需要加锁
+        run_lock = sync_run_lock(config_id)
+        if not args.plan and not run_lock.acquire():
+            logger.warning(f"配置ID {config_id} 的同步正在运行，本次不执行。")
+            sys.exit(RUN_LOCKED_EXIT_CODE)
+
         # 输出配置信息到日志
         logger.info(
             f"正在使用配置ID: {config_id} 运行，目标地址: {config['protocol']}://{config['host']}:{config['port']}"
@@ -460,6 +1146,27 @@ if __name__ == '__main__':
             logger.error(f"脚本配置出错，缺少必要的配置项，程序终止。")
             sys.exit(1)
 
+        # 解析部分同步的子目录
+        try:
+            sync_paths = normalize_sync_paths(config['rootpath'], args.path) if args.path else None
+        except ValueError as e:
+            logger.error(f"子路径无效: {e}")
+            sys.exit(1)
+
+        # 只刷新过期的目录：根目录过期时刷新整个配置，否则只同步过期的子目录
+        max_listing_age = None
+        if args.refresh_stale:
+            max_listing_age = config['freshness_hours'] * 3600
+            tree_index = RemoteTreeIndex(config_id, config['rootpath'], logger)
+            tree_index.import_legacy_cache()
+            stale_directories = tree_index.stale_directories(max_listing_age)
+            tree_index.close()
+            if not stale_directories:
+                logger.info(f"所有目录都在 {config['freshness_hours']} 小时内列出过，无需刷新。")
+                sys.exit(0)
+            sync_paths = normalize_sync_paths(config['rootpath'], stale_directories)
+            logger.info(f"共有 {len(stale_directories)} 个目录超过新鲜度窗口，" + ("刷新整个配置" if sync_paths is None else "只刷新这些目录"))
+
         # 连接 WebDAV 服务器
         try:
             webdav = connect_webdav(config)
@@ -471,7 +1178,8 @@ if __name__ == '__main__':
         try:
             # 获取下载间隔范围
             min_interval, max_interval = config['download_interval_range']
-            process_with_cache(webdav, config, script_config, config_id, script_config['size_threshold'], logger, min_interval, max_interval)
+            process_with_cache(webdav, config, script_config, config_id, script_config['size_threshold'], logger, min_interval, max_interval, sync_paths,
+                               max_listing_age, args.plan)
         except Exception as e:
             logger.error(f"处理文件时发生错误: {e}")
             sys.exit(1)
@@ -480,6 +1188,8 @@ if __name__ == '__main__':
 
     except Exception as e:
         logger.error(f"运行过程中出现未捕获的异常: {e}")
+        # 以非零退出码结束，外部通知触发的同步据此保留队列并重试
+        sys.exit(1)
 
     finally:
         db_handler.close()
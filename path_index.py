@@ -0,0 +1,73 @@
+import os
+from bisect import bisect_left
+
+# 根目录的相对路径
+ROOT = '.'
+
+
+class PathIndex:
+    """
+    本地路径索引：目录按路径分量组织为前缀树，上级目录的名称只保存一次；每个目录的文件名排序后保存为一个元组，
+    用二分查找判断是否存在。相比 {相对目录: set(文件名)}，不再为每个目录保存完整的相对路径，也没有集合的哈希表开销。
+    构建完成后只读，可以在多个线程中同时查询。相对目录使用 os.path.relpath 的格式，根目录为 '.'。
+    """
+    __slots__ = ('children', 'names')
+
+    def __init__(self):
+        self.children = None
+        self.names = ()
+
+    def find(self, relative_dir, create=False):
+        """
+        返回相对目录对应的节点，不存在时返回 None（create 为 True 时创建）。
+        """
+        node = self
+        if relative_dir in ('', ROOT):
+            return node
+        for part in relative_dir.split(os.sep):
+            child = node.children.get(part) if node.children else None
+            if child is None:
+                if not create:
+                    return None
+                if node.children is None:
+                    node.children = {}
+                child = node.children[part] = PathIndex()
+            node = child
+        return node
+
+    def add_directory(self, relative_dir, names):
+        self.find(relative_dir, create=True).names = tuple(sorted(names))
+
+    def contains(self, relative_dir, name):
+        node = self.find(relative_dir)
+        if node is None:
+            return False
+        position = bisect_left(node.names, name)
+        return position < len(node.names) and node.names[position] == name
+
+    def __contains__(self, relative_dir):
+        return self.find(relative_dir) is not None
+
+    def iter_files(self, relative_dir=ROOT):
+        """
+        深度优先逐个返回 relative_dir 下（含子目录）的 (相对目录, 文件名)。
+        """
+        start = self.find(relative_dir)
+        stack = [(relative_dir, start)] if start is not None else []
+        while stack:
+            directory, node = stack.pop()
+            for name in node.names:
+                yield directory, name
+            if node.children:
+                stack.extend((os.path.normpath(os.path.join(directory, part)), child)
+                             for part, child in sorted(node.children.items(), reverse=True))
+
+    def count_files(self):
+        count = 0
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            count += len(node.names)
+            if node.children:
+                stack.extend(node.children.values())
+        return count
@@ -0,0 +1,61 @@
+import threading
+from queue import Queue
+
+# 流水线各阶段队列的默认容量，队列满时上游阶段阻塞等待，保证内存占用稳定
+STAGE_QUEUE_SIZE = 1000
+
+
+class StageQueue:
+    """
+    流水线阶段之间的有界队列。除缓冲任务外，还记录已入队但尚未处理完成的任务，
+    以便写入遍历检查点，进程中断后重新入队。
+    """
+
+    def __init__(self, maxsize=STAGE_QUEUE_SIZE):
+        self.queue = Queue(maxsize=maxsize)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.consumers = 1
+
+    def put(self, task):
+        with self.lock:
+            self.pending.add(task)
+        self.queue.put(task)  # 队列已满时阻塞，形成背压
+
+    def close(self):
+        # 每个消费线程放入一个结束标记，通知其退出
+        for _ in range(self.consumers):
+            self.queue.put(None)
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.pending)
+
+
+def start_stage(name, stage_queue, handler, logger, workers=1):
+    """
+    启动一个流水线阶段：workers 个线程不断从 stage_queue 取任务交给 handler 处理，直到遇到结束标记，返回线程列表。
+    workers 大于 1 时任务并发处理，不保证顺序。单个任务出错只记录日志，不影响后续任务。
+    """
+    def run():
+        while True:
+            task = stage_queue.queue.get()
+            if task is None:
+                stage_queue.queue.task_done()
+                return
+            try:
+                handler(task)
+            except Exception as e:
+                logger.error(f"{name}阶段处理任务出错: {task}，错误: {e}")
+            finally:
+                with stage_queue.lock:
+                    stage_queue.pending.discard(task)
+                stage_queue.queue.task_done()
+
+    stage_queue.consumers = workers
+    threads = []
+    for index in range(workers):
+        thread = threading.Thread(target=run, name=name if workers == 1 else f"{name}-{index + 1}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
@@ -0,0 +1,49 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    令牌桶限流器，用于限制向 AList 发起的 HTTP 请求速率（PROPFIND、下载、API 调用等）。
+    rate 为每秒补充的令牌数，burst 为桶容量（允许的最大突发请求数）。
+    rate <= 0 时不做任何限制。线程安全，可在并发遍历的多个工作线程间共享。
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate or 0)
+        self.burst = max(1, int(burst or 1))
+        self.tokens = float(self.burst)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+        self.total_requests = 0  # 已放行的请求总数
+        self.total_wait_time = 0.0  # 因限流累计等待的时间（秒）
+
+    def _refill(self, now):
+        elapsed = now - self.last_refill
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.last_refill = now
+
+    def acquire(self, tokens=1):
+        """
+        获取令牌，令牌不足时阻塞等待，返回本次等待的秒数。
+        """
+        if self.rate <= 0:
+            with self.lock:
+                self.total_requests += tokens
+            return 0.0
+
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    self.total_requests += tokens
+                    self.total_wait_time += waited
+                    return waited
+                # 计算补足所需令牌的时间
+                delay = (tokens - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
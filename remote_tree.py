@@ -0,0 +1,230 @@
+import hashlib
+from array import array
+from urllib.parse import unquote
+
+# 目录中文件名之间的分隔符，文件名中不可能出现
+NAME_SEPARATOR = '\0'
+
+
+class TreeNode:
+    """
+    目录树节点的公共部分：支持 node['name']、node.get('digest') 等字典式访问，
+    与原先以字典表示节点的代码（目录树的比较、摘要、检查点编码等）保持兼容。
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+
+class RemoteFile(TreeNode):
+    """
+    文件节点。目录中的文件以列存方式保存在 RemoteDirectory 中，只在访问 children 时临时生成 RemoteFile。
+    """
+    __slots__ = ('name', 'size', 'modified')
+    is_directory = False
+    children = None
+    digest = None
+
+    def __init__(self, name, size, modified):
+        self.name = name
+        self.size = size
+        self.modified = modified
+
+
+class RemoteDirectory(TreeNode):
+    """
+    紧凑的目录节点：子目录为节点列表，文件按列保存——文件名（相对于本目录）拼接为一个字符串，
+    大小和修改时间各为一个 64 位整数数组，每个文件只占几十字节，而不是一个字典加一条完整路径。
+    listed 为 False 表示子条目未成功列出，此时 children 为 None；listed_at 为从索引加载时记录的最近一次列出时间。
+    """
+    __slots__ = ('name', 'size', 'modified', 'digest', 'listed', 'listed_at', 'directories', 'file_names', 'file_sizes',
+                 'file_mtimes')
+    is_directory = True
+
+    def __init__(self, name, size=0, modified=0, digest=None):
+        self.name = name
+        self.size = size
+        self.modified = modified
+        self.digest = digest
+        self.listed_at = None
+        self.set_entries([], [])
+
+    def set_entries(self, directories, files):
+        """
+        设置子条目：directories 为子目录节点列表，files 为 (文件名, 大小, 修改时间) 列表，文件名为完整路径。
+        """
+        prefix_length = len(self.name)
+        self.listed = True
+        self.directories = directories
+        self.file_names = NAME_SEPARATOR.join(
+            name[prefix_length:] if name.startswith(self.name) else name for name, _, _ in files
+        )
+        self.file_sizes = array('q', [size or 0 for _, size, _ in files])
+        self.file_mtimes = array('q', [modified or 0 for _, _, modified in files])
+
+    def copy_entries(self, other):
+        """
+        直接复用另一个目录节点（通常是缓存中的同一目录）的子条目，不重新打包。
+        """
+        self.listed = other.listed
+        self.listed_at = other.listed_at
+        self.directories = other.directories
+        self.file_names = other.file_names
+        self.file_sizes = other.file_sizes
+        self.file_mtimes = other.file_mtimes
+
+    def iter_files(self):
+        if not self.file_sizes:
+            return
+        for name, size, modified in zip(self.file_names.split(NAME_SEPARATOR), self.file_sizes, self.file_mtimes):
+            # 不在本目录之下的文件保存的是完整路径（以 '/' 开头）
+            yield RemoteFile(name if name.startswith('/') else self.name + name, size, modified)
+
+    @property
+    def children(self):
+        if not self.listed:
+            return None
+        return self.directories + list(self.iter_files())
+
+    @children.setter
+    def children(self, nodes):
+        if nodes is None:
+            self.set_entries([], [])
+            self.listed = False
+            return
+        directories = [node for node in nodes if node.get('is_directory')]
+        files = [(node['name'], node.get('size'), node.get('modified')) for node in nodes if not node.get('is_directory')]
+        self.set_entries(directories, files)
+
+
+def index_directories(tree):
+    """
+    为嵌套目录树建立 目录名 -> 目录节点 的索引（目录名即节点的 'name'，为解码后的完整路径）。
+    """
+    index = {}
+    stack = list(tree or [])
+    while stack:
+        node = stack.pop()
+        if node.is_directory:
+            index[node.name] = node
+            stack.extend(node.directories)
+    return index
+
+
+def directory_unchanged(cached_node, file_info):
+    """
+    判断目录是否可以直接复用缓存的子树：父目录列表中该目录的修改时间和大小与缓存一致，
+    且缓存中该目录曾被成功列出（children 为 None 表示上次列出失败）。
+    """
+    if cached_node is None or not cached_node.get('is_directory'):
+        return False
+    if not cached_node.listed:
+        return False
+    # 未能解析出修改时间的目录无法判断是否变化
+    if not file_info['modified']:
+        return False
+    return cached_node.get('modified') == file_info['modified'] and cached_node.get('size') == file_info['size']
+
+
+def directory_digest(children):
+    """
+    目录的 Merkle 摘要：按名称排序后，对每个子条目的名称、大小、修改时间和（子目录的）摘要做 SHA-1。
+    任意深度的子条目变化都会改变沿途所有上级目录的摘要。
+    """
+    digest = hashlib.sha1()
+    for node in sorted(children, key=lambda item: item['name']):
+        digest.update(f"{node['name']}\0{node.get('size')}\0{node.get('modified')}\0{node.get('digest') or ''}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def compute_digests(tree):
+    """
+    自底向上为缺少摘要的目录节点计算摘要（写入节点的 'digest'），已有摘要的目录视为子树未变化，不再深入；
+    子条目未成功列出（children 为 None）的目录没有摘要。
+    返回 (根目录摘要, 本次计算出的 [(目录名, 摘要), ...])。
+    """
+    computed = []
+    stack = [(node, False) for node in tree if node.is_directory and not node.digest]
+    while stack:
+        node, expanded = stack.pop()
+        if not node.listed:
+            continue
+        if not expanded:
+            stack.append((node, True))
+            stack.extend((child, False) for child in node.directories if not child.digest)
+        else:
+            node.digest = directory_digest(node.children)
+            computed.append((node.name, node.digest))
+    return directory_digest(tree), computed
+
+
+def iter_subtree(children):
+    """
+    深度优先逐个返回 children 及其所有子孙节点（子条目未列出的目录不再深入）。
+    """
+    stack = list(reversed(children or []))
+    while stack:
+        node = stack.pop()
+        yield node
+        children = node.children if node.is_directory else None
+        if children:
+            stack.extend(reversed(children))
+
+
+def change_record(change, node):
+    return (change, node['name'], bool(node.get('is_directory')), node.get('size'), node.get('modified'))
+
+
+def diff_trees(old_tree, new_tree):
+    """
+    比较两棵目录树（子条目列表），返回变化集 [(变化类型, 路径, 是否目录, 大小, 修改时间), ...]，
+    变化类型为 'added'、'removed' 或 'modified'（大小或修改时间变化）。新增或删除的目录连同整棵子树逐条列出，
+    类型在文件和目录之间变化的条目记为一次删除加一次新增。两边摘要相同的子目录直接跳过，比较代价与变化量成正比；
+    旧树中子条目未列出的目录，其新子条目全部记为新增，新树中子条目未列出的目录不做比较。
+    """
+    changes = []
+    stack = [(old_tree, new_tree)]
+    while stack:
+        old_children, new_children = stack.pop()
+        old_nodes = {node['name']: node for node in old_children or []}
+        for node in new_children:
+            old = old_nodes.pop(node['name'], None)
+            if old is None or bool(old.get('is_directory')) != bool(node.get('is_directory')):
+                if old is not None:
+                    changes.extend(change_record('removed', item) for item in iter_subtree([old]))
+                changes.extend(change_record('added', item) for item in iter_subtree([node]))
+                continue
+            if old.get('size') != node.get('size') or old.get('modified') != node.get('modified'):
+                changes.append(change_record('modified', node))
+            if not node.get('is_directory') or node.get('children') is None:
+                continue
+            if old.get('children') is None:
+                changes.extend(change_record('added', item) for item in iter_subtree(node['children']))
+            elif not node.get('digest') or node.get('digest') != old.get('digest'):
+                stack.append((old['children'], node['children']))
+        for old in old_nodes.values():
+            changes.extend(change_record('removed', item) for item in iter_subtree([old]))
+    return changes
+
+
+def listing_changes(previous_children, entries):
+    """
+    比较一个目录本次的列表（RemoteEntry 列表）与缓存中的子条目，返回 {已编码的条目名: 'added' 或 'modified'}，
+    未变化的条目不在其中。
+    """
+    previous = {node['name']: node for node in previous_children}
+    changes = {}
+    for entry in entries:
+        old = previous.get(unquote(entry.name))
+        if old is None or bool(old.get('is_directory')) != entry.is_directory:
+            changes[entry.name] = 'added'
+        elif old.get('size') != entry.size or old.get('modified') != entry.mtime:
+            changes[entry.name] = 'modified'
+    return changes
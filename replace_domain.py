@@ -10,27 +10,39 @@ if project_root not in sys.path:
 
 # 导入项目的日志模块
 from logger import setup_logger
+from db_handler import DBHandler
+from local_manifest import content_hash, open_manifest_for_directory
 
 def replace_domain_in_strm_files(target_directory, old_domain, new_domain):
     """
-    遍历目标目录及其子目录下的所有 .strm 文件，替换其中的域名。
+    替换目标目录及其子目录下所有 .strm 文件中的域名。
+    .strm 文件列表来自与 main.py 共用的本地文件清单，只重新扫描修改时间变化的目录，不再遍历整个目标目录。
     """
-    for root, dirs, files in os.walk(target_directory):
-        for filename in files:
-            if fnmatch.fnmatch(filename, '*.strm'):
-                file_path = os.path.join(root, filename)
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    if old_domain in content:
-                        new_content = content.replace(old_domain, new_domain)
-                        with open(file_path, 'w', encoding='utf-8') as f:
-                            f.write(new_content)
-                        logger.info(f"已更新文件：{file_path}")
-                    else:
-                        logger.info(f"文件中未找到旧域名，跳过：{file_path}")
-                except Exception as e:
-                    logger.error(f"处理文件时出错：{file_path}，错误信息：{e}")
+    db_handler = DBHandler()
+    try:
+        manifest = open_manifest_for_directory(db_handler, target_directory, logger)
+    finally:
+        db_handler.close()
+    try:
+        for file_path, _ in manifest.iter_files('.strm'):
+            if not fnmatch.fnmatch(os.path.basename(file_path), '*.strm'):
+                continue
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    content = f.read()
+                if old_domain in content:
+                    new_content = content.replace(old_domain, new_domain)
+                    with open(file_path, 'w', encoding='utf-8') as f:
+                        f.write(new_content)
+                    manifest.record_file(file_path, content_hash(new_content))
+                    logger.info(f"已更新文件：{file_path}")
+                else:
+                    logger.info(f"文件中未找到旧域名，跳过：{file_path}")
+            except Exception as e:
+                logger.error(f"处理文件时出错：{file_path}，错误信息：{e}")
+    finally:
+        manifest.save()
+        manifest.close()
 
 def main():
     if len(sys.argv) != 4:
@@ -0,0 +1,72 @@
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# main.py 发现同一配置的同步正在运行、本次不执行时的退出码
+RUN_LOCKED_EXIT_CODE = 75
+
+
+class FileLock:
+    """
+    基于文件的进程间互斥锁（非阻塞），持有锁的进程退出时由操作系统自动释放，不会残留。
+    """
+
+    def __init__(self, lock_file):
+        self.lock_file = lock_file
+        self.file = None
+
+    def acquire(self):
+        """
+        尝试获取锁，已被其它进程（或本进程的另一个 FileLock）持有时返回 False。
+        """
+        if self.file is not None:
+            return True
+        lock_dir = os.path.dirname(self.lock_file)
+        if lock_dir and not os.path.exists(lock_dir):
+            os.makedirs(lock_dir, exist_ok=True)
+        lock_file = open(self.lock_file, 'a+')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock_file.close()
+            return False
+        self.file = lock_file
+        return True
+
+    def release(self):
+        if self.file is None:
+            return
+        if fcntl is None:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.file.close()
+        self.file = None
+
+
+def sync_run_lock(config_id):
+    """
+    配置级的运行锁 cache/sync_<config_id>.lock：定时任务、手动运行、校验重建和外部通知启动的 main.py 都先获取该锁，
+    同一配置同时只有一个同步在运行。
+    """
+    return FileLock(os.path.join('cache', f'sync_{config_id}.lock'))
+
+
+def is_sync_running(config_id):
+    """
+    配置的同步是否正在运行（运行锁被其它进程持有）。
+    """
+    lock = sync_run_lock(config_id)
+    if not os.path.exists(lock.lock_file):
+        return False
+    if not lock.acquire():
+        return True
+    lock.release()
+    return False
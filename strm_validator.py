@@ -5,6 +5,8 @@ import random
 import time
 from db_handler import DBHandler
 from logger import setup_logger
+from tree_index import RemoteTreeIndex, tree_index_file
+from local_manifest import LocalManifest, content_hash
 import subprocess
 import re  # 导入正则表达式模块
 
@@ -63,107 +65,108 @@ class StrmValidator:
         if not self.remote_base.endswith('/'):
             self.remote_base += '/'
 
-    def load_cached_tree(self):
-        cache_dir = 'cache'
-        cache_file = os.path.join(cache_dir, f'webdav_directory_cache_{self.config_id}.json')
-        if os.path.exists(cache_file):
-            try:
-                with open(cache_file, 'r', encoding='utf-8') as f:
-                    self.logger.info(f"加载缓存文件: {cache_file}")
-                    return json.load(f)
-            except Exception as e:
-                self.logger.error(f"加载缓存文件出错: {e}")
-        else:
-            self.logger.warning(f"缓存文件不存在: {cache_file}")
-        return None
+    def connect_tree_index(self):
+        """
+        索引已存在时以只读方式打开，不与正在运行的同步争用写锁；尚未建立索引时新建并导入旧版 JSON 缓存。
+        """
+        if os.path.exists(tree_index_file(self.config_id)):
+            return RemoteTreeIndex(self.config_id, self.remote_base, self.logger, readonly=True)
+        tree_index = RemoteTreeIndex(self.config_id, self.remote_base, self.logger)
+        tree_index.import_legacy_cache()
+        return tree_index
+
+    def open_tree_index(self):
+        """
+        打开远程目录树索引，索引为空时返回 None。
+        """
+        tree_index = self.connect_tree_index()
+        if not tree_index.has_entries():
+            self.logger.warning(f"远程目录树索引为空: {tree_index.db_file}")
+            tree_index.close()
+            return None
+        self.logger.info(f"使用远程目录树索引: {tree_index.db_file}，共 {tree_index.count_entries()} 个条目")
+        return tree_index
+
+    def open_local_manifest(self):
+        """
+        打开并刷新本配置的本地文件清单（与 main.py 共用）。
+        """
+        manifest = LocalManifest(self.config_id, self.target_directory, self.logger)
+        checked, scanned = manifest.refresh()
+        self.logger.info(f"本地文件清单已刷新：检查 {checked} 个目录，重新扫描 {scanned} 个")
+        return manifest
 
     def list_local_strm_files(self):
         strm_files = []
         # 获取配置中的strm后缀，默认为'-转码'
         strm_suffix = self.config.get('strm_suffix', '-转码')
         
-        for root, dirs, files in os.walk(self.target_directory):
-            for file in files:
-                if file.lower().endswith('.strm'):
-                    # 检查是否是带后缀的strm文件
-                    if strm_suffix in file:
-                        full_path = os.path.abspath(os.path.join(root, file))
-                        strm_files.append(full_path)
+        # 本地文件来自持久化的本地文件清单，只重新扫描修改时间变化的目录
+        manifest = self.open_local_manifest()
+        try:
+            for file_path, _ in manifest.iter_files('.strm'):
+                # 检查是否是带后缀的strm文件
+                if strm_suffix in os.path.basename(file_path):
+                    strm_files.append(os.path.abspath(file_path))
+        finally:
+            manifest.close()
         self.logger.info(f"找到 {len(strm_files)} 个本地带后缀 '{strm_suffix}' 的 .strm 文件")
         return strm_files
 
-    def build_expected_strm_set(self, file_tree, current_path=''):
+    def build_expected_strm_set(self, tree_index):
         expected_strm_set = set()
         size_threshold_mb = self.script_config.get('size_threshold', 100)  # 获取大小阈值，默认100MB
         size_threshold_bytes = size_threshold_mb * 1024 * 1024  # 转换为字节
 
-        for file in file_tree:
-            file_name = file['name']
-            file_size = file.get('size', 0)  # 假设缓存中包含文件大小字段
-            is_directory = file.get('is_directory', False)  # 获取是否为目录的标识
-
+        # 只从索引中查询不小于阈值的文件，目录和小文件不需要读取
+        for file_name, file_size in tree_index.iter_files(size_threshold_bytes):
             if not file_name.startswith(self.remote_base):
                 self.logger.warning(f"文件路径不以远程根路径开头: {file_name}")
                 continue
 
-            # 如果是目录，递归处理子文件
-            if is_directory:
-                children = file.get('children', [])
-                if children:
-                    expected_strm_set.update(self.build_expected_strm_set(children, current_path))
-            else:
-                # 文件大小小于阈值，跳过该文件
-                if file_size < size_threshold_bytes:
-                    self.logger.info(f"跳过文件（大小小于阈值 {size_threshold_mb}MB）: {file_name}, 大小: {file_size / (1024 * 1024):.2f}MB")
-                    continue
-
-                file_extension = os.path.splitext(file_name)[1].lower().lstrip('.')
-                if file_extension in self.video_formats:
-                    # 生成对应的 .strm 文件路径
-                    relative_path = os.path.relpath(file_name, self.remote_base)
-                    video_relative_dir = os.path.dirname(relative_path)
-                    video_base_name = os.path.splitext(os.path.basename(relative_path))[0]
-                    
-                    # 获取配置中的strm后缀，默认为'-转码'
-                    strm_suffix = self.config.get('strm_suffix', '-转码')
-                    strm_file_name = f"{video_base_name}{strm_suffix}.strm"
-                    strm_file_path = os.path.abspath(
-                        os.path.join(self.target_directory, video_relative_dir, strm_file_name)
-                    )
-                    expected_strm_set.add(strm_file_path)
-                    self.logger.debug(f"预期的 .strm 文件路径: {strm_file_path}")
+            file_extension = os.path.splitext(file_name)[1].lower().lstrip('.')
+            if file_extension in self.video_formats:
+                # 生成对应的 .strm 文件路径
+                relative_path = os.path.relpath(file_name, self.remote_base)
+                video_relative_dir = os.path.dirname(relative_path)
+                video_base_name = os.path.splitext(os.path.basename(relative_path))[0]
+                
+                # 获取配置中的strm后缀，默认为'-转码'
+                strm_suffix = self.config.get('strm_suffix', '-转码')
+                strm_file_name = f"{video_base_name}{strm_suffix}.strm"
+                strm_file_path = os.path.abspath(
+                    os.path.join(self.target_directory, video_relative_dir, strm_file_name)
+                )
+                expected_strm_set.add(strm_file_path)
+                self.logger.debug(f"预期的 .strm 文件路径: {strm_file_path}")
         return expected_strm_set
 
-    def check_cache_file(self, cache_file, max_age_hours=24):
+    def check_tree_index(self):
         """
-        检查缓存文件是否过期，如果缓存文件存在且在max_age_hours内被修改过，则返回True。
-        如果缓存文件不存在或已过期，则返回False。
+        按配置的新鲜度窗口检查远程目录树索引中每个目录最近一次列出的时间，返回过期的目录列表。
+        索引为空或根目录过期时返回 [根目录]，全部未过期时返回空列表。
         """
-        if os.path.exists(cache_file):
-            last_modified_time = os.path.getmtime(cache_file)
-            current_time = time.time()
-            # 计算缓存文件的年龄（秒），并将其转换为小时
-            cache_age_hours = (current_time - last_modified_time) / 3600
-            if cache_age_hours <= max_age_hours:
-                self.logger.info(f"缓存文件 {cache_file} 存在且未过期（{cache_age_hours:.2f}小时）")
-                return True
+        freshness_hours = self.config.get('freshness_hours', 24)
+        tree_index = self.connect_tree_index()
+        try:
+            stale_directories = tree_index.stale_directories(freshness_hours * 3600)
+            if stale_directories:
+                self.logger.info(f"远程目录树索引 {tree_index.db_file} 中有 {len(stale_directories)} 个目录超过 {freshness_hours} 小时未列出，将刷新这些目录")
             else:
-                self.logger.info(f"缓存文件 {cache_file} 已过期（{cache_age_hours:.2f}小时），将重新生成缓存")
-        else:
-            self.logger.warning(f"缓存文件 {cache_file} 不存在")
-
-        # 缓存文件不存在或已过期
-        return False
+                self.logger.info(f"远程目录树索引 {tree_index.db_file} 中的目录都在 {freshness_hours} 小时内列出过")
+            return stale_directories
+        finally:
+            tree_index.close()
 
-    def rebuild_cache(self, config_id):
+    def rebuild_cache(self, config_id, refresh_stale=False):
         """
-        调用 main.py 重建缓存文件
+        调用 main.py 重建缓存文件；refresh_stale 为 True 时只重新列出过期的目录。
         """
         self.logger.info("正在调用 main.py 重建缓存文件...")
         try:
             # 调用 main.py 重新生成缓存文件
             result = subprocess.run(
-                ['/usr/local/bin/python3.9', 'main.py', str(config_id)],
+                ['/usr/local/bin/python3.9', 'main.py', str(config_id)] + (['--refresh-stale'] if refresh_stale else []),
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
                 universal_newlines=True
@@ -175,26 +178,24 @@ class StrmValidator:
         except Exception as e:
             self.logger.error(f"调用 main.py 重建缓存时发生错误: {e}")
 
-    def fast_scan(self, cached_tree, local_strm_files):
-        # 修改为先检查缓存文件时间
-        cache_file = os.path.join('cache', f'webdav_directory_cache_{self.config_id}.json')
-        if not self.check_cache_file(cache_file):
-            # 如果缓存文件已过期或不存在，调用 main.py 重建缓存
-            self.rebuild_cache(self.config_id)
-            # 重新加载缓存文件
-            cached_tree = self.load_cached_tree()
+    def fast_scan(self, local_strm_files):
+        # 先检查各目录最近一次列出的时间，只刷新过期的目录
+        if self.check_tree_index():
+            self.rebuild_cache(self.config_id, refresh_stale=True)
 
-        if not cached_tree:
+        tree_index = self.open_tree_index()
+        if not tree_index:
             self.logger.warning("未加载到缓存树，快扫将视为所有本地 .strm 文件无效。")
-            invalid_files = local_strm_files
-        else:
-            invalid_files = self.fast_scan_logic(cached_tree, local_strm_files)
+            return local_strm_files
 
-        return invalid_files
+        try:
+            return self.fast_scan_logic(tree_index, local_strm_files)
+        finally:
+            tree_index.close()
 
-    def fast_scan_logic(self, cached_tree, local_strm_files):
+    def fast_scan_logic(self, tree_index, local_strm_files):
         # 构建期望的 .strm 文件集
-        expected_strm_files = self.build_expected_strm_set(cached_tree) if cached_tree else set()
+        expected_strm_files = self.build_expected_strm_set(tree_index)
         local_strm_files_set = set(local_strm_files)
 
         # 额外存在的本地 .strm 文件（本地有但缓存中没有）
@@ -336,12 +337,7 @@ class StrmValidator:
         invalid_files = []
 
         if self.scan_mode == 'quick':
-            cached_tree = self.load_cached_tree()
-            if not cached_tree:
-                self.logger.warning("未加载到缓存树，快扫将视为所有本地 .strm 文件无效。")
-                invalid_files = local_strm_files
-            else:
-                invalid_files = self.fast_scan(cached_tree, local_strm_files)
+            invalid_files = self.fast_scan(local_strm_files)
         elif self.scan_mode == 'slow':
             invalid_files = self.slow_scan(local_strm_files)
         else:
@@ -372,22 +368,20 @@ class StrmValidator:
         generated_count = 0
         skipped_count = 0
         
-        for root, dirs, files in os.walk(self.target_directory):
-            for file in files:
-                file_path = os.path.join(root, file)
+        manifest = self.open_local_manifest()
+        # 已存在的 .strm 文件从本地文件清单中查询，不再逐个访问文件系统
+        strm_index = manifest.path_index(lambda name: name.lower().endswith('.strm'))
+        try:
+            for file_path, file_size in manifest.iter_files():
+                root, file = os.path.split(file_path)
                 file_extension = os.path.splitext(file)[1].lower().lstrip('.')
                 
                 # 检查是否是视频文件
                 if file_extension in video_formats:
-                    # 检查文件大小
-                    try:
-                        file_size = os.path.getsize(file_path)
-                        if file_size < size_threshold_bytes:
-                            self.logger.debug(f"跳过文件（大小小于阈值）: {file}，大小: {file_size / (1024 * 1024):.2f}MB")
-                            skipped_count += 1
-                            continue
-                    except OSError as e:
-                        self.logger.warning(f"无法获取文件大小: {file}，错误: {e}")
+                    # 检查文件大小（使用清单中记录的大小）
+                    if file_size < size_threshold_bytes:
+                        self.logger.debug(f"跳过文件（大小小于阈值）: {file}，大小: {file_size / (1024 * 1024):.2f}MB")
+                        skipped_count += 1
                         continue
                     
                     # 检查是否已存在对应的strm文件
@@ -395,7 +389,7 @@ class StrmValidator:
                     strm_file_name = f"{base_name}{strm_suffix}.strm"
                     strm_file_path = os.path.join(root, strm_file_name)
                     
-                    if os.path.exists(strm_file_path):
+                    if strm_index.contains(os.path.relpath(root, self.target_directory), strm_file_name):
                         self.logger.debug(f"跳过生成strm文件（已存在）: {strm_file_name}")
                         skipped_count += 1
                         continue
@@ -415,12 +409,16 @@ class StrmValidator:
                         
                         # 设置文件权限
                         os.chmod(strm_file_path, 0o777)
+                        manifest.record_file(strm_file_path, content_hash(http_link))
                         
                         self.logger.info(f"已生成strm文件: {strm_file_name}")
                         generated_count += 1
                         
                     except Exception as e:
                         self.logger.error(f"生成strm文件时出错: {file}，错误: {e}")
+        finally:
+            manifest.save()
+            manifest.close()
         
         self.logger.info(f"strm文件生成完成。生成: {generated_count} 个，跳过: {skipped_count} 个")
 
@@ -0,0 +1,119 @@
+import json
+import os
+import threading
+import time
+
+# 每类操作在计划中保留的示例路径数量
+PLAN_SAMPLE_SIZE = 20
+# 计划中的操作类型及其说明
+PLAN_ACTIONS = (
+    ('directory_create', '新建目录'),
+    ('strm_create', '新建 .strm'),
+    ('strm_update', '重写 .strm'),
+    ('strm_delete', '删除 .strm'),
+    ('download', '下载文件'),
+    ('download_overwrite', '重新下载覆盖'),
+    ('file_delete', '删除已下载文件'),
+    ('file_copy', '复制到其他输出'),
+)
+
+
+class SyncPlan:
+    """
+    干跑计划：main.py --plan 时写入、下载、删除等操作只记录到计划中，不实际执行，
+    结束后汇总每类操作的数量和字节数，并按配置的限流和下载间隔估算实际运行所需的时间。
+    add 可在写入、下载阶段的多个线程中调用。
+    """
+
+    def __init__(self, config_id):
+        self.config_id = config_id
+        self.plan_file = os.path.join('cache', f'sync_plan_{config_id}.json')
+        self.lock = threading.Lock()
+        self.actions = {action: {'count': 0, 'bytes': 0, 'samples': []} for action, _ in PLAN_ACTIONS}
+        # 计划删除的 .strm 文件；干跑时远程目录树索引未更新，链接检查仍会遍历到这些文件，不再计为重写
+        self.deleted = set()
+        self.started_at = time.time()
+
+    def add(self, action, path, size=0):
+        with self.lock:
+            if action == 'strm_delete':
+                self.deleted.add(path)
+            elif action == 'strm_update' and path in self.deleted:
+                return
+            entry = self.actions[action]
+            entry['count'] += 1
+            entry['bytes'] += size or 0
+            if len(entry['samples']) < PLAN_SAMPLE_SIZE:
+                entry['samples'].append(path)
+
+    def estimate_seconds(self, config, crawl_seconds):
+        """
+        估算实际运行的耗时：遍历耗时取本次干跑的实测值（实际运行的列表请求与干跑相同）；
+        下载阶段逐个下载，每个文件至少等待一次限流间隔和配置的平均下载间隔，文件传输时间无法预估，不计入。
+        """
+        downloads = self.actions['download']['count'] + self.actions['download_overwrite']['count']
+        request_rate = config.get('request_rate') or 0
+        min_interval, max_interval = config.get('download_interval_range', (0, 0))
+        per_download = (min_interval + max_interval) / 2 + (1 / request_rate if request_rate > 0 else 0)
+        return crawl_seconds + downloads * per_download
+
+    def summary(self, config, crawl_seconds, requests):
+        return {
+            'config_id': self.config_id,
+            'generated_at': time.time(),
+            'update_mode': config.get('update_mode'),
+            'crawl_seconds': round(crawl_seconds, 2),
+            'crawl_requests': requests,
+            'estimated_seconds': round(self.estimate_seconds(config, crawl_seconds), 1),
+            'actions': self.actions,
+        }
+
+    def finish(self, config, crawl_seconds, requests, logger):
+        """
+        输出计划汇总并保存到 cache/sync_plan_<config_id>.json，返回汇总。
+        """
+        summary = self.summary(config, crawl_seconds, requests)
+        logger.info("干跑计划（未对目标目录做任何修改）:")
+        for action, label in PLAN_ACTIONS:
+            entry = self.actions[action]
+            logger.info(f"  {label}: {entry['count']} 个，共 {format_bytes(entry['bytes'])}")
+            for path in entry['samples'][:5]:
+                logger.info(f"    {path}")
+        logger.info(f"遍历耗时 {crawl_seconds:.1f} 秒，发起 {requests} 次请求；"
+                    f"按当前限流和下载间隔估算实际运行至少需要 {format_duration(summary['estimated_seconds'])}（不含文件传输时间）")
+        try:
+            with open(self.plan_file, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+            logger.info(f"干跑计划已保存到: {self.plan_file}")
+        except Exception as e:
+            logger.error(f"保存干跑计划时出错: {e}")
+        return summary
+
+
+def load_plan(config_id):
+    """
+    读取配置最近一次保存的干跑计划，不存在时返回 None。
+    """
+    plan_file = os.path.join('cache', f'sync_plan_{config_id}.json')
+    if not os.path.exists(plan_file):
+        return None
+    with open(plan_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours} 小时 {minutes} 分"
+    if minutes:
+        return f"{minutes} 分 {seconds} 秒"
+    return f"{seconds} 秒"
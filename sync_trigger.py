@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from urllib.parse import unquote
+
+from listing_backend import DAV_PREFIX
+from run_lock import FileLock, is_sync_running
+
+# 同一配置最后一次收到通知后等待的时间（秒），期间的通知合并为一次同步
+SYNC_DEBOUNCE = 30
+# 通知持续不断时，从首次通知起最多等待的时间（秒），避免同步被无限推迟
+SYNC_MAX_DELAY = 300
+# 后台线程检查队列的间隔（秒）
+POLL_INTERVAL = 5
+# 多进程部署时，只有持有该锁的进程运行后台线程处理队列
+WORKER_LOCK_FILE = os.path.join('cache', 'sync_trigger.lock')
+
+
+def relative_sync_path(rootpath, path):
+    """
+    把通知中的路径转换为相对于配置根路径的路径。支持 AList 路径（/电影/xxx）
+    和 WebDAV 路径（/dav/电影/xxx）；不在根路径下时返回 None，根路径本身返回空字符串。
+    """
+    root = unquote(rootpath).rstrip('/')
+    path = '/' + unquote(path).strip().strip('/')
+    if '..' in path.split('/'):
+        return None
+    for candidate in (path, DAV_PREFIX + path):
+        candidate = candidate.rstrip('/')
+        if candidate == root or candidate.startswith(root + '/'):
+            return candidate[len(root):].strip('/')
+    return None
+
+
+class SyncTriggerWorker:
+    """
+    后台线程：定期检查 sync_queue，某个配置的通知平静 debounce 秒后（或首次通知已超过 max_delay 秒），
+    把该配置排队的所有子目录交给一次 main.py --path 运行。同一配置的同步（包括定时任务、手动运行等其它途径启动的）
+    尚未结束时不启动；队列中的路径在同步成功结束后才删除，同步失败时保留并在 debounce 秒后重试。
+    db_factory 用于在后台线程中创建独立的 DBHandler，run 为启动 main.py 的函数，返回子进程对象。
+    """
+
+    def __init__(self, db_factory, run, logger, debounce=SYNC_DEBOUNCE, max_delay=SYNC_MAX_DELAY,
+                 poll_interval=POLL_INTERVAL):
+        self.db_factory = db_factory
+        self.run = run
+        self.logger = logger
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.running = {}  # config_id -> (由通知触发、尚未处理结果的子进程, 本次同步的队列条目)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.worker_lock = FileLock(WORKER_LOCK_FILE)
+        self.last_attempt = 0
+
+    def start(self):
+        """
+        启动后台线程，可重复调用。其它进程已在处理队列时不启动，每隔 poll_interval 秒重新尝试一次，
+        以便该进程退出后接替。
+        """
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            if time.monotonic() - self.last_attempt < self.poll_interval:
+                return
+            self.last_attempt = time.monotonic()
+            if not self.worker_lock.acquire():
+                return
+            self.thread = threading.Thread(target=self.run_forever, name='sync-trigger', daemon=True)
+            self.thread.start()
+
+    def run_forever(self):
+        db_handler = self.db_factory()
+        while True:
+            try:
+                self.process_due(db_handler)
+            except Exception as e:
+                self.logger.error(f"处理同步队列时出错: {e}")
+            time.sleep(self.poll_interval)
+
+    def collect_finished(self, db_handler, now):
+        """
+        处理已结束的同步：成功时从队列中删除本次同步的路径，失败时保留并重新计时。
+        """
+        for config_id, (process, entries) in list(self.running.items()):
+            returncode = process.poll()
+            if returncode is None:
+                continue
+            del self.running[config_id]
+            if returncode == 0:
+                db_handler.remove_sync_paths(config_id, entries)
+                self.logger.info(f"配置ID {config_id} 的 {len(entries)} 个待同步目录已同步完成")
+            else:
+                db_handler.requeue_sync_paths(config_id, entries, now)
+                self.logger.warning(f"配置ID {config_id} 的同步未成功（退出码 {returncode}），"
+                                    f"待同步目录保留在队列中，{self.debounce} 秒后重试")
+
+    def process_due(self, db_handler, now=None):
+        now = now or time.time()
+        self.collect_finished(db_handler, now)
+        for config_id, entries in db_handler.get_sync_queue().items():
+            first_queued = min(entry[1] for entry in entries)
+            last_queued = max(entry[2] for entry in entries)
+            if now - last_queued < self.debounce and now - first_queued < self.max_delay:
+                continue
+
+            # 本线程启动的同步尚未结束，或其它途径启动的同步正在运行时，等其结束后再启动
+            if config_id in self.running or is_sync_running(config_id):
+                continue
+
+            paths = [entry[0] for entry in entries]
+            # 队列中的根目录（空路径）表示同步整个配置
+            process = self.run(config_id, None if '' in paths else paths)
+            if process is None:
+                continue
+            self.running[config_id] = (process, entries)
+            self.logger.info(f"配置ID {config_id} 的 {len(paths)} 个待同步目录已开始同步: {', '.join(paths) or '/'}")
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+清理云端已删除条目的测试：附属文件的匹配、单次删除上限和推迟的删除（python -m pytest test_orphan_sidecars.py）
+"""
+
+import logging
+import os
+
+import pytest
+
+import main
+from local_manifest import LocalManifest
+from main import orphan_sidecars, remaining_video_names
+from path_index import PathIndex
+from tree_index import RemoteTreeIndex
+
+logger = logging.getLogger('test_orphan_sidecars')
+
+ROOTPATH = '/dav/电影'
+TARGET = '/media/strm'
+CONFIG = {'target_directory': TARGET}
+DOWNLOAD_FORMATS = {'nfo', 'jpg', 'srt'}
+VIDEO_FORMATS = ['mkv', 'mp4']
+
+
+def local_tree():
+    tree = PathIndex()
+    tree.add_directory('.', [
+        'Alien-转码.strm', 'Alien.nfo', 'Alien-poster.jpg', 'Alien.zh.srt',
+        'Alien.Resurrection-转码.strm', 'Alien.Resurrection.nfo', 'Alien.Resurrection-poster.jpg',
+        'Aliens.nfo',
+    ])
+    return tree
+
+
+def sidecar_names(remaining_videos):
+    files = orphan_sidecars('/dav/电影/Alien.mkv', TARGET, local_tree(), CONFIG, DOWNLOAD_FORMATS, remaining_videos)
+    return sorted(os.path.basename(path) for path in files)
+
+
+def test_keep_sidecars_of_remaining_videos():
+    assert sidecar_names(['Alien.Resurrection', 'Aliens']) == ['Alien-poster.jpg', 'Alien.nfo', 'Alien.zh.srt']
+
+
+def test_remove_sidecars_when_no_other_video_remains():
+    assert sidecar_names([]) == [
+        'Alien-poster.jpg', 'Alien.Resurrection-poster.jpg', 'Alien.Resurrection.nfo', 'Alien.nfo', 'Alien.zh.srt',
+    ]
+
+
+def test_remaining_video_names(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tree_index = RemoteTreeIndex(1, ROOTPATH, logger)
+    try:
+        rows = [
+            ('/dav/电影/Alien.mkv', '/dav/电影/', 0),
+            ('/dav/电影/Alien.Resurrection.mkv', '/dav/电影/', 0),
+            ('/dav/电影/Alien.Resurrection.nfo', '/dav/电影/', 0),
+            ('/dav/电影/Alien 3.mp4', '/dav/电影/', 0),
+            ('/dav/电影/Alien.Covenant/', '/dav/电影/', 1),
+            ('/dav/电影/Alien.Covenant/Alien.Covenant.mkv', '/dav/电影/Alien.Covenant/', 0),
+        ]
+        tree_index.conn.executemany('INSERT INTO remote_tree (path, parent, size, mtime, is_dir) VALUES (?, ?, 0, 0, ?)',
+                                    rows)
+        # 干跑时本次删除的视频仍在索引中
+        names = remaining_video_names(tree_index, '/dav/电影/', {'/dav/电影/Alien.mkv': False}, VIDEO_FORMATS)
+        assert sorted(names) == ['Alien 3', 'Alien.Resurrection']
+    finally:
+        tree_index.close()
+
+
+SCRIPT_CONFIG = {'video_formats': ['mkv'], 'subtitle_formats': ['srt'], 'image_formats': ['jpg'],
+                 'metadata_formats': ['nfo']}
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    """
+    本地目标目录中有 40 个视频的 .strm 文件和字幕，返回 (配置, 本地文件清单)。
+    """
+    monkeypatch.chdir(tmp_path)
+    target = tmp_path / 'strm'
+    target.mkdir()
+    for index in range(40):
+        (target / f'v{index}-转码.strm').write_text('http://example/d/v.mkv', encoding='utf-8')
+        (target / f'v{index}.srt').write_text('1', encoding='utf-8')
+    config = {'rootpath': ROOTPATH, 'target_directory': str(target), 'strm_suffix': '-转码', 'prune_max_percent': 10}
+    manifest = LocalManifest(1, str(target), logger)
+    monkeypatch.setattr(main, 'local_manifests', {str(target): manifest})
+    monkeypatch.setattr(main, 'sync_plan', None)
+    yield config, manifest
+    manifest.close()
+
+
+def removed_changes(indexes):
+    return [('removed', f'{ROOTPATH}/v{index}.mkv', False, 0, 0) for index in indexes]
+
+
+def prune(config, changes, tree_index=None):
+    local_tree = main.build_local_directory_tree(main.manifest_for(config), SCRIPT_CONFIG, logger)
+    main.remove_orphaned_files(changes, config, SCRIPT_CONFIG, logger, local_tree, tree_index)
+
+
+def strm_count(config):
+    return sum(1 for name in os.listdir(config['target_directory']) if name.endswith('.strm'))
+
+
+def test_prune_over_cap_is_deferred(library):
+    config, manifest = library
+    # 11 个超过 PRUNE_MIN_FILES，且超过 40 个的 10%
+    prune(config, removed_changes(range(11)))
+    assert strm_count(config) == 40
+    assert sorted(path for path, _ in manifest.deferred_prune()) == sorted(
+        change[1] for change in removed_changes(range(11)))
+
+
+def test_prune_within_cap_is_applied(library):
+    config, _ = library
+    prune(config, removed_changes(range(3)))
+    assert strm_count(config) == 37
+    assert not os.path.exists(os.path.join(config['target_directory'], 'v0-转码.strm'))
+
+
+def test_deferred_prune_applied_later(library):
+    config, manifest = library
+    prune(config, removed_changes(range(11)))
+    assert len(manifest.deferred_prune()) == 11
+
+    # 确认云端确实已删除后调高上限；期间 v0 又在云端出现，不再删除
+    tree_index = RemoteTreeIndex(1, ROOTPATH, logger)
+    try:
+        tree_index.conn.execute("INSERT INTO remote_tree (path, parent, size, mtime, is_dir) VALUES (?, ?, 0, 0, 0)",
+                                (f'{ROOTPATH}/v0.mkv', f'{ROOTPATH}/'))
+        prune(dict(config, prune_max_percent=50), [], tree_index)
+    finally:
+        tree_index.close()
+    assert strm_count(config) == 30
+    assert os.path.exists(os.path.join(config['target_directory'], 'v0-转码.strm'))
+    assert manifest.deferred_prune() == []
+
+
+def test_prune_disabled(library):
+    config, manifest = library
+    prune(dict(config, prune_max_percent=0), removed_changes(range(3)))
+    assert strm_count(config) == 40
+    assert manifest.deferred_prune() == []
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+外部通知触发同步的测试：sync_queue 的合并、/api/sync_trigger 的校验和后台线程的出队（python -m pytest test_sync_trigger.py）
+"""
+
+import logging
+
+import pytest
+
+from db_handler import DBHandler
+from sync_trigger import SyncTriggerWorker, relative_sync_path
+
+logger = logging.getLogger('test_sync_trigger')
+
+SECURITY_CODE = 'test-code'
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db_handler = DBHandler(str(tmp_path / 'config.db'))
+    db_handler.cursor.execute('''INSERT INTO config (config_name, url, username, password, rootpath, target_directory,
+                                                     download_interval_range)
+                                 VALUES ('电影', 'http://127.0.0.1:5244', 'u', 'p', '/dav/电影', ?, '1-3')''',
+                              (str(tmp_path / 'strm'),))
+    db_handler.conn.commit()
+    yield db_handler
+    db_handler.close()
+
+
+def queued_paths(db_handler, config_id=1):
+    return [entry[0] for entry in db_handler.get_sync_queue().get(config_id, [])]
+
+
+def test_relative_sync_path():
+    assert relative_sync_path('/dav/电影', '/电影/剧集/') == '剧集'
+    assert relative_sync_path('/dav/电影', '/dav/电影/剧集') == '剧集'
+    assert relative_sync_path('/dav/电影', '/电影') == ''
+    assert relative_sync_path('/dav/电影', '/电影2/剧集') is None
+    assert relative_sync_path('/dav/电影', '/电影/../音乐') is None
+
+
+def test_enqueue_coalesces_duplicates_and_nested_paths(db):
+    assert db.enqueue_sync_path(1, '剧集/第一季', 10) == '剧集/第一季'
+    assert db.enqueue_sync_path(1, '剧集/第二季', 20) == '剧集/第二季'
+    # 重复的路径只更新通知时间
+    assert db.enqueue_sync_path(1, '剧集/第一季', 30) == '剧集/第一季'
+    assert db.get_sync_queue()[1] == [('剧集/第一季', 10, 30), ('剧集/第二季', 20, 20)]
+
+    # 父目录替换已排队的子目录，保留最早的通知时间
+    assert db.enqueue_sync_path(1, '剧集', 40) == '剧集'
+    assert db.get_sync_queue()[1] == [('剧集', 10, 40)]
+    # 已排队目录下的子路径合并进父目录
+    assert db.enqueue_sync_path(1, '剧集/第三季', 50) == '剧集'
+    assert db.get_sync_queue()[1] == [('剧集', 10, 50)]
+    # 名称相同前缀的兄弟目录不合并
+    assert db.enqueue_sync_path(1, '剧集2', 60) == '剧集2'
+    assert queued_paths(db) == ['剧集', '剧集2']
+
+    # 根目录覆盖所有路径，其它配置的队列不受影响
+    db.enqueue_sync_path(2, '音乐', 70)
+    assert db.enqueue_sync_path(1, '', 80) == ''
+    assert db.enqueue_sync_path(1, '电影', 90) == ''
+    assert queued_paths(db) == ['']
+    assert queued_paths(db, 2) == ['音乐']
+
+
+def test_remove_keeps_paths_notified_again(db):
+    db.enqueue_sync_path(1, 'a', 10)
+    db.enqueue_sync_path(1, 'b', 10)
+    entries = db.get_sync_queue()[1]
+    db.enqueue_sync_path(1, 'b', 20)
+    db.remove_sync_paths(1, entries)
+    assert db.get_sync_queue()[1] == [('b', 10, 20)]
+
+
+class FakeProcess:
+    def __init__(self):
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+
+def test_worker_dequeues_only_after_success(db):
+    processes = []
+
+    def run(config_id, paths):
+        processes.append((config_id, paths, FakeProcess()))
+        return processes[-1][2]
+
+    worker = SyncTriggerWorker(lambda: db, run, logger, debounce=30, max_delay=300)
+    db.enqueue_sync_path(1, 'a', 0)
+    worker.process_due(db, now=10)
+    assert processes == []  # 仍在等待 debounce
+
+    worker.process_due(db, now=100)
+    assert [(config_id, paths) for config_id, paths, _ in processes] == [(1, ['a'])]
+    assert queued_paths(db) == ['a']
+    worker.process_due(db, now=200)
+    assert len(processes) == 1  # 上一次同步尚未结束
+
+    # 同步失败：保留在队列中，重新计时后重试
+    processes[0][2].returncode = 1
+    worker.process_due(db, now=210)
+    assert db.get_sync_queue()[1] == [('a', 210, 210)]
+    assert len(processes) == 1
+    worker.process_due(db, now=250)
+    assert len(processes) == 2
+
+    processes[1][2].returncode = 0
+    worker.process_due(db, now=260)
+    assert db.get_sync_queue() == {}
+
+
+def test_worker_waits_for_other_runs(db):
+    from run_lock import sync_run_lock
+
+    processes = []
+    worker = SyncTriggerWorker(lambda: db, lambda config_id, paths: processes.append(paths) or FakeProcess(), logger)
+    db.enqueue_sync_path(1, '', 0)
+    lock = sync_run_lock(1)
+    assert lock.acquire()
+    try:
+        worker.process_due(db, now=1000)
+        assert processes == []
+    finally:
+        lock.release()
+    worker.process_due(db, now=1000)
+    assert processes == [None]
+
+
+@pytest.fixture
+def client(db, tmp_path, monkeypatch):
+    import app
+
+    monkeypatch.setattr(app, 'db_handler', db)
+    monkeypatch.setattr(app, 'ENV_FILE', str(tmp_path / 'app.env'))
+    monkeypatch.setenv('SECURITY_CODE', SECURITY_CODE)
+    monkeypatch.setattr(app.app, 'testing', True)
+    return app.app.test_client()
+
+
+def test_sync_trigger_checks_security_code(client, db):
+    response = client.post('/api/sync_trigger', json={'token': 'wrong', 'path': '/电影/剧集'})
+    assert response.status_code == 403
+    response = client.post('/api/sync_trigger', json={'path': '/电影/剧集'})
+    assert response.status_code == 403
+    assert db.get_sync_queue() == {}
+
+    response = client.post('/api/sync_trigger', json={'path': '/电影/剧集'}, headers={'X-Sync-Token': SECURITY_CODE})
+    assert response.status_code == 200
+    assert response.get_json()['queued'] == [{'config_id': 1, 'path': '/电影/剧集', 'queued_path': '剧集'}]
+
+
+def test_sync_trigger_validates_parameters(client, db):
+    response = client.post('/api/sync_trigger', json={'token': SECURITY_CODE})
+    assert response.status_code == 400
+    for config_id in ('abc', True, 1.5, -1):
+        response = client.post('/api/sync_trigger', json={'token': SECURITY_CODE, 'path': '/电影', 'config_id': config_id})
+        assert response.status_code == 400
+        assert 'error' in response.get_json()
+    response = client.post('/api/sync_trigger', data={'token': SECURITY_CODE, 'path': '/电影', 'config_id': 'x'})
+    assert response.status_code == 400
+    assert db.get_sync_queue() == {}
+
+    response = client.post('/api/sync_trigger', json={'token': SECURITY_CODE, 'paths': ['/电影/a', '/音乐/b'],
+                                                      'config_id': '1'})
+    assert response.status_code == 200
+    assert response.get_json()['ignored'] == ['/音乐/b']
+    assert queued_paths(db) == ['a']
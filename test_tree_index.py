@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+远程目录树索引导入旧版 JSON 缓存的测试（python -m pytest test_tree_index.py）
+"""
+
+import json
+import logging
+import os
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import tree_history
+from listing_backend import RemoteEntry
+from remote_tree import compute_digests, diff_trees
+from tree_index import RemoteTreeIndex
+
+logger = logging.getLogger('test_tree_index')
+
+ROOTPATH = '/dav/电影'
+MTIME = 'Mon, 01 Jan 2024 00:00:00 GMT'
+MTIME_TIMESTAMP = 1704067200
+
+
+def legacy_entry(name, size=0, children=None):
+    is_directory = name.endswith('/')
+    return {
+        'name': name,
+        'size': size,
+        'modified': MTIME,
+        'is_directory': is_directory,
+        'children': (children if children is not None else []) if is_directory else None,
+    }
+
+
+def legacy_cache():
+    """
+    旧版 main.py 保存的缓存：webdav.ls 的结果中每个目录都包含自身（第一项），
+    自身的 children 因已访问而为空列表；修改时间为 HTTP 日期字符串。
+    """
+    season = '/dav/电影/剧集/第一季/'
+    series = '/dav/电影/剧集/'
+    return [
+        legacy_entry('/dav/电影/'),
+        legacy_entry('/dav/电影/Alien.mkv', 2048),
+        legacy_entry(series, children=[
+            legacy_entry(series),
+            legacy_entry(season, children=[
+                legacy_entry(season),
+                legacy_entry(season + 'E01.mkv', 4096),
+                legacy_entry(season + 'E01.srt', 10),
+            ]),
+        ]),
+    ]
+
+
+def write_legacy_cache(config_id):
+    os.makedirs('cache', exist_ok=True)
+    with open(os.path.join('cache', f'webdav_directory_cache_{config_id}.json'), 'w', encoding='utf-8') as f:
+        json.dump(legacy_cache(), f, ensure_ascii=False, indent=4)
+
+
+def assert_tree_usable(tree_index):
+    rows = tree_index.conn.execute('SELECT path, parent, mtime FROM remote_tree').fetchall()
+    assert rows
+    assert all(path != parent for path, parent, _ in rows)
+    assert all(path != tree_index.root for path, _, _ in rows)
+    assert all(isinstance(mtime, int) for _, _, mtime in rows)
+
+    tree = tree_index.load_tree()
+    compute_digests(tree)
+    names = sorted(node['name'] for node in tree)
+    assert names == ['/dav/电影/Alien.mkv', '/dav/电影/剧集/']
+    series = [node for node in tree if node['name'] == '/dav/电影/剧集/'][0]
+    assert [node['name'] for node in series['children']] == ['/dav/电影/剧集/第一季/']
+    assert diff_trees(tree, tree) == []
+    assert dict((path, mtime) for path, _, mtime in rows)['/dav/电影/Alien.mkv'] == MTIME_TIMESTAMP
+
+
+def test_import_legacy_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_legacy_cache(1)
+
+    tree_index = RemoteTreeIndex(1, ROOTPATH, logger)
+    tree_index.import_legacy_cache()
+    try:
+        assert tree_index.count_entries() == 5
+        assert_tree_usable(tree_index)
+    finally:
+        tree_index.close()
+
+
+def test_repair_previous_import(tmp_path, monkeypatch):
+    """
+    早期版本原样导入的索引（目录成为自己的子条目、修改时间为字符串）在下次打开时被修复。
+    """
+    monkeypatch.chdir(tmp_path)
+    write_legacy_cache(1)
+    tree_index = RemoteTreeIndex(1, ROOTPATH, logger)
+    tree_index.close()
+
+    rows = []
+    stack = [(tree_index.root, node) for node in reversed(legacy_cache())]
+    while stack:
+        parent, node = stack.pop()
+        children = node['children']
+        rows.append((node['name'], parent, node['size'], node['modified'], int(node['is_directory']),
+                     int(node['is_directory'] and children is not None), 0))
+        if node['is_directory'] and children:
+            stack.extend((node['name'], child) for child in reversed(children))
+    conn = sqlite3.connect(os.path.join('cache', 'tree_index_1.db'))
+    conn.executemany('''INSERT OR REPLACE INTO remote_tree (path, parent, size, mtime, is_dir, listed, last_seen_run)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)''', rows)
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('complete', '1')")
+    conn.commit()
+    conn.close()
+
+    tree_index = RemoteTreeIndex(1, ROOTPATH, logger)
+    tree_index.import_legacy_cache()
+    try:
+        assert_tree_usable(tree_index)
+    finally:
+        tree_index.close()
+
+
+def record_run(tree_index, files, finished_at=None):
+    """
+    模拟一次完整运行：根目录列出 files（{文件名: (大小, 修改时间)}），返回运行编号。
+    """
+    run_id = tree_index.begin_run()
+    entries = [RemoteEntry(tree_index.root + name, size, mtime, False) for name, (size, mtime) in files.items()]
+    tree_index.record_listing(tree_index.root, entries, run_id)
+    tree_index.finish_run(run_id, True)
+    if finished_at is not None:
+        tree_index.conn.execute('UPDATE tree_runs SET finished_at = ? WHERE run_id = ?', (finished_at, run_id))
+        tree_index.conn.commit()
+    return run_id
+
+
+@pytest.fixture
+def history_index(tmp_path, monkeypatch):
+    """
+    三次运行的索引：
+    运行 1：A、B、C；运行 2：A 变化、B 删除、D 和 E 新增；运行 3：A 再次变化、D 删除、B 重新出现。
+    """
+    monkeypatch.chdir(tmp_path)
+    tree_index = RemoteTreeIndex(1, ROOTPATH, logger)
+    record_run(tree_index, {'A.mkv': (100, 1), 'B.mkv': (100, 1), 'C.mkv': (100, 1)},
+               datetime(2024, 1, 1, 8).timestamp())
+    record_run(tree_index, {'A.mkv': (200, 2), 'C.mkv': (100, 1), 'D.mkv': (100, 1), 'E.mkv': (100, 1)},
+               datetime(2024, 1, 2, 8).timestamp())
+    record_run(tree_index, {'A.mkv': (300, 3), 'B.mkv': (100, 1), 'C.mkv': (100, 1), 'E.mkv': (100, 1)},
+               datetime(2024, 1, 3, 8).timestamp())
+    yield tree_index
+    tree_index.close()
+
+
+def test_diff_runs_folds_journal(history_index):
+    changes, next_after = history_index.diff_runs(1, 3)
+    assert next_after is None
+    # A 两次变化只记一次，D 新增后又删除不出现，B 删除后又出现记为变化
+    assert changes == [
+        ('modified', '/dav/电影/A.mkv', False, 300, 3),
+        ('modified', '/dav/电影/B.mkv', False, 100, 1),
+        ('added', '/dav/电影/E.mkv', False, 100, 1),
+    ]
+
+    changes, _ = history_index.diff_runs(1, 2)
+    assert changes == [
+        ('modified', '/dav/电影/A.mkv', False, 200, 2),
+        ('removed', '/dav/电影/B.mkv', False, 100, 1),
+        ('added', '/dav/电影/D.mkv', False, 100, 1),
+        ('added', '/dav/电影/E.mkv', False, 100, 1),
+    ]
+    assert history_index.diff_runs(3, 3) == ([], None)
+    with pytest.raises(ValueError):
+        history_index.diff_runs(3, 1)
+
+
+def test_diff_runs_paging(history_index):
+    full, _ = history_index.diff_runs(1, 2)
+    pages = []
+    after = None
+    while True:
+        changes, after = history_index.diff_runs(1, 2, after, limit=1)
+        pages.append(changes)
+        if after is None:
+            break
+    # 每页一个路径，最后一页为空（上一页恰好取满时无法预知后面是否还有）
+    assert [change for page in pages for change in page] == full
+    assert all(len(page) <= 1 for page in pages)
+    assert list(history_index.iter_diff(1, 2, page_size=3)) == full
+
+
+def test_diff_runs_before_history_start(history_index, monkeypatch):
+    monkeypatch.setattr('tree_index.JOURNAL_KEEP_RUNS', 1)
+    history_index.compact(3)
+    assert history_index.history_start() == 2
+    assert [run['run_id'] for run in history_index.list_runs()] == [2, 3]
+    with pytest.raises(ValueError):
+        history_index.diff_runs(1, 3)
+    changes, _ = history_index.diff_runs(2, 3)
+    assert [change[:2] for change in changes] == [
+        ('modified', '/dav/电影/A.mkv'), ('added', '/dav/电影/B.mkv'), ('removed', '/dav/电影/D.mkv'),
+    ]
+
+
+def test_tree_history_resolve_run(history_index):
+    assert tree_history.resolve_run(history_index, '2') == 2
+    assert tree_history.resolve_run(history_index, '2024-01-02 12:00') == 2
+    assert tree_history.resolve_run(history_index, '2024-01-03') == 2
+    with pytest.raises(ValueError):
+        tree_history.resolve_run(history_index, '2023-12-31')
+    with pytest.raises(ValueError):
+        tree_history.resolve_run(history_index, 'yesterday')
+
+
+def test_tree_history_print_changes(history_index, capsys):
+    tree_history.print_changes(history_index.iter_diff(1, 3), ['added'], True)
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line)['path'] for line in lines] == ['/dav/电影/E.mkv']
@@ -0,0 +1,109 @@
+import json
+import os
+import struct
+import zlib
+
+from remote_tree import RemoteDirectory, RemoteFile
+
+# 文件头：魔数 + 格式版本 + 压缩方式
+MAGIC = b'STRMTREE'
+FORMAT_VERSION = 1
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+HEADER = struct.Struct('>8sBB')
+
+
+def encode_tree(tree, root_name):
+    """
+    把嵌套目录树编码为紧凑的嵌套列表：文件为 [名称, 大小, 修改时间]，目录为 [名称, 大小, 修改时间, 子条目, 摘要]。
+    名称只保存相对于上级目录的部分（上级目录路径不再重复），子条目未列出的目录子条目为 None。
+    """
+    def encode(nodes, parent):
+        encoded = []
+        for node in nodes:
+            name = node['name']
+            # 不在上级目录之下的节点保存完整路径（以 '/' 开头，解码时据此区分）
+            short_name = name[len(parent):] if name.startswith(parent) else name
+            item = [short_name, node.get('size') or 0, int(node.get('modified') or 0)]
+            if node.get('is_directory'):
+                children = node.get('children')
+                item.append(encode(children, name) if children is not None else None)
+                item.append(node.get('digest'))
+            encoded.append(item)
+        return encoded
+
+    return encode(tree or [], root_name)
+
+
+def decode_tree(encoded, root_name):
+    """
+    encode_tree 的逆操作，还原为紧凑的嵌套目录树（目录为 RemoteDirectory 节点）。
+    """
+    def decode(items, parent):
+        directories = []
+        files = []
+        for item in items:
+            short_name, size, modified = item[:3]
+            name = short_name if short_name.startswith('/') else parent + short_name
+            if len(item) == 3:
+                files.append((name, size, modified))
+                continue
+            node = RemoteDirectory(name, size, modified, item[4])
+            if item[3] is None:
+                node.children = None
+            else:
+                node.set_entries(*decode(item[3], name))
+            directories.append(node)
+        return directories, files
+
+    directories, files = decode(encoded or [], root_name)
+    return directories + [RemoteFile(name, size, modified) for name, size, modified in files]
+
+
+def dumps(payload, compress=True):
+    """
+    把可 JSON 序列化的 payload 编码为带版本头的字节串，默认使用 zlib 压缩。
+    """
+    data = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if compress:
+        return HEADER.pack(MAGIC, FORMAT_VERSION, COMPRESSION_ZLIB) + zlib.compress(data, 6)
+    return HEADER.pack(MAGIC, FORMAT_VERSION, COMPRESSION_NONE) + data
+
+
+def loads(data):
+    """
+    解码 dumps 生成的字节串。文件头不匹配或版本不支持时抛出 ValueError。
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("文件过短，不是有效的目录树文件")
+    magic, version, compression = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("文件头不匹配，不是有效的目录树文件")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"不支持的目录树文件版本: {version}")
+    body = data[HEADER.size:]
+    if compression == COMPRESSION_ZLIB:
+        body = zlib.decompress(body)
+    elif compression != COMPRESSION_NONE:
+        raise ValueError(f"不支持的压缩方式: {compression}")
+    return json.loads(body.decode('utf-8'))
+
+
+def write_file(path, payload, compress=True):
+    """
+    原子写入：先写同目录下的临时文件并刷新到磁盘，再重命名覆盖目标文件，写入中途崩溃不会损坏已有文件。
+    返回写入的字节数。
+    """
+    data = dumps(payload, compress)
+    temp_file = path + '.tmp'
+    with open(temp_file, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, path)
+    return len(data)
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return loads(f.read())
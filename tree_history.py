@@ -0,0 +1,112 @@
+import argparse
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+
+from db_handler import DBHandler
+from tree_index import DIFF_PAGE_SIZE, RemoteTreeIndex, tree_index_file
+
+logger = logging.getLogger('tree_history')
+
+
+def open_tree_index(config_id):
+    """
+    以只读方式打开配置对应的远程目录树索引，不影响正在运行的同步；配置不存在或尚未建立索引时返回 None。
+    """
+    db_handler = DBHandler()
+    try:
+        config = db_handler.get_webdav_config(config_id)
+    finally:
+        db_handler.close()
+    if not config or not os.path.exists(tree_index_file(config_id)):
+        return None
+    return RemoteTreeIndex(config_id, config['rootpath'], logger, readonly=True)
+
+
+def resolve_run(tree_index, value):
+    """
+    把命令行中的运行编号或时间（如 2024-01-02 或 '2024-01-02 08:00'）解析为运行编号。
+    """
+    if value.isdigit():
+        return int(value)
+    for time_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            timestamp = datetime.strptime(value, time_format).timestamp()
+            break
+        except ValueError:
+            continue
+    else:
+        raise ValueError(f"无法识别的运行编号或时间: {value}")
+    run_id = tree_index.run_at(timestamp)
+    if run_id is None:
+        raise ValueError(f"{value} 之前没有已结束的运行")
+    return run_id
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S') if timestamp else '-'
+
+
+def print_runs(tree_index):
+    for run in tree_index.list_runs():
+        flags = []
+        if run['complete']:
+            flags.append('完整')
+        print(f"{run['run_id']}\t{format_time(run['started_at'])}\t{format_time(run['finished_at'])}\t{','.join(flags)}")
+
+
+def print_changes(changes, change_types, as_json):
+    for change, path, is_dir, size, mtime in changes:
+        if change_types and change not in change_types:
+            continue
+        if as_json:
+            print(json.dumps({'change': change, 'path': path, 'is_dir': is_dir, 'size': size, 'mtime': mtime},
+                             ensure_ascii=False))
+        else:
+            print(f"{change}\t{path}\t{size}\t{format_time(mtime)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='查询远程目录树的历史运行，对比任意两次运行之间的变化')
+    parser.add_argument('config_id', type=int)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('runs', help='列出可查询的运行')
+    diff_parser = commands.add_parser('diff', help='对比两次运行结束时的目录树')
+    diff_parser.add_argument('from_run', help='起点：运行编号或时间（取该时间之前最后一次结束的运行）')
+    diff_parser.add_argument('to_run', nargs='?', default=None, help='终点：运行编号或时间，默认为最近一次运行')
+    diff_parser.add_argument('--change', action='append', choices=('added', 'removed', 'modified'),
+                             help='只输出指定类型的变化（可多次指定）')
+    diff_parser.add_argument('--page-size', type=int, default=DIFF_PAGE_SIZE, help='每页查询的路径数')
+    diff_parser.add_argument('--after', default=None, help='只查询一页：从该路径之后开始，并输出下一页的起点')
+    diff_parser.add_argument('--json', action='store_true', help='每行输出一个 JSON 对象')
+    args = parser.parse_args()
+
+    tree_index = open_tree_index(args.config_id)
+    if tree_index is None:
+        print(f"配置ID {args.config_id} 不存在或尚未建立远程目录树索引")
+        sys.exit(1)
+
+    try:
+        if args.command == 'runs':
+            print_runs(tree_index)
+            return
+
+        from_run = resolve_run(tree_index, args.from_run)
+        to_run = resolve_run(tree_index, args.to_run) if args.to_run else int(tree_index.get_meta('finished_run', 0))
+        if args.after is None:
+            print_changes(tree_index.iter_diff(from_run, to_run, args.page_size), args.change, args.json)
+        else:
+            changes, next_after = tree_index.diff_runs(from_run, to_run, args.after, args.page_size)
+            print_changes(changes, args.change, args.json)
+            print(f"下一页起点: {next_after}" if next_after is not None else "没有更多变化", file=sys.stderr)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        tree_index.close()
+
+
+if __name__ == '__main__':
+    main()
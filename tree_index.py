@@ -0,0 +1,503 @@
+import json
+import os
+import shutil
+import sqlite3
+import time
+from itertools import groupby
+from urllib.parse import unquote
+from urllib.request import pathname2url
+
+from listing_backend import parse_http_date
+from remote_tree import RemoteDirectory
+
+# 路径前缀范围查询的上界：任何以 prefix 开头的路径都小于 prefix + MAX_CHAR
+MAX_CHAR = '\U0010ffff'
+# 保留最近多少次运行的变更日志，以及保留的变更日志最多多少条（历史差异只能查询保留范围内的运行）
+JOURNAL_KEEP_RUNS = 100
+JOURNAL_MAX_ROWS = 1000000
+# 历史差异查询每页默认返回的路径数
+DIFF_PAGE_SIZE = 1000
+
+
+def legacy_mtime(value):
+    """
+    旧版缓存中的修改时间：easywebdav 返回的 HTTP 日期字符串，或已经是时间戳。
+    """
+    if isinstance(value, str):
+        return parse_http_date(value)
+    return int(value or 0)
+
+
+def tree_index_file(config_id):
+    return os.path.join('cache', f'tree_index_{config_id}.db')
+
+
+class RemoteTreeIndex:
+    """
+    远程目录树索引，保存在 cache/tree_index_<config_id>.db（SQLite）中，取代整棵树写入一个 JSON 文件的缓存方式。
+    每个远程条目一行：path 为解码后的完整路径（目录以 '/' 结尾），parent 为所在目录的路径，
+    listed 表示目录的子条目是否已成功列出，last_seen_run 为条目最近一次写入或变化时的运行编号，
+    digest 为目录的 Merkle 摘要（见 remote_tree.directory_digest），子条目可能已变化的目录摘要为空，
+    listed_at 为目录最近一次成功列出的时间（根目录记录在 meta 的 root_listed_at 中）。
+    遍历过程中每列出一个目录，只写入与索引相比新增、变化和删除的条目，未变化的条目不产生写入；
+    每条变更同时追加到只增不改的变更日志 tree_journal 中，每次运行结束后清理超出保留范围的旧日志（见 compact）。
+    readonly 为 True 时以只读方式打开已存在的索引，不建表也不写入 meta，同步运行持有写事务时也能查询。
+    """
+
+    def __init__(self, config_id, rootpath, logger, readonly=False):
+        cache_dir = 'cache'
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.db_file = tree_index_file(config_id)
+        self.legacy_cache_file = os.path.join(cache_dir, f'webdav_directory_cache_{config_id}.json')
+        # 早期版本定期写入的目录树快照，已不再使用
+        self.legacy_snapshot_dir = os.path.join(cache_dir, f'tree_snapshots_{config_id}')
+        self.root = unquote(rootpath).rstrip('/') + '/'
+        self.logger = logger
+        if readonly:
+            self.conn = sqlite3.connect(f'file:{pathname2url(os.path.abspath(self.db_file))}?mode=ro', uri=True)
+            return
+        self.conn = sqlite3.connect(self.db_file)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.initialize_tables()
+
+    def initialize_tables(self):
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS remote_tree (
+                                path TEXT PRIMARY KEY,
+                                parent TEXT,
+                                size INTEGER,
+                                mtime INTEGER,
+                                is_dir INTEGER,
+                                listed INTEGER DEFAULT 0,
+                                last_seen_run INTEGER,
+                                digest TEXT,
+                                listed_at REAL)''')
+        columns = [column[1] for column in self.conn.execute('PRAGMA table_info(remote_tree)')]
+        for column, column_type in (('digest', 'TEXT'), ('listed_at', 'REAL')):
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE remote_tree ADD COLUMN {column} {column_type}')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_remote_tree_parent ON remote_tree (parent)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_remote_tree_files ON remote_tree (is_dir, size)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        # 变更日志：change 为 added、removed 或 modified，记录变更后（删除时为删除前）的条目
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS tree_journal (
+                                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                                run_id INTEGER,
+                                change TEXT,
+                                path TEXT,
+                                parent TEXT,
+                                size INTEGER,
+                                mtime INTEGER,
+                                is_dir INTEGER)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_tree_journal_run ON tree_journal (run_id)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_tree_journal_path ON tree_journal (path, seq)')
+        # 每次运行的起止时间，用于按时间定位运行编号
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS tree_runs (
+                                run_id INTEGER PRIMARY KEY,
+                                started_at REAL,
+                                finished_at REAL,
+                                complete INTEGER DEFAULT 0)''')
+
+        # 根路径变化后旧索引不再适用，整体清空
+        if self.get_meta('rootpath') not in (None, self.root):
+            self.logger.info("配置的根路径已变化，清空远程目录树索引。")
+            self.conn.execute('DELETE FROM remote_tree')
+            self.conn.execute('DELETE FROM tree_journal')
+            self.conn.execute('DELETE FROM tree_runs')
+            self.conn.execute('DELETE FROM meta')
+            shutil.rmtree(self.legacy_snapshot_dir, ignore_errors=True)
+        # 根路径未变化时不写入，避免每次打开索引都开启写事务
+        if self.get_meta('rootpath') != self.root:
+            self.set_meta('rootpath', self.root)
+        self.remove_legacy_snapshots()
+        self.conn.commit()
+
+    def remove_legacy_snapshots(self):
+        """
+        删除早期版本写入的快照目录。当时最早快照之前的变更日志已被删除，把它记为历史差异的起点。
+        """
+        if not os.path.isdir(self.legacy_snapshot_dir):
+            return
+        runs = sorted(int(file_name[4:-4]) for file_name in os.listdir(self.legacy_snapshot_dir)
+                      if file_name.startswith('run_') and file_name.endswith('.dat') and file_name[4:-4].isdigit())
+        if runs and runs[0] > self.history_start():
+            self.set_meta('history_start', runs[0])
+        shutil.rmtree(self.legacy_snapshot_dir, ignore_errors=True)
+        self.logger.info(f"已删除不再使用的目录树快照: {self.legacy_snapshot_dir}")
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def has_entries(self):
+        return self.conn.execute('SELECT 1 FROM remote_tree LIMIT 1').fetchone() is not None
+
+    def import_legacy_cache(self):
+        """
+        索引为空且存在旧版 JSON 缓存时，把 JSON 缓存导入索引（只导入一次），旧文件保留不动。
+        旧版缓存直接保存了 PROPFIND 的结果：每个目录的子条目中包含目录自身，修改时间为 HTTP 日期字符串，
+        导入时跳过目录自身的条目并把修改时间转换为时间戳。
+        """
+        if not os.path.exists(self.legacy_cache_file):
+            return
+        if self.has_entries():
+            self.repair_legacy_rows()
+            return
+        try:
+            with open(self.legacy_cache_file, 'r', encoding='utf-8') as f:
+                tree = json.load(f)
+        except Exception as e:
+            self.logger.error(f"读取旧版缓存文件出错，跳过导入: {e}")
+            return
+
+        rows = []
+        stack = [(self.root, node) for node in reversed(tree or [])]
+        while stack:
+            parent, node = stack.pop()
+            # 目录自身的条目（包括根目录）会让目录成为自己的子条目
+            if node['name'].rstrip('/') in (parent.rstrip('/'), self.root.rstrip('/')):
+                continue
+            children = node.get('children')
+            is_dir = bool(node.get('is_directory'))
+            rows.append((node['name'], parent, node.get('size', 0), legacy_mtime(node.get('modified')), int(is_dir),
+                         int(is_dir and children is not None), 0))
+            if is_dir and children:
+                stack.extend((node['name'], child) for child in reversed(children))
+        self.conn.executemany('''INSERT OR REPLACE INTO remote_tree (path, parent, size, mtime, is_dir, listed, last_seen_run)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?)''', rows)
+        # 旧缓存来自一次完整运行
+        self.set_meta('complete', 1)
+        self.set_meta('finished_at', os.path.getmtime(self.legacy_cache_file))
+        self.set_meta('legacy_repaired', 1)
+        self.conn.commit()
+        self.logger.info(f"已将旧版缓存文件 {self.legacy_cache_file} 导入远程目录树索引，共 {len(rows)} 个条目")
+
+    def repair_legacy_rows(self):
+        """
+        修复早期版本从旧版缓存导入的索引（只执行一次）：目录自身的条目覆盖了目录原来的行，使目录成为自己的子条目，
+        把这些行的 parent 改回上级目录（根目录自身的行删除）；把字符串形式的修改时间转换为时间戳。
+        """
+        if self.get_meta('legacy_repaired'):
+            return
+        removed = self.conn.execute('DELETE FROM remote_tree WHERE path = ?', (self.root,)).rowcount
+        self_rows = [path for (path,) in self.conn.execute('SELECT path FROM remote_tree WHERE path = parent')]
+        self.conn.executemany('UPDATE remote_tree SET parent = ? WHERE path = ?',
+                              [(path.rstrip('/').rsplit('/', 1)[0] + '/', path) for path in self_rows])
+        text_rows = self.conn.execute("SELECT path, mtime FROM remote_tree WHERE typeof(mtime) = 'text'").fetchall()
+        self.conn.executemany('UPDATE remote_tree SET mtime = ? WHERE path = ?',
+                              [(legacy_mtime(mtime), path) for path, mtime in text_rows])
+        if removed or self_rows or text_rows:
+            # 摘要由错误的条目计算得出，全部作废，下次运行时重新计算
+            self.conn.execute('UPDATE remote_tree SET digest = NULL')
+            self.logger.info(f"已修复从旧版缓存导入的索引：{removed + len(self_rows)} 个目录自身的条目，"
+                             f"{len(text_rows)} 个字符串形式的修改时间")
+        self.set_meta('legacy_repaired', 1)
+        self.conn.commit()
+
+    def load_tree(self):
+        """
+        从索引组装紧凑的嵌套目录树（根目录的子条目列表，目录为 RemoteDirectory 节点），
+        按父目录分组读取，每个目录的文件直接打包，不为每个文件创建对象。
+        子条目未成功列出的目录 children 为 None，目录节点带有已保存的 'digest' 和 'listed_at'。
+        """
+        directories = {self.root: RemoteDirectory(self.root)}
+        rows = self.conn.execute('SELECT parent, path, size, mtime, is_dir, listed, digest, listed_at FROM remote_tree ORDER BY parent, rowid')
+        for parent, group in groupby(rows, key=lambda row: row[0]):
+            subdirectories = []
+            files = []
+            for _, path, size, mtime, is_dir, listed, digest, listed_at in group:
+                if not is_dir:
+                    files.append((path, size, mtime))
+                    continue
+                node = directories.get(path)
+                if node is None:
+                    node = directories[path] = RemoteDirectory(path)
+                node.size, node.modified, node.digest, node.listed_at = size, mtime, digest, listed_at
+                if not listed:
+                    node.children = None
+                subdirectories.append(node)
+            parent_node = directories.get(parent)
+            if parent_node is None:
+                parent_node = directories[parent] = RemoteDirectory(parent)
+            # 未成功列出的目录（listed = 0）保留已有子条目行，但不作为缓存复用
+            if parent_node.listed:
+                parent_node.set_entries(subdirectories, files)
+        return directories[self.root].children
+
+    def begin_run(self):
+        run_id = int(self.get_meta('last_run', 0)) + 1
+        self.set_meta('last_run', run_id)
+        self.conn.execute('INSERT OR REPLACE INTO tree_runs (run_id, started_at) VALUES (?, ?)', (run_id, time.time()))
+        self.conn.commit()
+        return run_id
+
+    def ensure_directory(self, path, run_id):
+        """
+        确保目录 path（解码后，以 '/' 结尾）及其上级目录在索引中存在，部分同步前调用。
+        新建的目录修改时间记为 0，下次增量更新时不会被当作未变化而跳过。
+        沿途目录的摘要清空，等下次完整运行时重新计算。
+        """
+        relative = path[len(self.root):].strip('/')
+        parent = self.root
+        for part in relative.split('/') if relative else []:
+            current = f"{parent}{part}/"
+            cursor = self.conn.execute('''INSERT OR IGNORE INTO remote_tree (path, parent, size, mtime, is_dir, listed, last_seen_run)
+                                          VALUES (?, ?, 0, 0, 1, 0, ?)''', (current, parent, run_id))
+            if cursor.rowcount:
+                self.append_journal([(run_id, 'added', current, parent, 0, 0, 1)])
+            self.conn.execute('UPDATE remote_tree SET digest = NULL WHERE path = ?', (current,))
+            parent = current
+
+    def record_listing(self, directory, entries, run_id):
+        """
+        写入目录 directory（解码后，以 '/' 结尾）的一次成功列表：与索引中该目录现有的子条目比较，
+        只插入新增的、更新大小或修改时间变化的、删除已不存在的子条目（连同子树），每条变更追加到变更日志。
+        有变更时清空该目录及所有上级目录的摘要（遍历结束后由 update_digests 重新写入），最后把该目录标记为已列出。
+        """
+        existing = {
+            path: (size, mtime, is_dir)
+            for path, size, mtime, is_dir in self.conn.execute(
+                'SELECT path, size, mtime, is_dir FROM remote_tree WHERE parent = ?', (directory,))
+        }
+        inserts = []
+        updates = []
+        journal = []
+        for entry in entries:
+            path = unquote(entry.name)
+            current = (entry.size, entry.mtime, int(entry.is_directory))
+            previous = existing.pop(path, None)
+            if previous == current:
+                continue
+            if previous is not None and previous[2] == current[2]:
+                updates.append((entry.size, entry.mtime, run_id, path))
+                journal.append((run_id, 'modified', path, directory) + current)
+                continue
+            if previous is not None:
+                # 文件与目录互相替换：先删除旧条目（及其子树）
+                journal.extend(self.delete_subtree(path, previous[2], run_id))
+            inserts.append((path, directory) + current + (run_id,))
+            journal.append((run_id, 'added', path, directory) + current)
+        for path, previous in existing.items():
+            journal.extend(self.delete_subtree(path, previous[2], run_id))
+
+        self.conn.executemany('''INSERT INTO remote_tree (path, parent, size, mtime, is_dir, listed, last_seen_run)
+                                 VALUES (?, ?, ?, ?, ?, 0, ?)''', inserts)
+        self.conn.executemany('UPDATE remote_tree SET size = ?, mtime = ?, last_seen_run = ? WHERE path = ?', updates)
+        if journal:
+            self.append_journal(journal)
+            self.conn.executemany('UPDATE remote_tree SET digest = NULL WHERE path = ?',
+                                  [(path,) for path in self.ancestors(directory)])
+
+        listed_at = time.time()
+        self.conn.execute('UPDATE remote_tree SET listed = 1, listed_at = ? WHERE path = ?', (listed_at, directory))
+        if directory == self.root:
+            self.set_meta('root_listed_at', listed_at)
+
+    def ancestors(self, directory):
+        """
+        directory 本身及其在根目录之下的所有上级目录。
+        """
+        relative = directory[len(self.root):].strip('/')
+        paths = []
+        current = self.root
+        for part in relative.split('/') if relative else []:
+            current = f"{current}{part}/"
+            paths.append(current)
+        return paths
+
+    def delete_subtree(self, path, is_dir, run_id):
+        """
+        删除条目 path 及其子树（path 为目录时），返回对应的变更日志记录。
+        """
+        upper = path + MAX_CHAR if is_dir else path
+        rows = self.conn.execute('SELECT path, parent, size, mtime, is_dir FROM remote_tree WHERE path >= ? AND path <= ?',
+                                 (path, upper)).fetchall()
+        self.conn.executemany('DELETE FROM remote_tree WHERE path = ?', [(row[0],) for row in rows])
+        return [(run_id, 'removed') + tuple(row) for row in rows]
+
+    def append_journal(self, records):
+        self.conn.executemany('''INSERT INTO tree_journal (run_id, change, path, parent, size, mtime, is_dir)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?)''', records)
+
+    def mark_unlisted(self, directory):
+        """
+        目录列出失败：保留已有的子条目，但标记为未列出，下次运行不会直接复用。
+        """
+        self.conn.execute('UPDATE remote_tree SET listed = 0, digest = NULL WHERE path = ?', (directory,))
+
+    def update_digests(self, digests):
+        """
+        保存本次计算出的目录摘要，digests 为 [(目录名, 摘要), ...]，与已保存摘要相同的目录不产生写入。
+        """
+        self.conn.executemany('UPDATE remote_tree SET digest = ? WHERE path = ? AND digest IS NOT ?',
+                              [(digest, path, digest) for path, digest in digests])
+
+    def compact(self, run_id):
+        """
+        压缩变更日志：只保留最近 JOURNAL_KEEP_RUNS 次运行的变更日志，保留的条数超过 JOURNAL_MAX_ROWS 时再丢弃更早的运行。
+        当前状态始终保存在 remote_tree 表中，不需要另外的快照；丢弃后更新可查询历史差异的起点（meta 中的 history_start）。
+        """
+        history_start = self.history_start()
+        start = max(run_id - JOURNAL_KEEP_RUNS, history_start)
+        kept_rows = 0
+        for journal_run, rows in self.conn.execute('''SELECT run_id, COUNT(*) FROM tree_journal WHERE run_id > ?
+                                                      GROUP BY run_id ORDER BY run_id DESC''', (start,)).fetchall():
+            kept_rows += rows
+            if kept_rows > JOURNAL_MAX_ROWS:
+                start = journal_run
+                break
+        if start <= history_start:
+            return
+
+        deleted = self.conn.execute('DELETE FROM tree_journal WHERE run_id <= ?', (start,)).rowcount
+        self.conn.execute('DELETE FROM tree_runs WHERE run_id < ?', (start,))
+        self.set_meta('history_start', start)
+        self.conn.commit()
+        self.logger.info(f"已清理运行 {start} 及之前的 {deleted} 条变更日志，历史差异最早可从运行 {start} 开始查询")
+
+    def commit(self):
+        self.conn.commit()
+
+    def finish_run(self, run_id, complete):
+        """
+        记录一次运行结束。complete 表示本次遍历覆盖了整个根目录（部分同步时为 False）。
+        """
+        finished_at = time.time()
+        self.set_meta('finished_run', run_id)
+        self.set_meta('finished_at', finished_at)
+        self.conn.execute('UPDATE tree_runs SET finished_at = ?, complete = ? WHERE run_id = ?',
+                          (finished_at, int(bool(complete)), run_id))
+        if complete:
+            self.set_meta('complete', 1)
+        self.conn.commit()
+        try:
+            self.compact(run_id)
+        except Exception as e:
+            self.logger.error(f"压缩变更日志时出错: {e}")
+
+    def list_runs(self):
+        """
+        可查询历史差异的运行，返回 [{'run_id', 'started_at', 'finished_at', 'complete'}, ...]，按运行编号排列。
+        最早的一次为 history_start 对应的运行，它的变更日志已被清理，只能作为差异的起点。
+        """
+        rows = self.conn.execute('SELECT run_id, started_at, finished_at, complete FROM tree_runs WHERE run_id >= ? ORDER BY run_id',
+                                 (self.history_start(),))
+        return [
+            {'run_id': run_id, 'started_at': started_at, 'finished_at': finished_at, 'complete': bool(complete)}
+            for run_id, started_at, finished_at, complete in rows
+        ]
+
+    def history_start(self):
+        """
+        变更日志覆盖的起点：该运行及之前的变更日志已被清理，之后每次运行的变更都在变更日志中。
+        """
+        return int(self.get_meta('history_start', 0))
+
+    def run_at(self, timestamp):
+        """
+        timestamp 时刻的目录树对应的运行编号：该时刻之前最后一次结束的运行，没有时返回 None。
+        """
+        row = self.conn.execute('SELECT MAX(run_id) FROM tree_runs WHERE finished_at <= ?', (timestamp,)).fetchone()
+        return row[0]
+
+    def diff_runs(self, from_run, to_run, after=None, limit=DIFF_PAGE_SIZE):
+        """
+        对比运行 from_run 结束时与 to_run 结束时的目录树，由两次运行之间的变更日志合并得到，不需要重建整棵树。
+        按路径分页返回 (变化列表, 下一页起点)：变化列表格式与 remote_tree.diff_trees 一致，
+        after 为上一页返回的起点（只返回路径大于它的条目），没有下一页时起点为 None。
+        from_run 早于变更日志覆盖的起点时抛出 ValueError。
+        """
+        if from_run > to_run:
+            raise ValueError(f"起始运行 {from_run} 晚于结束运行 {to_run}")
+        if from_run < self.history_start():
+            raise ValueError(f"运行 {from_run} 的变更日志已被清理，最早只能从运行 {self.history_start()} 开始对比")
+
+        groups = self.conn.execute('''SELECT path, MIN(seq), MAX(seq) FROM tree_journal
+                                      WHERE run_id > ? AND run_id <= ? AND path > ?
+                                      GROUP BY path ORDER BY path LIMIT ?''',
+                                   (from_run, to_run, after or '', limit)).fetchall()
+        sequences = [seq for _, first_seq, last_seq in groups for seq in (first_seq, last_seq)]
+        records = {}
+        # 分批查询，避免超过 SQLite 的参数数量上限
+        for start in range(0, len(sequences), 500):
+            batch = sequences[start:start + 500]
+            placeholders = ','.join('?' * len(batch))
+            for seq, change, path, is_dir, size, mtime in self.conn.execute(
+                    f'SELECT seq, change, path, is_dir, size, mtime FROM tree_journal WHERE seq IN ({placeholders})', batch):
+                records[seq] = (change, path, bool(is_dir), size, mtime)
+
+        changes = []
+        for path, first_seq, last_seq in groups:
+            first = records[first_seq]
+            last = records[last_seq]
+            # 第一条变更为新增说明起点时不存在，最后一条为删除说明终点时不存在
+            existed = first[0] != 'added'
+            exists = last[0] != 'removed'
+            if existed and exists:
+                if first[2] != last[2]:
+                    changes.append(('removed', path) + first[2:])
+                    changes.append(('added', path) + last[2:])
+                else:
+                    changes.append(('modified', path) + last[2:])
+            elif existed:
+                changes.append(('removed', path) + last[2:])
+            elif exists:
+                changes.append(('added', path) + last[2:])
+        next_after = groups[-1][0] if len(groups) == limit else None
+        return changes, next_after
+
+    def iter_diff(self, from_run, to_run, page_size=DIFF_PAGE_SIZE):
+        """
+        逐页遍历 diff_runs 的全部结果，每次只在内存中保留一页。
+        """
+        after = None
+        while True:
+            changes, after = self.diff_runs(from_run, to_run, after, page_size)
+            yield from changes
+            if after is None:
+                break
+
+    def stale_directories(self, max_age_seconds):
+        """
+        需要重新列出的目录（解码后的完整路径）：从未成功列出，或最近一次列出早于 max_age_seconds 秒前。
+        已被其它过期目录包含的子目录不再单独返回；根目录过期时只返回根目录。
+        """
+        cutoff = time.time() - max_age_seconds
+        if float(self.get_meta('root_listed_at', 0)) < cutoff:
+            return [self.root]
+        rows = self.conn.execute('''SELECT path FROM remote_tree
+                                    WHERE is_dir = 1 AND (listed = 0 OR listed_at IS NULL OR listed_at < ?)
+                                    ORDER BY path''', (cutoff,))
+        stale = []
+        for (path,) in rows:
+            # 按路径排序后，子目录紧跟在上级目录之后
+            if stale and path.startswith(stale[-1]):
+                continue
+            stale.append(path)
+        return stale
+
+    def has_entry(self, path):
+        return self.conn.execute('SELECT 1 FROM remote_tree WHERE path = ?', (path,)).fetchone() is not None
+
+    def list_files(self, directory):
+        """
+        目录中的文件路径（不含子目录），directory 为以 '/' 结尾的完整路径。
+        """
+        return [path for (path,) in self.conn.execute('SELECT path FROM remote_tree WHERE parent = ? AND is_dir = 0',
+                                                      (directory,))]
+
+    def count_entries(self):
+        return self.conn.execute('SELECT COUNT(*) FROM remote_tree').fetchone()[0]
+
+    def iter_files(self, min_size=0):
+        """
+        逐行返回大小不小于 min_size 的远程文件 (path, size)，不把整棵树读入内存。
+        """
+        return self.conn.execute('SELECT path, size FROM remote_tree WHERE is_dir = 0 AND size >= ?', (min_size,))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,108 @@
+from urllib.parse import urlparse
+from xml.etree import ElementTree
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from listing_backend import RemoteEntry, parse_http_date
+
+# 只请求遍历所需的三个属性，服务器无需计算其它属性，响应体积也更小
+PROPFIND_BODY = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<d:propfind xmlns:d="DAV:"><d:prop>'
+    '<d:getcontentlength/><d:getlastmodified/><d:resourcetype/>'
+    '</d:prop></d:propfind>'
+)
+
+# 读取响应体时每次交给解析器的字节数
+READ_CHUNK_SIZE = 65536
+
+
+class WebDAVError(Exception):
+    """
+    PROPFIND 请求返回非 207 状态码时抛出，status_code 为服务器返回的状态码。
+    """
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def parse_response_element(elem):
+    """
+    把 multistatus 中的一个 <D:response> 元素转换为 RemoteEntry。
+    """
+    href = elem.findtext('{DAV:}href') or ''
+    if href.startswith('http://') or href.startswith('https://'):
+        href = urlparse(href).path
+    is_directory = elem.find('.//{DAV:}resourcetype/{DAV:}collection') is not None or href.endswith('/')
+    if is_directory and not href.endswith('/'):
+        href += '/'
+    size_text = elem.findtext('.//{DAV:}getcontentlength')
+    try:
+        size = int(size_text) if size_text else 0
+    except ValueError:
+        size = 0
+    return RemoteEntry(href, size, parse_http_date(elem.findtext('.//{DAV:}getlastmodified')), is_directory)
+
+
+def iter_propfind_entries(chunks):
+    """
+    增量解析 PROPFIND 的 multistatus 响应，每解析完一个 <D:response> 就产出一个 RemoteEntry，
+    并立即释放已处理的元素，响应再大内存占用也保持稳定。
+    """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    root = None
+
+    def drain():
+        nonlocal root
+        for event, elem in parser.read_events():
+            if event == 'start':
+                if root is None:
+                    root = elem
+            elif elem.tag == '{DAV:}response':
+                yield parse_response_element(elem)
+                # 已处理的 response 从根节点上摘除，避免整个文档堆积在内存中
+                root.clear()
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from drain()
+    parser.close()
+    yield from drain()
+
+
+class WebDAVClient:
+    """
+    专用于目录遍历的轻量 WebDAV 客户端：PROPFIND 只请求大小、修改时间和类型三个属性，
+    流式增量解析响应。所有线程共享一个带连接池的 Session，复用 keep-alive 连接。
+    """
+
+    def __init__(self, config, pool_size=10, timeout=(10, 300)):
+        self.base_url = f"{config['protocol']}://{config['host']}:{config['port']}"
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = (config['username'], config['password'])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def propfind(self, path, depth=1):
+        """
+        对 path（已 URL 编码）发送 PROPFIND，逐个产出 RemoteEntry（包含 path 自身）。
+        """
+        response = self.session.request(
+            'PROPFIND', self.base_url + path, data=PROPFIND_BODY,
+            headers={'Depth': str(depth), 'Content-Type': 'application/xml; charset=utf-8'},
+            stream=True, timeout=self.timeout
+        )
+        with response:
+            if response.status_code != 207:
+                raise WebDAVError(f"PROPFIND {path} 失败，状态码: {response.status_code}", response.status_code)
+            yield from iter_propfind_entries(response.iter_content(chunk_size=READ_CHUNK_SIZE))
+
+    def ls(self, path):
+        return list(self.propfind(path, depth=1))
+
+    def close(self):
+        self.session.close()